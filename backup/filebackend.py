@@ -3,11 +3,47 @@ import os
 import struct
 import shutil
 import tempfile
-from typing import Iterator
-from urllib.parse import urlparse
+import threading
+from typing import Iterator, Tuple
+from urllib.parse import urlparse, parse_qs
 from backend import Backend, Change
 
 
+# fdatasync is missing on some platforms, fsync does the job there
+fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+
+def pwrite_joined(fd: int, buffers: list, offset: int) -> int:
+    return os.pwrite(fd, b''.join(buffers), offset)
+
+
+# pwritev is missing on some platforms too, one pwrite of the joined
+# buffers writes the same
+pwritev = getattr(os, 'pwritev', pwrite_joined)
+
+
+def parse_sync(query: str) -> Tuple[str, float]:
+    '''Parse the durability settings from the query of a file: URL.
+
+    `sync=change` syncs every change before it is confirmed, `sync=group`
+    (default) syncs all changes of a `window` of milliseconds at once,
+    `sync=none` leaves it to the operating system.
+    '''
+    sync, window = 'group', 0.1
+    for (key, values) in parse_qs(query).items():
+        if len(values) != 1:
+            raise ValueError('{} can only have one value'.format(key))
+        if key == 'sync':
+            if values[0] not in ('change', 'group', 'none'):
+                raise ValueError('Unknown sync mode ' + values[0])
+            sync = values[0]
+        elif key == 'window':
+            window = int(values[0]) / 1000
+        else:
+            raise ValueError('Unknown query string parameter ' + key)
+    return sync, window
+
+
 class FileBackend(Backend):
     def __init__(self, destination: str, create: bool):
         self.version = None
@@ -16,6 +52,12 @@ class FileBackend(Backend):
         self.offsets = [0, 0]
         self.version_count = 0
         self.url = urlparse(self.destination)
+        self.sync, self.sync_window = parse_sync(self.url.query)
+        # The backup file stays open, the lock keeps the group commit
+        # timer away while it is synced, closed or swapped.
+        self.fd = None
+        self.lock = threading.Lock()
+        self.timer = None
 
         if os.path.exists(self.url.path) and create:
             raise ValueError("Attempted to create a FileBackend, but file already exists.")
@@ -31,19 +73,57 @@ class FileBackend(Backend):
     def initialize(self) -> bool:
         return self.read_metadata()
 
-    def write_metadata(self):
+    def _open(self) -> int:
+        if self.fd is None:
+            self.fd = os.open(self.url.path, os.O_RDWR | os.O_CREAT, 0o666)
+        return self.fd
+
+    def close(self):
+        """Sync and close the backup file, it is reopened when needed."""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.fd is not None:
+                fdatasync(self.fd)
+                os.close(self.fd)
+                self.fd = None
+
+    def _group_sync(self):
+        # Sync a duplicate so neither the next change nor close() has to
+        # wait for it.
+        with self.lock:
+            self.timer = None
+            fd = os.dup(self.fd) if self.fd is not None else None
+        if fd is not None:
+            try:
+                fdatasync(fd)
+            finally:
+                os.close(fd)
+
+    def _sync_write(self):
+        """Called after each write, syncs it as configured."""
+        if self.sync == 'change':
+            fdatasync(self.fd)
+        elif self.sync == 'group':
+            # one sync for all changes of the window
+            with self.lock:
+                if self.timer is None:
+                    self.timer = threading.Timer(self.sync_window, self._group_sync)
+                    self.timer.daemon = True
+                    self.timer.start()
+
+    def _header(self) -> bytes:
         blob = struct.pack("!IIQIQQ", 0x01, self.version, self.offsets[0],
                            self.prev_version, self.offsets[1],
                            self.version_count)
 
         # Pad the header
-        blob += b'\x00' * (512 - len(blob))
-        mode = "rb+" if os.path.exists(self.url.path) else "wb+"
+        return blob + b'\x00' * (512 - len(blob))
 
-        with open(self.url.path, mode) as f:
-            f.seek(0)
-            f.write(blob)
-            f.flush()
+    def write_metadata(self):
+        os.pwrite(self._open(), self._header(), 0)
+        self._sync_write()
 
     def read_metadata(self):
         with open(self.url.path, 'rb') as f:
@@ -70,16 +150,22 @@ class FileBackend(Backend):
 
         length = struct.pack("!I", len(payload))
         version = struct.pack("!I", entry.version)
-        with open(self.url.path, 'ab') as f:
-            f.seek(self.offsets[0])
-            f.write(length)
-            f.write(version)
-            f.write(typ)
-            f.write(payload)
-            self.prev_version, self.offsets[1] = self.version, self.offsets[0]
-            self.version = entry.version
-            self.offsets[0] += 9 + len(payload)
-            self.version_count += 1
+        # Write the entry where the header says the next one goes, after a
+        # rewind that's over the rewound one, and only then the header.
+        buffers = [length, version, typ, payload]
+        written = pwritev(self._open(), buffers, self.offsets[0])
+        if written != sum(len(b) for b in buffers):
+            logging.error("Short write to the backup, {} of {} bytes".format(written, sum(len(b) for b in buffers)))
+            return False
+        # A header pointing beyond a lost entry would corrupt the backup,
+        # only sync=change orders them. The other modes write the header
+        # right away too, so a crash of the plugin loses nothing.
+        if self.sync == 'change':
+            fdatasync(self.fd)
+        self.prev_version, self.offsets[1] = self.version, self.offsets[0]
+        self.version = entry.version
+        self.offsets[0] += 9 + len(payload)
+        self.version_count += 1
         self.write_metadata()
 
         return True
@@ -193,6 +279,8 @@ class FileBackend(Backend):
 
         assert self.version == clone.version
         assert self.prev_version == clone.prev_version
+        # The clone has to be on disk before it replaces the backup.
+        clone.close()
 
         stats['after'] = {
             'version_count': clone.version_count,
@@ -203,6 +291,7 @@ class FileBackend(Backend):
             stats['before']['version_count'] - stats['after']['version_count'],
             stats['before']['backupsize'] - stats['after']['backupsize'],
         ))
+        self.close()
         shutil.move(clonepath, self.url.path)
 
         # Re-initialize ourselves so we have the correct metadata
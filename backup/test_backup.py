@@ -1,4 +1,6 @@
-from backend import Backend
+from backend import Backend, Change
+from filebackend import FileBackend, parse_sync
+import filebackend
 import socketbackend
 from flaky import flaky
 from pyln.testing.fixtures import *  # noqa: F401,F403
@@ -333,3 +335,44 @@ def test_parse_socket_url():
     assert s.proxytarget.host == '127.0.0.1'
     assert s.proxytarget.port == 9050
     assert s.proxytarget.addrtype == socketbackend.AddrType.IPv4
+
+
+def test_parse_file_sync():
+    assert parse_sync('') == ('group', 0.1)
+    assert parse_sync('sync=change') == ('change', 0.1)
+    assert parse_sync('sync=group&window=20') == ('group', 0.02)
+    with pytest.raises(ValueError):
+        parse_sync('sync=always')
+    with pytest.raises(ValueError):
+        parse_sync('sync=none&sync=change')
+    with pytest.raises(ValueError):
+        parse_sync('dummy=value')
+
+
+@pytest.mark.parametrize("sync", ["change", "group", "none"])
+def test_file_backend_rewind(tmp_path, sync):
+    """The entry after a rewind replaces the rewound one, whatever the sync mode.
+    """
+    bdest = 'file://' + str(tmp_path / 'backup.dbak') + '?sync=' + sync
+    backend = FileBackend(bdest, create=True)
+    for version in range(1, 4):
+        assert backend.add_change(Change(version, None, ["UPDATE vars SET intval={}".format(version)]))
+    assert backend.rewind()
+    assert backend.add_change(Change(3, None, ["UPDATE vars SET intval=33"]))
+    backend.close()
+
+    backend = FileBackend(bdest, create=False)
+    assert backend.initialize()
+    assert (backend.version, backend.prev_version, backend.version_count) == (3, 2, 4)
+    assert [c.transaction for c in backend.stream_changes()] == [
+        ["UPDATE vars SET intval=1"],
+        ["UPDATE vars SET intval=2"],
+        ["UPDATE vars SET intval=33"],
+    ]
+
+
+def test_file_backend_without_pwritev(tmp_path, monkeypatch):
+    """Platforms without os.pwritev write the joined buffers instead.
+    """
+    monkeypatch.setattr(filebackend, 'pwritev', filebackend.pwrite_joined)
+    test_file_backend_rewind(tmp_path, 'change')
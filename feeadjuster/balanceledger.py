@@ -0,0 +1,74 @@
+import threading
+import time
+from pyln.client import Millisatoshi
+
+
+class BalanceLedger(object):
+    """ Our and the total amount of each channel in msat, indexed by scid.
+
+    Kept up to date from notifications: `forward` with the amounts of a
+    settled forward, `move` with the channel movements of our own payments.
+    Amounts may be given like notifications have them, i.e. "1000msat".
+    It is reconciled against a `listpeerchannels` snapshot at start and
+    periodically, which also corrects drift from missed notifications.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.balances = {}      # scid -> {"our", "total"}
+        self.channel_ids = {}   # channel_id -> scid, coin movements use channel ids
+        self.reconciled_at = 0
+        self.stale = False      # a channel opened, reconcile on the next occasion
+
+    def __contains__(self, scid: str):
+        return scid in self.balances
+
+    def balance(self, scid: str):
+        with self.lock:
+            b = self.balances.get(scid)
+            return dict(b) if b is not None else None
+
+    def reconcile(self, snapshot):
+        """ Takes over the balances of a `ChannelSnapshot` """
+        with self.lock:
+            self.balances = {}
+            self.channel_ids = {}
+            for ch in snapshot:
+                scid = ch.get("short_channel_id")
+                if scid is None:
+                    continue
+                self.balances[scid] = {"our": int(Millisatoshi(ch["to_us_msat"])),
+                                       "total": int(Millisatoshi(ch["total_msat"]))}
+                if ch.get("channel_id") is not None:
+                    self.channel_ids[ch["channel_id"]] = scid
+            self.reconciled_at = time.time()
+            self.stale = False
+
+    def due(self, interval: float):
+        return self.stale or time.time() - self.reconciled_at >= interval
+
+    def _add(self, scid: str, msat: int):
+        b = self.balances.get(scid)
+        if b is None:
+            # unknown channel, the next reconciliation picks it up
+            self.stale = True
+            return
+        b["our"] = min(max(b["our"] + msat, 0), b["total"])
+
+    def forward(self, in_scid: str, out_scid: str, in_msat, out_msat):
+        """ A settled forward: we got `in_msat` and paid `out_msat` """
+        with self.lock:
+            self._add(in_scid, int(Millisatoshi(in_msat)))
+            self._add(out_scid, -int(Millisatoshi(out_msat)))
+
+    def move(self, channel_id: str, credit_msat, debit_msat):
+        """ A channel movement of a `coin_movement` notification """
+        with self.lock:
+            scid = self.channel_ids.get(channel_id)
+            if scid is None:
+                self.stale = True
+                return
+            self._add(scid, int(Millisatoshi(credit_msat)) - int(Millisatoshi(debit_msat)))
+
+    def drop(self, scid: str):
+        with self.lock:
+            self.balances.pop(scid, None)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+""" Offline replay of forward events through the feeadjuster plugin.
+
+Feeds a stream of `forward_event` notifications to the plugin's handler,
+connected to a FakeRpc instead of lightningd, and reports handler latency,
+mutex hold time, RPC calls per event and the `setchannel` updates for each
+combination of adjustment method and fee strategy. The stream is either
+synthetic or recorded with `lightning-cli listforwards > forwards.json`.
+Other plugin options can be swept with comma separated values, every
+combination replays the identical stream on an identical node:
+
+    python3 benchmark.py --events 2000
+    python3 benchmark.py --forwards forwards.json --methods default hard --strategies median
+    python3 benchmark.py --option feeadjuster-threshold=0.05,0.1 --option feeadjuster-coalesce-window=0,1
+    python3 benchmark.py --latency 0.01 --option feeadjuster-parallel=1,8
+"""
+import argparse
+import importlib
+import itertools
+import json
+import random
+import threading
+import time
+from fakerpc import FakeRpc
+import feeadjuster
+
+
+class TimedLock(object):
+    """ A Lock that records how long it was held """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.acquired_at = None
+        self.held = []
+
+    def acquire(self, blocking: bool = True, timeout: float = -1):
+        acquired = self.lock.acquire(blocking, timeout)
+        if acquired:
+            self.acquired_at = time.perf_counter()
+        return acquired
+
+    def release(self):
+        self.held.append(time.perf_counter() - self.acquired_at)
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    __enter__ = acquire
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def percentile(values: list, percent: float):
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+
+def load_forwards(path: str):
+    """ (in_channel, out_channel, out_msat, fee_msat, received_time) of the
+        settled forwards of a `listforwards` result, oldest first.
+    """
+    with open(path) as f:
+        forwards = json.load(f)["forwards"]
+    stream = []
+    for fw in forwards:
+        if fw.get("status") != "settled" or fw.get("out_channel") is None:
+            continue
+        # older versions only have the *_msatoshi fields
+        out_msat = int(fw.get("out_msat", fw.get("out_msatoshi", 0)))
+        fee_msat = int(fw.get("fee_msat", fw.get("fee", 0)))
+        stream.append((fw["in_channel"], fw["out_channel"], out_msat, fee_msat, float(fw["received_time"])))
+    return sorted(stream, key=lambda fw: fw[4])
+
+
+def synthetic_forwards(args):
+    """ Forwards between random pairs of our channels, `--rate` per second """
+    rpc = FakeRpc(channels=args.channels, liquidity=args.liquidity, seed=args.seed)
+    channels = list(rpc.channels.values())
+    rand = random.Random(args.seed)
+    stream = []
+    for i in range(args.events):
+        inc, out = rand.sample(channels, 2)
+        out_msat = int(int(out["total_msat"]) * rand.uniform(0, args.amount))
+        stream.append((inc["short_channel_id"], out["short_channel_id"], out_msat, None, i / args.rate))
+    return stream
+
+
+def start_plugin(args, options: dict, rpc: FakeRpc = None):
+    """ A fresh plugin instance connected to a fresh simulated node, or
+        restarted on `rpc`
+    """
+    module = importlib.reload(feeadjuster)
+    module.FORWARD_INDEX = ":memory:"
+    plugin = module.plugin
+    if rpc is None:
+        rpc = FakeRpc(channels=args.channels, liquidity=args.liquidity, latency=args.latency, seed=args.seed)
+    plugin.rpc = rpc
+    plugin.log = lambda message, level='info': args.verbose and print(f"  [{level}] {message}")
+    opts = {name: option.default for name, option in plugin.options.items()}
+    # the random sleeps would dominate every measurement
+    opts["feeadjuster-deactivate-fuzz"] = True
+    opts.update(options)
+    module.init(opts, {}, plugin)
+    return module, plugin, rpc
+
+
+def replay(args, options: dict, stream: list):
+    module, plugin, rpc = start_plugin(args, options)
+    # the initial feeadjust is not part of the benchmark
+    rpc.calls.clear()
+    rpc.updates.clear()
+    plugin.mutex = TimedLock()
+    handler = plugin.subscriptions["forward_event"]
+    latencies = []
+    settled = 0
+    start = time.time()
+    for in_scid, out_scid, out_msat, fee_msat, received_time in stream:
+        if args.speed > 0:
+            delay = start + (received_time - stream[0][4]) / args.speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        event = rpc.forward(in_scid, out_scid, out_msat, fee_msat)
+        settled += event["status"] == "settled"
+        t = time.perf_counter()
+        handler(plugin, forward_event=event)
+        latencies.append(time.perf_counter() - t)
+    # wait for the last coalescing window
+    while plugin.forwards.pending() > 0 or plugin.forwards.timer is not None or plugin.mutex.locked():
+        time.sleep(0.01)
+    return {
+        "events": len(stream),
+        "settled": settled,
+        "time": time.time() - start,
+        "latencies": latencies,
+        "held": plugin.mutex.held,
+        "queued": plugin.limiter.stats()["queue_depth"],
+    }, rpc
+
+
+def print_result(name: str, stats: dict, rpc: FakeRpc, verbose: bool = False):
+    ms = 1000
+    per_event = sum(rpc.calls.values()) / stats["events"] if stats["events"] else 0
+    print(f"{name:<40} {stats['settled']:>7} {rpc.calls['setchannel']:>10} {per_event:>9.3f} "
+          f"{percentile(stats['latencies'], 50) * ms:>8.3f} {percentile(stats['latencies'], 99) * ms:>8.3f} "
+          f"{len(stats['held']):>6} {percentile(stats['held'], 50) * ms:>8.3f} {max(stats['held'], default=0) * ms:>8.3f} "
+          f"{stats['time']:>8.2f}s")
+    if verbose:
+        print(f"  rpc calls: {dict(rpc.calls)}  still queued: {stats['queued']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--forwards", help="listforwards JSON to replay instead of a synthetic stream")
+    parser.add_argument("--methods", nargs="+", default=["default", "soft", "hard"],
+                        help="feeadjuster-adjustment-method values to compare")
+    parser.add_argument("--strategies", nargs="+", default=["global", "median", "revenue"],
+                        help="feeadjuster-feestrategy values to compare")
+    parser.add_argument("--option", action="append", default=[],
+                        help="plugin option name=value[,value...], values are swept")
+    parser.add_argument("--events", type=int, default=1000, help="synthetic forwards")
+    parser.add_argument("--rate", type=float, default=10, help="synthetic forwards per second")
+    parser.add_argument("--amount", type=float, default=0.05, help="maximum share of a channel per synthetic forward")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="replay speed relative to the stream's timestamps, 0 replays as fast as possible")
+    parser.add_argument("--channels", type=int, default=20, help="our channels, recorded streams open more")
+    parser.add_argument("--liquidity", type=float, default=None,
+                        help="our share of each channel's capacity, random by default")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per setchannel call")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    stream = load_forwards(args.forwards) if args.forwards else synthetic_forwards(args)
+    sweeps = []
+    for option in args.option:
+        name, values = option.split("=", 1)
+        # flag options are swept as true,false
+        flags = {"true": True, "false": False}
+        sweeps.append([(name, flags.get(v, v)) for v in values.split(",")])
+
+    print(f"{'benchmark':<40} {'settled':>7} {'setchannel':>10} {'rpc/event':>9} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'locks':>6} {'held ms':>8} {'max ms':>8} {'time':>9}")
+    for combination in itertools.product(*sweeps):
+        for method, strategy in itertools.product(args.methods, args.strategies):
+            options = dict(combination, **{"feeadjuster-adjustment-method": method,
+                                           "feeadjuster-feestrategy": strategy})
+            name = " ".join([method, strategy] + [f"{n.replace('feeadjuster-', '')}={v}" for n, v in combination])
+            stats, rpc = replay(args, options, stream)
+            print_result(name, stats, rpc, args.verbose)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+class ChannelSnapshot(object):
+    """ One `listpeerchannels` result, indexed by scid and by peer_id.
+
+    Built once per refresh, so looking up a channel, its peer or its fees
+    doesn't scan all our channels again.
+    """
+    def __init__(self, channels: list):
+        self.channels = channels
+        self.by_scid = {}
+        self.by_peer = {}
+        for ch in channels:
+            self.by_peer.setdefault(ch["peer_id"], []).append(ch)
+            # channels that are not yet confirmed have no scid
+            if ch.get("short_channel_id") is not None:
+                self.by_scid[ch["short_channel_id"]] = ch
+
+    def __len__(self):
+        return len(self.channels)
+
+    def __iter__(self):
+        return iter(self.channels)
+
+    def __contains__(self, scid: str):
+        return scid in self.by_scid
+
+    def get(self, scid: str):
+        return self.by_scid.get(scid)
+
+    def peer_id(self, scid: str):
+        ch = self.by_scid.get(scid)
+        return ch["peer_id"] if ch is not None else None
+
+    def peer_channels(self, peer_id: str):
+        return self.by_peer.get(peer_id, [])
+
+    def fees(self, scid: str):
+        ch = self.by_scid.get(scid)
+        if ch is None:
+            return None
+        return {"base": ch["fee_base_msat"], "ppm": ch["fee_proportional_millionths"]}
+
+    def balance(self, scid: str):
+        """ Our and the total amount of a channel in msat """
+        ch = self.by_scid.get(scid)
+        if ch is None:
+            return None
+        return {"our": int(ch["to_us_msat"]), "total": int(ch["total_msat"])}
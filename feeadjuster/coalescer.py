@@ -0,0 +1,44 @@
+import threading
+
+
+class Coalescer(object):
+    """ Merges keys added within `window` seconds into one `flush(keys)` call.
+
+    The first key of a batch starts the timer, keys added until it fires
+    join the batch. Keys added while a batch is flushed go into the next
+    one. With a window of 0 every add is flushed right away in the calling
+    thread.
+    """
+    def __init__(self, window: float, flush):
+        self.window = window
+        self.flush = flush
+        self.lock = threading.Lock()
+        self.keys = set()
+        self.timer = None
+        self.added = 0      # keys added, including duplicates
+        self.flushes = 0
+
+    def add(self, keys):
+        with self.lock:
+            self.added += len(keys)
+            self.keys.update(keys)
+            if self.window > 0 and self.timer is None:
+                self.timer = threading.Timer(self.window, self._fire)
+                self.timer.daemon = True
+                self.timer.start()
+        if self.window <= 0:
+            self._fire()
+
+    def pending(self):
+        with self.lock:
+            return len(self.keys)
+
+    def _fire(self):
+        with self.lock:
+            keys = self.keys
+            self.keys = set()
+            self.timer = None
+        if len(keys) == 0:
+            return
+        self.flushes += 1
+        self.flush(keys)
@@ -0,0 +1,180 @@
+import collections
+import hashlib
+import json
+import random
+import threading
+import time
+from pyln.client import Millisatoshi, RpcError
+
+
+class FakeRpc(object):
+    """ Simulated lightningd RPC for offline benchmarks of the plugin.
+
+    Serves our channels with known balances and fees, and the gossip of the
+    other channels of each peer, through the calls the plugin uses
+    (`listpeerchannels`, `listchannels`, `setchannel`, `listconfigs`, ...).
+    `forward` moves the liquidity of a forward between two of our channels
+    and returns its `forward_event` notification, `listforwards` lists them
+    afterwards. Channels a recorded stream refers to are opened on first
+    use. `setchannel` takes `latency` seconds, like a round trip to
+    lightningd. Every call is counted in `calls`, the `setchannel`
+    arguments are kept in `updates`.
+    """
+    def __init__(self, channels: int = 20, peer_channels: int = 5, capacity=(10**9, 10**10),
+                 liquidity: float = None, latency: float = 0.0, fee_base: int = 1000, fee_ppm: int = 10,
+                 seed: int = 1):
+        self.rand = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.updates = []
+        self.capacity = capacity
+        self.liquidity = liquidity
+        self.latency = latency
+        self.peer_channels = peer_channels
+        self.fee_base = fee_base
+        self.fee_ppm = fee_ppm
+        self.me = "02" + "00" * 32
+        self.channels = {}   # scid -> listpeerchannels entry
+        self.gossip = []     # listchannels entries of the peers' other channels
+        self.datastore_ = {}
+        self.forwards = []
+        for i in range(channels):
+            self.open(f"{100 + i}x1x0")
+
+    def open(self, scid: str):
+        """ A new channel with a new peer, if it doesn't exist yet """
+        with self.lock:
+            if scid in self.channels:
+                return self.channels[scid]
+            peer = "03" + "%064x" % self.rand.getrandbits(256)
+            total = self.rand.randint(*self.capacity)
+            share = self.rand.random() if self.liquidity is None else self.liquidity
+            self.channels[scid] = {
+                "short_channel_id": scid,
+                "channel_id": "%064x" % self.rand.getrandbits(256),
+                "peer_id": peer,
+                "state": "CHANNELD_NORMAL",
+                "to_us_msat": Millisatoshi(int(total * share)),
+                "total_msat": Millisatoshi(total),
+                "fee_base_msat": Millisatoshi(self.fee_base),
+                "fee_proportional_millionths": self.fee_ppm,
+                "maximum_htlc_out_msat": Millisatoshi(total),
+            }
+            for i in range(self.peer_channels):
+                self.gossip.append({
+                    "source": "04" + "%064x" % self.rand.getrandbits(256),
+                    "destination": peer,
+                    "short_channel_id": f"{scid.split('x')[0]}x{i + 2}x0",
+                    "base_fee_millisatoshi": self.rand.choice([0, 1000]),
+                    "fee_per_millionth": self.rand.randint(1, 2000),
+                })
+            return self.channels[scid]
+
+    def forward(self, in_scid: str, out_scid: str, out_msat: int, fee_msat: int = None):
+        """ Settles a forward if the outgoing channel has the liquidity, its
+            notification has status "failed" otherwise.
+        """
+        inc = self.open(in_scid)
+        out = self.open(out_scid)
+        if fee_msat is None:
+            fee_msat = int(out["fee_base_msat"]) + out_msat * out["fee_proportional_millionths"] // 10**6
+        in_msat = out_msat + fee_msat
+        with self.lock:
+            settled = int(out["to_us_msat"]) >= out_msat \
+                and int(inc["total_msat"]) - int(inc["to_us_msat"]) >= in_msat
+            if settled:
+                out["to_us_msat"] = Millisatoshi(int(out["to_us_msat"]) - out_msat)
+                inc["to_us_msat"] = Millisatoshi(int(inc["to_us_msat"]) + in_msat)
+            now = time.time()
+            forward = {
+                "in_channel": in_scid,
+                "in_htlc_id": len(self.forwards),
+                "payment_hash": hashlib.sha256(str(len(self.forwards)).encode()).hexdigest(),
+                "out_channel": out_scid,
+                "in_msat": Millisatoshi(in_msat),
+                "out_msat": Millisatoshi(out_msat),
+                "fee_msat": Millisatoshi(fee_msat),
+                "status": "settled" if settled else "failed",
+                "received_time": now,
+                "resolved_time": now,
+                "created_index": len(self.forwards) + 1,
+                "updated_index": len(self.forwards) + 1,
+            }
+            self.forwards.append(forward)
+        return dict(forward)
+
+    def getinfo(self):
+        self.calls["getinfo"] += 1
+        return {"id": self.me, "version": "v23.08"}
+
+    def help(self):
+        self.calls["help"] += 1
+        return {"help": [{"command": "listchannels [short_channel_id] [source] [destination]"},
+                         {"command": "setchannel id [feebase] [feeppm] [htlcmin] [htlcmax] [enforcedelay]"}]}
+
+    def listconfigs(self, config: str = None):
+        self.calls["listconfigs"] += 1
+        values = {"fee-base": self.fee_base, "fee-per-satoshi": self.fee_ppm}
+        return {"configs": {config: {"value_int": values[config]}} if config in values else {}}
+
+    def listpeerchannels(self, peer_id: str = None):
+        self.calls["listpeerchannels"] += 1
+        with self.lock:
+            return {"channels": [dict(ch) for ch in self.channels.values()
+                                 if peer_id is None or ch["peer_id"] == peer_id]}
+
+    def listchannels(self, short_channel_id: str = None, source: str = None, destination: str = None):
+        self.calls["listchannels"] += 1
+        with self.lock:
+            return {"channels": [dict(ch) for ch in self.gossip
+                                 if (short_channel_id is None or ch["short_channel_id"] == short_channel_id)
+                                 and (source is None or ch["source"] == source)
+                                 and (destination is None or ch["destination"] == destination)]}
+
+    def setchannel(self, id: str, feebase=None, feeppm=None, htlcmin=None, htlcmax=None):
+        self.calls["setchannel"] += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self.lock:
+            ch = self.channels.get(id)
+            if ch is None:
+                raise RpcError("setchannel", {"id": id}, {"message": "Could not find any active channels"})
+            if feebase is not None:
+                ch["fee_base_msat"] = Millisatoshi(int(feebase))
+            if feeppm is not None:
+                ch["fee_proportional_millionths"] = int(feeppm)
+            if htlcmax is not None:
+                ch["maximum_htlc_out_msat"] = Millisatoshi(int(htlcmax))
+            self.updates.append((id, feebase, feeppm, htlcmax))
+        return {"channels": [{"short_channel_id": id}]}
+
+    def listforwards(self, index: str = None, start: int = 0, limit: int = None):
+        self.calls["listforwards"] += 1
+        with self.lock:
+            forwards = [dict(fw) for fw in self.forwards if index is None or fw[f"{index}_index"] >= start]
+        return {"forwards": forwards[:limit]}
+
+    def datastore(self, key, string=None, mode="must-create"):
+        self.calls["datastore"] += 1
+        self.datastore_[json.dumps(key)] = string
+        return {"key": key, "string": string}
+
+    def listdatastore(self, key=None):
+        """ The entry of `key` or its immediate children """
+        self.calls["listdatastore"] += 1
+        key = [key] if isinstance(key, str) else list(key or [])
+        entries = []
+        for k, string in self.datastore_.items():
+            k = json.loads(k)
+            if k == key or (k[:len(key)] == key and len(k) == len(key) + 1):
+                entries.append({"key": k, "string": string})
+        return {"datastore": entries}
+
+    def deldatastore(self, key):
+        self.calls["deldatastore"] += 1
+        if json.dumps(key) not in self.datastore_:
+            raise RpcError("deldatastore", {"key": key}, {"message": "Key does not exist"})
+        return {"key": key, "string": self.datastore_.pop(json.dumps(key))}
+
+    def call(self, method: str, payload: dict = None):
+        return getattr(self, method)(**(payload or {}))
@@ -1,21 +1,46 @@
 #!/usr/bin/env python3
+import json
 import random
-import statistics
 import time
 import math
+import feecurves
+from concurrent.futures import ThreadPoolExecutor
+from balanceledger import BalanceLedger
+from channelsnapshot import ChannelSnapshot
+from coalescer import Coalescer
+from feeindex import FeeIndex
+from forwardindex import ForwardIndex
+from ratelimiter import UpdateLimiter
 from clnutils import cln_parse_rpcversion
 from pyln.client import Plugin, Millisatoshi, RpcError
-from threading import Lock
+from threading import Lock, Timer
 
 
 plugin = Plugin()
 # Our amount and the total amount in each of our channel, indexed by scid
 plugin.adj_balances = {}
+# Last applied liquidity, fees and max_htlc per scid, kept in the datastore
+plugin.adj_state = {}
 # Cache to avoid loads of RPC calls
 plugin.our_node_id = None
-plugin.peerchannels = None
-plugin.channels = None
+plugin.snapshot = ChannelSnapshot([])
+# Channel balances kept up to date from notifications
+plugin.ledger = BalanceLedger()
+# Sorted gossip fees per destination for the median strategy
+plugin.fee_index = FeeIndex()
 plugin.excludelist = None
+# Channels of settled forwards waiting for a fee adjustment, set up in init
+plugin.forwards = None
+# Pool for concurrent setchannel calls, set up in init
+plugin.executor = None
+# Plans of at least this many channels are evaluated with numpy, if available
+plugin.batch_min = 32
+# Our forward history for the revenue strategy, set up in init
+plugin.forward_index = None
+FORWARD_INDEX = "feeadjuster-forwards.sqlite3"
+# Defers and merges updates of the forward path, set up in init
+plugin.limiter = UpdateLimiter()
+plugin.limiter_timer = None
 # Users can configure this
 plugin.update_threshold = 0.05
 # forward_event must wait for init
@@ -31,7 +56,8 @@ def read_excludelist():
     except FileNotFoundError:
         exclude_list = []
         print("There is no feeadjuster-exclude.list given, applying the options to the channels with all peers.")
-    return exclude_list
+    # looked up for every adjusted channel
+    return set(exclude_list)
 
 
 def get_adjusted_percentage(plugin: Plugin, scid: str):
@@ -93,6 +119,14 @@ def get_peerchannels(plugin: Plugin):
     return channels
 
 
+def refresh_snapshot(plugin: Plugin):
+    """ Indexes a fresh `listpeerchannels`, lookups below use the snapshot.
+        The balance ledger is reconciled against it.
+    """
+    plugin.snapshot = ChannelSnapshot(get_peerchannels(plugin))
+    plugin.ledger.reconcile(plugin.snapshot)
+
+
 def get_config(plugin: Plugin, config: str):
     """ Helper to reconstruct `listconfigs` for older CLN versions """
     # versions >=23.08 return a configs object and value_* fields
@@ -118,64 +152,139 @@ def get_config(plugin: Plugin, config: str):
     return result[config]
 
 
-def get_peer_id_for_scid(plugin: Plugin, scid: str):
-    for ch in plugin.peerchannels:
-        if ch.get('short_channel_id') == scid:
-            return ch['peer_id']
-    return None
-
-
-def get_peerchannel(plugin: Plugin, scid: str):
-    for ch in plugin.peerchannels:
-        if ch.get("short_channel_id") == scid:
-            return ch
-    return None
-
+def get_fees_global(plugin: Plugin, scid: str):
+    return {"base": plugin.adj_basefee, "ppm": plugin.adj_ppmfee}
 
-def get_chan_fees(plugin: Plugin, scid: str):
-    channel = get_peerchannel(plugin, scid)
-    assert channel is not None
-    return {"base": channel["fee_base_msat"], "ppm": channel["fee_proportional_millionths"]}
 
+def get_fees_revenue(plugin: Plugin, scid: str):
+    """ Global fees scaled by the channel's own forward history.
 
-def get_fees_global(plugin: Plugin, scid: str):
-    return {"base": plugin.adj_basefee, "ppm": plugin.adj_ppmfee}
+    The outgoing flow of the last `feeadjuster-revenue-window` is compared
+    to the channel's average of seven windows: more demand raises the fees,
+    less demand lowers them unless the channel still earns its usual fees,
+    and a channel that didn't forward at all gets half the fees to attract
+    flow. Failed forwards out of the channel mean demand beyond its
+    liquidity and raise the fees further.
+    """
+    recent = plugin.forward_index.window(scid, plugin.revenue_window)
+    history = plugin.forward_index.window(scid, plugin.revenue_window * 7)
+    if history["out_msat"] == 0:
+        factor = 0.5
+    else:
+        factor = min(max(recent["out_msat"] * 7 / history["out_msat"], 0.5), 2)
+        if factor < 1 and recent["fee_msat"] * 7 >= history["fee_msat"]:
+            factor = 1
+    attempts = recent["out_count"] + recent["failed"]
+    if attempts > 0:
+        factor *= 1 + recent["failed"] / attempts
+    return {"base": plugin.adj_basefee, "ppm": int(plugin.adj_ppmfee) * factor}
+
+
+def forward_msat(forward: dict, name: str):
+    # older versions only have the *_msatoshi fields, and `fee`
+    value = forward.get(f"{name}_msat", forward.get(f"{name}_msatoshi", forward.get(name, 0)))
+    return int(Millisatoshi(value))
+
+
+def index_forward(plugin: Plugin, forward: dict, commit: bool = True):
+    """ Adds a forward of a notification or `listforwards` to the forward index """
+    # in_htlc_id and the indexes are missing in older notifications, the
+    # payment hash and the time the HTLC came in are the same in both
+    received_time = float(forward.get("received_time", 0))
+    key = f"{forward.get('in_channel')}/{forward.get('payment_hash')}/{received_time:.3f}"
+    resolved_time = float(forward.get("resolved_time", received_time or time.time()))
+    plugin.forward_index.add(key, forward.get("status"), forward.get("in_channel"), forward.get("out_channel"),
+                             forward_msat(forward, "in"), forward_msat(forward, "out"),
+                             forward_msat(forward, "fee"), resolved_time, commit)
+
+
+def catch_up_forwards(plugin: Plugin):
+    """ Adds the forwards resolved since the last run to the forward index,
+        page by page after the `updated` index it saw last.
+    """
+    index = plugin.forward_index
+    start = index.cursor("forwards")
+    while True:
+        try:
+            forwards = plugin.rpc.call("listforwards", {"index": "updated", "start": start + 1,
+                                                        "limit": 1000})["forwards"]
+        except RpcError as e:
+            # without the indexes everything is listed, known forwards are skipped
+            plugin.log(f"Full listforwards for the forward index: {e}", "debug")
+            for fwd in plugin.rpc.listforwards()["forwards"]:
+                index_forward(plugin, fwd, commit=False)
+            index.commit()
+            break
+        for fwd in forwards:
+            index_forward(plugin, fwd, commit=False)
+        last = max([start] + [fwd.get("updated_index", 0) for fwd in forwards])
+        index.set_cursor("forwards", last)
+        if len(forwards) < 1000 or last == start:
+            break
+        start = last
+    index.prune()
+
+
+def refresh_fee_index(plugin: Plugin, force: bool = False):
+    """ Reloads the gossip fees of the median strategy when they are older
+        than `feeadjuster-gossip-refresh`, or always with `force`.
+    """
+    if plugin.fee_strategy != get_fees_median:
+        return
+    if force:
+        plugin.fee_index.expire()
+    # with listchannels by `destination` each peer is loaded when it's needed
+    if not plugin.listchannels_by_dst and plugin.fee_index.age() >= plugin.gossip_refresh:
+        plugin.fee_index.load(plugin.rpc.listchannels()['channels'])
 
 
 def get_fees_median(plugin: Plugin, scid: str):
     """ Median fees from peers or peer.
 
     The assumption is that our node competes in fees to other peers of a peer.
+    Other percentiles than the median can be set by `feeadjuster-percentile`.
     """
-    peer_id = get_peer_id_for_scid(plugin, scid)
+    peer_id = plugin.snapshot.peer_id(scid)
     assert peer_id is not None
-    if plugin.listchannels_by_dst:
-        plugin.channels = plugin.rpc.call("listchannels",
-                                          {"destination": peer_id})['channels']
-    channels_to_peer = [ch for ch in plugin.channels
-                        if ch['destination'] == peer_id
-                        and ch['source'] != plugin.our_node_id]
-    if len(channels_to_peer) == 0:
+    if plugin.listchannels_by_dst and plugin.fee_index.age(peer_id) >= plugin.gossip_refresh:
+        plugin.fee_index.load_destination(peer_id, plugin.rpc.call("listchannels",
+                                                                   {"destination": peer_id})['channels'])
+    if plugin.fee_index.count(peer_id) == 0:
         return None
     # fees > ~5000 (base and ppm) are currently about top 2% of network fee extremists
-    fees_ppm = [ch['fee_per_millionth'] for ch in channels_to_peer if 0 < ch['fee_per_millionth'] < 5000]
-    fees_base = [ch['base_fee_millisatoshi'] for ch in channels_to_peer if 0 < ch['base_fee_millisatoshi'] < 5000]
+    fee_ppm = plugin.fee_index.percentile(peer_id, "ppm", plugin.fee_percentile)
+    fee_base = plugin.fee_index.percentile(peer_id, "base", plugin.fee_percentile)
+
+    # without fees in range use default values
+    if fee_ppm is None:
+        fee_ppm = int(plugin.adj_ppmfee / plugin.median_multiplier)
+    if fee_base is None:
+        fee_base = int(plugin.adj_basefee / plugin.median_multiplier)
+    return {"base": fee_base * plugin.median_multiplier,
+            "ppm": fee_ppm * plugin.median_multiplier}
 
-    # if lists are emtpy use default values, otherwise statistics.median will fail.
-    if len(fees_ppm) == 0:
-        fees_ppm = [int(plugin.adj_ppmfee / plugin.median_multiplier)]
-    if len(fees_base) == 0:
-        fees_base = [int(plugin.adj_basefee / plugin.median_multiplier)]
-    return {"base": statistics.median(fees_base) * plugin.median_multiplier,
-            "ppm": statistics.median(fees_ppm) * plugin.median_multiplier}
+
+def fees_changed(plugin: Plugin, scid: str, base: int, ppm: int, max_htlc: int = None):
+    fees = plugin.snapshot.fees(scid)
+    if fees is None:
+        return False
+    if base != fees['base'] or ppm != fees['ppm']:
+        return True
+    current = plugin.snapshot.get(scid).get("maximum_htlc_out_msat")
+    return max_htlc is not None and current is not None and int(current) != max_htlc
 
 
 def setchannelfee(plugin: Plugin, scid: str, base: int, ppm: int, min_htlc: int = None, max_htlc: int = None):
-    fees = get_chan_fees(plugin, scid)
-    if fees is None or base == fees['base'] and ppm == fees['ppm']:
+    if not fees_changed(plugin, scid, base, ppm, max_htlc):
         return False
     try:
         plugin.rpc.setchannel(scid, base, ppm, min_htlc, max_htlc)
+        # keep the snapshot current until the next refresh
+        channel = plugin.snapshot.get(scid)
+        channel["fee_base_msat"] = base
+        channel["fee_proportional_millionths"] = ppm
+        if max_htlc is not None:
+            channel["maximum_htlc_out_msat"] = max_htlc
         return True
     except RpcError as e:
         plugin.log(f"Could not adjust fees for channel {scid}: '{e}'", level="error")
@@ -202,134 +311,319 @@ def significant_update(plugin: Plugin, scid: str):
     return False
 
 
-def maybe_adjust_fees(plugin: Plugin, scids: list):
-    channels_adjusted = 0
-    for scid in scids:
-        if scid in plugin.exclude_list or get_peer_id_for_scid(plugin, scid) in plugin.exclude_list:
+def plan_channel(plugin: Plugin, scid: str, curve: tuple = None):
+    """ The fee update of one channel, None if it stays as it is.
+        `curve` is the ratio and max_htlc of a batch evaluation, without
+        it they are computed here.
+    """
+    if scid in plugin.exclude_list or plugin.snapshot.peer_id(scid) in plugin.exclude_list:
+        return None
+    our = plugin.adj_balances[scid]["our"]
+    total = plugin.adj_balances[scid]["total"]
+    percentage = our / total
+    base = int(plugin.adj_basefee)
+    ppm = int(plugin.adj_ppmfee)
+
+    # select ideal values per channel
+    fees = plugin.fee_strategy(plugin, scid)
+    if fees is not None:
+        ppm = int(fees['ppm'])
+        if plugin.basefee:
+            base = int(fees['base'])
+
+    # reset to normal fees if imbalance is not high enough
+    if (percentage > plugin.imbalance and percentage < 1 - plugin.imbalance):
+        update = {"scid": scid, "reason": "default", "base": base, "ppm": ppm, "max_htlc": None}
+    else:
+        if not significant_update(plugin, scid):
+            return None
+        if curve is not None:
+            ratio, max_htlc = curve
+        else:
+            percentage = get_adjusted_percentage(plugin, scid)
+            assert 0 <= percentage and percentage <= 1
+            ratio = plugin.get_ratio(percentage)
+            if plugin.max_htlc_steps >= 1:
+                max_htlc = int(total * math.ceil(plugin.max_htlc_steps * percentage) / plugin.max_htlc_steps)
+            else:
+                max_htlc = None
+        update = {"scid": scid, "reason": "adjusted", "ratio": ratio,
+                  "base": base, "ppm": int(ppm * ratio), "max_htlc": max_htlc}
+    if not fees_changed(plugin, scid, update["base"], update["ppm"], update["max_htlc"]):
+        return None
+    current = plugin.snapshot.fees(scid)
+    update["current_base"] = int(current["base"])
+    update["current_ppm"] = int(current["ppm"])
+    update["our"] = our
+    return update
+
+
+def batch_curves(plugin: Plugin, scids: list):
+    """ Ratio and max_htlc of all `scids` in one numpy pass, indexed by scid """
+    our = [plugin.adj_balances[scid]["our"] for scid in scids]
+    total = [plugin.adj_balances[scid]["total"] for scid in scids]
+    curves = feecurves.evaluate(our, total, plugin.get_ratio,
+                                big_enough_liquidity=int(plugin.big_enough_liquidity),
+                                max_htlc_steps=plugin.max_htlc_steps)
+    assert ((0 <= curves["percentage"]) & (curves["percentage"] <= 1)).all()
+    ratios = curves["ratio"].tolist()
+    if curves["max_htlc"] is None:
+        return {scid: (ratio, None) for scid, ratio in zip(scids, ratios)}
+    return {scid: (ratio, max_htlc) for scid, ratio, max_htlc in zip(scids, ratios, curves["max_htlc"].tolist())}
+
+
+def plan_fees(plugin: Plugin, scids: list):
+    """ Target fees and max_htlc of the channels that need a change """
+    curves = {}
+    if feecurves.available() and len(scids) >= plugin.batch_min:
+        curves = batch_curves(plugin, scids)
+    return [u for u in (plan_channel(plugin, scid, curves.get(scid)) for scid in scids) if u is not None]
+
+
+def apply_update(plugin: Plugin, update: dict):
+    scid = update["scid"]
+    if not setchannelfee(plugin, scid, update["base"], update["ppm"], None, update["max_htlc"]):
+        return False
+    if update["reason"] == "default":
+        plugin.log(f"Set default fees as imbalance is too low for {scid}:   ppm {update['ppm']}   base {update['base']}msat")
+    else:
+        plugin.log(f"Adjusted fees of {scid} with a ratio of {update['ratio']}:   ppm {update['ppm']}   "
+                   f"base {update['base']}msat   max_htlc {update['max_htlc']}")
+    plugin.adj_balances[scid]["last_liquidity"] = update["our"]
+    plugin.adj_state[scid] = {
+        "last_liquidity": update["our"],
+        "base": update["base"],
+        "ppm": update["ppm"],
+        "max_htlc": update["max_htlc"],
+        "updated_at": int(time.time()),
+    }
+    return True
+
+
+def apply_plan(plugin: Plugin, updates: list, limit: bool = False):
+    """ Runs the `setchannel` calls of a plan, at most
+        `feeadjuster-parallel` at once. Returns the number of changed channels.
+
+        With `limit` the updates go through the rate limiter first, those
+        without tokens are applied later by `flush_deferred`.
+    """
+    if limit and plugin.limiter.enabled():
+        for u in updates:
+            plugin.limiter.submit(u["scid"], u)
+        updates = plugin.limiter.take_ready()
+        schedule_deferred(plugin)
+    else:
+        # applied right away, an older deferred value must not follow
+        for u in updates:
+            plugin.limiter.cancel(u["scid"])
+    if len(updates) <= 1 or plugin.executor is None:
+        applied = [apply_update(plugin, u) for u in updates]
+    else:
+        applied = list(plugin.executor.map(lambda u: apply_update(plugin, u), updates))
+    changed = [u["scid"] for u, adjusted in zip(updates, applied) if adjusted]
+    save_state(plugin, changed)
+    return len(changed)
+
+
+def load_state(plugin: Plugin):
+    try:
+        data = plugin.rpc.listdatastore(["feeadjuster", "state"])["datastore"]
+    except RpcError as e:
+        plugin.log(f"Could not load adjuster state: {e}", "debug")
+        return
+    plugin.adj_state = {}
+    for entry in data:
+        scid = entry["key"][-1]
+        if "string" not in entry:
             continue
-        our = plugin.adj_balances[scid]["our"]
-        total = plugin.adj_balances[scid]["total"]
-        percentage = our / total
-        base = int(plugin.adj_basefee)
-        ppm = int(plugin.adj_ppmfee)
-
-        # select ideal values per channel
-        fees = plugin.fee_strategy(plugin, scid)
-        if fees is not None:
-            ppm = int(fees['ppm'])
-            if plugin.basefee:
-                base = int(fees['base'])
-
-        # reset to normal fees if imbalance is not high enough
-        if (percentage > plugin.imbalance and percentage < 1 - plugin.imbalance):
-            if setchannelfee(plugin, scid, base, ppm):
-                plugin.log(f"Set default fees as imbalance is too low for {scid}:   ppm {ppm}   base {base}msat")
-                plugin.adj_balances[scid]["last_liquidity"] = our
-                channels_adjusted += 1
+        if scid in plugin.snapshot:
+            plugin.adj_state[scid] = json.loads(entry["string"])
             continue
+        # closed channels are dropped
+        try:
+            plugin.rpc.deldatastore(entry["key"])
+        except RpcError as e:
+            plugin.log(f"Could not drop adjuster state of {scid}: {e}", "debug")
 
-        if not significant_update(plugin, scid):
-            continue
 
-        percentage = get_adjusted_percentage(plugin, scid)
-        assert 0 <= percentage and percentage <= 1
-        ratio = plugin.get_ratio(percentage)
-        if plugin.max_htlc_steps >= 1:
-            max_htlc = int(total * math.ceil(plugin.max_htlc_steps * percentage) / plugin.max_htlc_steps)
-        else:
-            max_htlc = None
-        if setchannelfee(plugin, scid, base, int(ppm * ratio), None, max_htlc):
-            plugin.log(f"Adjusted fees of {scid} with a ratio of {ratio}:   ppm {int(ppm * ratio)}   base {base}msat   max_htlc {max_htlc}")
-            plugin.adj_balances[scid]["last_liquidity"] = our
-            channels_adjusted += 1
-    plugin.log("maybe_adjust_fees done", "debug")
-    return channels_adjusted
+def save_state(plugin: Plugin, scids: list):
+    """ Stores the state of the changed channels, one datastore key per
+        channel, so a restart only adjusts the channels that moved since.
+    """
+    for scid in scids:
+        try:
+            plugin.rpc.datastore(["feeadjuster", "state", scid], string=json.dumps(plugin.adj_state[scid]),
+                                 mode="create-or-replace")
+        except RpcError as e:
+            plugin.log(f"Could not save adjuster state of {scid}: {e}", "debug")
 
 
-def get_new_balance(plugin: Plugin, scid: str):
-    i = 0
-    while i < 5:
-        chan = get_peerchannel(plugin, scid)
-        assert chan is not None
-        if scid not in plugin.adj_balances:
-            time.sleep(5)
-            plugin.peerchannels = get_peerchannels(plugin)
-            chan = get_peerchannel(plugin, scid)
-            plugin.adj_balances[scid] = {
-                "our": int(chan["to_us_msat"]),
-                "total": int(chan["total_msat"]),
-            }
-            return
-        elif (
-            int(chan["to_us_msat"]) != plugin.adj_balances[scid]["our"]
-            or int(chan["total_msat"]) != plugin.adj_balances[scid]["total"]
-        ):
-            plugin.adj_balances[scid]["our"] = int(chan["to_us_msat"])
-            plugin.adj_balances[scid]["total"] = int(chan["total_msat"])
-            return
-        else:
-            time.sleep(1)
-            plugin.peerchannels = get_peerchannels(plugin)
-            i += 1
+def restore_liquidity(plugin: Plugin, scid: str):
+    """ Takes over the last liquidity of the previous run, unless the fees
+        were changed by someone else meanwhile.
+    """
+    state = plugin.adj_state.get(scid)
+    if state is None or fees_changed(plugin, scid, state["base"], state["ppm"], state["max_htlc"]):
+        return
+    plugin.adj_balances[scid]["last_liquidity"] = state["last_liquidity"]
+
+
+def schedule_deferred(plugin: Plugin):
+    wait = plugin.limiter.next_ready()
+    if wait is None or plugin.limiter_timer is not None:
+        return
+    plugin.limiter_timer = Timer(wait, flush_deferred)
+    plugin.limiter_timer.daemon = True
+    plugin.limiter_timer.start()
+
+
+def flush_deferred():
+    """ Applies the deferred updates that got their tokens meanwhile """
+    plugin.mutex.acquire(blocking=True)
+    try:
+        plugin.limiter_timer = None
+        channels_adjusted = apply_plan(plugin, [], limit=True)
+        plugin.log(f"Applied {channels_adjusted} deferred update(s), "
+                   f"{plugin.limiter.stats()['queue_depth']} still queued", "debug")
+    except Exception as e:
+        plugin.log("Applying deferred updates: " + str(e), level="error")
+    finally:
+        plugin.mutex.release()
+
+
+def maybe_adjust_fees(plugin: Plugin, scids: list):
+    channels_adjusted = apply_plan(plugin, plan_fees(plugin, scids), limit=True)
+    plugin.log("maybe_adjust_fees done", "debug")
+    return channels_adjusted
 
 
 @plugin.subscribe("forward_event")
 def forward_event(plugin: Plugin, forward_event: dict, **kwargs):
+    if plugin.forward_index is not None:
+        index_forward(plugin, forward_event)
+        # the next catch-up starts after this forward
+        if "updated_index" in forward_event:
+            index = plugin.forward_index
+            index.set_cursor("forwards", max(index.cursor("forwards"), int(forward_event["updated_index"])))
+    if forward_event["status"] == "settled":
+        # older versions only have the *_msatoshi fields
+        plugin.ledger.forward(forward_event["in_channel"], forward_event["out_channel"],
+                              forward_event.get("in_msat", forward_event.get("in_msatoshi", 0)),
+                              forward_event.get("out_msat", forward_event.get("out_msatoshi", 0)))
     if not plugin.forward_event_subscription:
         return
     if forward_event["status"] == "settled":
-        plugin.mutex.acquire(blocking=True)
-        plugin.peerchannels = get_peerchannels(plugin)
-        if plugin.fee_strategy == get_fees_median and not plugin.listchannels_by_dst:
-            plugin.channels = plugin.rpc.listchannels()['channels']
-        in_scid = forward_event["in_channel"]
-        out_scid = forward_event["out_channel"]
-        get_new_balance(plugin, in_scid)
-        get_new_balance(plugin, out_scid)
+        # merged with the other forwards of the coalescing window
+        plugin.forwards.add([forward_event["in_channel"], forward_event["out_channel"]])
 
-        try:
-            # Pseudo-randomly add some hysterisis to the update
-            if not plugin.deactivate_fuzz and random.randint(0, 9) == 9:
-                time.sleep(random.randint(0, 5))
-            maybe_adjust_fees(plugin, [in_scid, out_scid])
-        except Exception as e:
-            plugin.log("Adjusting fees: " + str(e), level="error")
+
+def adjust_forwarded(scids: set):
+    """ Adjusts the channels of all forwards of one coalescing window with
+        one snapshot and one `maybe_adjust_fees` pass.
+    """
+    plugin.mutex.acquire(blocking=True)
+    try:
+        # balances come from the ledger, lightningd is asked only periodically
+        if plugin.ledger.due(plugin.reconcile_interval):
+            refresh_snapshot(plugin)
+        refresh_fee_index(plugin)
+        # channels can be closed meanwhile
+        scids = [scid for scid in scids if scid in plugin.snapshot and scid in plugin.ledger]
+        for scid in scids:
+            plugin.adj_balances.setdefault(scid, {}).update(plugin.ledger.balance(scid))
+
+        # Pseudo-randomly add some hysterisis to the update
+        if not plugin.deactivate_fuzz and random.randint(0, 9) == 9:
+            time.sleep(random.randint(0, 5))
+        maybe_adjust_fees(plugin, scids)
+    except Exception as e:
+        plugin.log("Adjusting fees: " + str(e), level="error")
+    finally:
         plugin.mutex.release()
 
 
+@plugin.subscribe("coin_movement")
+def coin_movement(plugin: Plugin, coin_movement: dict, **kwargs):
+    # forwards are booked from forward_event already
+    tags = coin_movement.get("tags") or [coin_movement.get("tag")]
+    if coin_movement.get("type") != "channel_mvt" or "routed" in tags:
+        return
+    plugin.ledger.move(coin_movement.get("account_id"),
+                       coin_movement.get("credit_msat", coin_movement.get("credit", 0)),
+                       coin_movement.get("debit_msat", coin_movement.get("debit", 0)))
+
+
+@plugin.subscribe("channel_state_changed")
+def channel_state_changed(plugin: Plugin, channel_state_changed: dict, **kwargs):
+    if channel_state_changed.get("new_state") == "CHANNELD_NORMAL":
+        plugin.ledger.stale = True
+    elif channel_state_changed.get("short_channel_id") is not None:
+        plugin.ledger.drop(channel_state_changed["short_channel_id"])
+
+
 @plugin.method("feeadjust")
-def feeadjust(plugin: Plugin, scid: str = None):
+def feeadjust(plugin: Plugin, scid: str = None, dry_run: bool = False):
     """Adjust fees for all channels (default) or just a given `scid`.
 
-    This method is automatically called in plugin init, or can be called manually after a successful payment.
+    This method is automatically called in plugin init, for the channels that moved since the last run only,
+    or can be called manually after a successful payment.
     Otherwise, the plugin keeps the fees up-to-date.
+    With `dry_run` the planned changes are returned without applying them,
+    the adjuster state stays as it is. Only the gossip fees of the median
+    strategy are reloaded if they are older than `feeadjuster-gossip-refresh`.
 
     To stop adjusting the channels for a set PeerIDs or SCIDs, place a file
     called `feeadjuster-exclude.list` in the lightningd data directory with a
     simple line-by-line list of PeerIDs (pubkeys) or SCIDs.
     """
+    return adjust_channels(plugin, scid, dry_run)
+
+
+def adjust_channels(plugin: Plugin, scid: str = None, dry_run: bool = False, warm: bool = False):
+    """ `feeadjust`, `warm` keeps the liquidity of the previous run so only
+        channels that moved past the threshold are adjusted.
+    """
     plugin.mutex.acquire(blocking=True)
-    plugin.peerchannels = get_peerchannels(plugin)
-    if plugin.fee_strategy == get_fees_median and not plugin.listchannels_by_dst:
-        plugin.channels = plugin.rpc.listchannels()['channels']
-    channels_adjusted = 0
-    plugin.exclude_list = read_excludelist()
-
-    for chan in plugin.peerchannels:
-        if scid in plugin.exclude_list or chan["peer_id"] in plugin.exclude_list:
-            continue
-        if chan["state"] == "CHANNELD_NORMAL":
-            _scid = chan.get("short_channel_id")
-            if scid is not None and scid != _scid:
+    # a dry run plans on a fresh snapshot but leaves the adjuster state as it is
+    saved_snapshot = plugin.snapshot
+    saved_balances = dict(plugin.adj_balances)
+    try:
+        if dry_run:
+            plugin.snapshot = ChannelSnapshot(get_peerchannels(plugin))
+            refresh_fee_index(plugin)
+        else:
+            refresh_snapshot(plugin)
+            if warm:
+                load_state(plugin)
+            refresh_fee_index(plugin, force=True)
+        plugin.exclude_list = read_excludelist()
+
+        scids = []
+        for chan in plugin.snapshot:
+            if scid in plugin.exclude_list or chan["peer_id"] in plugin.exclude_list:
                 continue
-            plugin.adj_balances[_scid] = {
-                "our": int(chan["to_us_msat"]),
-                "total": int(chan["total_msat"])
-            }
-            channels_adjusted += maybe_adjust_fees(plugin, [_scid])
+            if chan["state"] == "CHANNELD_NORMAL":
+                _scid = chan.get("short_channel_id")
+                if scid is not None and scid != _scid:
+                    continue
+                plugin.adj_balances[_scid] = {
+                    "our": int(chan["to_us_msat"]),
+                    "total": int(chan["total_msat"])
+                }
+                if warm:
+                    restore_liquidity(plugin, _scid)
+                scids.append(_scid)
+        updates = plan_fees(plugin, scids)
+        if dry_run:
+            return {"message": f"{len(updates)} channel(s) would be adjusted", "plan": updates}
+        channels_adjusted = apply_plan(plugin, updates)
+    finally:
+        if dry_run:
+            plugin.snapshot = saved_snapshot
+            plugin.adj_balances = saved_balances
+        plugin.mutex.release()
     msg = f"{channels_adjusted} channel(s) adjusted"
     plugin.log(msg)
-    plugin.mutex.release()
     return msg
 
 
@@ -348,6 +642,20 @@ def feeadjuster_toggle(plugin: Plugin, value: bool = None):
     return msg
 
 
+@plugin.method("feeadjuster-queue")
+def feeadjuster_queue(plugin: Plugin):
+    """Shows the fee updates deferred by the rate limiter.
+
+    `queue_depth` updates are waiting, `deferred` updates had to wait so far
+    and `merged` of them were replaced by a newer value before being sent.
+    """
+    msg = plugin.limiter.stats()
+    with plugin.limiter.lock:
+        msg["queue"] = list(plugin.limiter.pending.values())
+    msg["next_in"] = plugin.limiter.next_ready()
+    return msg
+
+
 @plugin.init()
 def init(options: dict, configuration: dict, plugin: Plugin, **kwargs):
     # do all the stuff that needs to be done just once ...
@@ -362,6 +670,15 @@ def init(options: dict, configuration: dict, plugin: Plugin, **kwargs):
     plugin.imbalance = float(options.get("feeadjuster-imbalance"))
     plugin.max_htlc_steps = int(options.get("feeadjuster-max-htlc-steps"))
     plugin.basefee = bool(options.get("feeadjuster-basefee"))
+    plugin.forwards = Coalescer(float(options.get("feeadjuster-coalesce-window")), adjust_forwarded)
+    plugin.reconcile_interval = float(options.get("feeadjuster-reconcile-interval"))
+    plugin.parallel = int(options.get("feeadjuster-parallel"))
+    if plugin.parallel > 1:
+        plugin.executor = ThreadPoolExecutor(max_workers=plugin.parallel)
+    # updates per minute overall and per hour for each channel
+    rate = float(options.get("feeadjuster-ratelimit"))
+    channel_rate = float(options.get("feeadjuster-ratelimit-channel"))
+    plugin.limiter = UpdateLimiter(rate / 60, max(rate, 1), channel_rate / 3600, max(channel_rate, 1))
     adjustment_switch = {
         "soft": get_ratio_soft,
         "hard": get_ratio_hard,
@@ -370,10 +687,18 @@ def init(options: dict, configuration: dict, plugin: Plugin, **kwargs):
     plugin.get_ratio = adjustment_switch.get(options.get("feeadjuster-adjustment-method"), get_ratio)
     fee_strategy_switch = {
         "global": get_fees_global,
-        "median": get_fees_median
+        "median": get_fees_median,
+        "revenue": get_fees_revenue
     }
     plugin.fee_strategy = fee_strategy_switch.get(options.get("feeadjuster-feestrategy"), get_fees_global)
+    plugin.revenue_window = float(options.get("feeadjuster-revenue-window"))
+    if plugin.fee_strategy == get_fees_revenue:
+        plugin.forward_index = ForwardIndex(FORWARD_INDEX, keep=max(30 * 24 * 3600, 8 * plugin.revenue_window))
+        catch_up_forwards(plugin)
     plugin.median_multiplier = float(options.get("feeadjuster-median-multiplier"))
+    plugin.fee_percentile = float(options.get("feeadjuster-percentile"))
+    plugin.gossip_refresh = float(options.get("feeadjuster-gossip-refresh"))
+    plugin.fee_index.exclude_source = plugin.our_node_id
     plugin.adj_basefee = get_config(plugin, "fee-base")
     if plugin.adj_basefee is None:
         plugin.adj_basefee = 1000
@@ -387,6 +712,9 @@ def init(options: dict, configuration: dict, plugin: Plugin, **kwargs):
     if plugin.imbalance > 0.5:
         plugin.imbalance = 1 - plugin.imbalance
 
+    if plugin.fee_percentile < 0 or plugin.fee_percentile > 100:
+        raise ValueError("feeadjuster-percentile must be between 0 and 100.")
+
     # detect if server supports the new listchannels by `destination` (#4614)
     plugin.listchannels_by_dst = False
     rpchelp = plugin.rpc.help().get('help')
@@ -411,9 +739,16 @@ def init(options: dict, configuration: dict, plugin: Plugin, **kwargs):
                f"fee_strategy: {plugin.fee_strategy.__name__}, "
                f"listchannels_by_dst: {plugin.listchannels_by_dst},"
                f"max_htlc_steps: {plugin.max_htlc_steps},"
-               f"basefee: {plugin.basefee}")
+               f"basefee: {plugin.basefee}, "
+               f"coalesce_window: {plugin.forwards.window}, "
+               f"reconcile_interval: {plugin.reconcile_interval}, "
+               f"percentile: {plugin.fee_percentile}, "
+               f"gossip_refresh: {plugin.gossip_refresh}, "
+               f"revenue_window: {plugin.revenue_window}, "
+               f"parallel: {plugin.parallel}, "
+               f"ratelimit: {rate}/min, {channel_rate}/h per channel")
     plugin.mutex.release()
-    feeadjust(plugin)
+    adjust_channels(plugin, warm=True)
 
 
 plugin.add_option(
@@ -471,7 +806,8 @@ plugin.add_option(
     "global",
     "Sets the per channel fee selection strategy. "
     "Can be 'global' to use global config or default values, "
-    "or 'median' to use the median fees from peers of peer "
+    "'median' to use the median fees from peers of peer "
+    "or 'revenue' to scale the global fees by the channel's own forward history. "
     "Default: 'global'.",
     "string"
 )
@@ -483,6 +819,20 @@ plugin.add_option(
     "Default: '1.0'.",
     "string"
 )
+plugin.add_option(
+    "feeadjuster-percentile",
+    "50",
+    "Sets the percentile of the peers' fees used by the fee strategy 'median'. "
+    "Default: '50' (the median).",
+    "string"
+)
+plugin.add_option(
+    "feeadjuster-gossip-refresh",
+    "600",
+    "Seconds the gossip fees of the fee strategy 'median' are cached between forwards. "
+    "feeadjust always reloads them.",
+    "string"
+)
 plugin.add_option(
     "feeadjuster-max-htlc-steps",
     "0",
@@ -498,4 +848,46 @@ plugin.add_option(
     "Also adjust base fee dynamically. Currently only affects median strategy.",
     "bool"
 )
-plugin.run()
+plugin.add_option(
+    "feeadjuster-coalesce-window",
+    "1",
+    "Seconds in which forward events are collected and their channels adjusted at once. "
+    "0 handles every forward on its own.",
+    "string"
+)
+plugin.add_option(
+    "feeadjuster-parallel",
+    "8",
+    "Maximum number of concurrent setchannel calls when many channels are adjusted at once. "
+    "1 adjusts one channel after the other.",
+    "string"
+)
+plugin.add_option(
+    "feeadjuster-ratelimit",
+    "0",
+    "Maximum number of channel updates per minute caused by forwards, over all channels. "
+    "Updates beyond it are deferred and merged. 0 disables the limit.",
+    "string"
+)
+plugin.add_option(
+    "feeadjuster-ratelimit-channel",
+    "0",
+    "Maximum number of updates per hour of a single channel caused by forwards. "
+    "Updates beyond it are deferred and merged. 0 disables the limit.",
+    "string"
+)
+plugin.add_option(
+    "feeadjuster-revenue-window",
+    "86400",
+    "Seconds of forward history the fee strategy 'revenue' compares to the average of seven such windows.",
+    "string"
+)
+plugin.add_option(
+    "feeadjuster-reconcile-interval",
+    "300",
+    "Seconds after which the balances tracked from notifications are checked against listpeerchannels.",
+    "string"
+)
+
+if __name__ == "__main__":
+    plugin.run()
@@ -0,0 +1,44 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def available():
+    """ Batch evaluation needs numpy, without it the plugin evaluates channel by channel """
+    return np is not None
+
+
+def adjusted_percentages(our, total, big_enough_liquidity: int = 0):
+    """ `get_adjusted_percentage` for arrays of our and total amounts in msat """
+    our = np.asarray(our, dtype=np.float64)
+    total = np.asarray(total, dtype=np.float64)
+    if big_enough_liquidity == 0:
+        return our / total
+    min_liquidity = np.minimum(total / 2, big_enough_liquidity)
+    theirs = total - our
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where((our >= min_liquidity) & (theirs >= min_liquidity), 0.5,
+                        np.where(our < min_liquidity,
+                                 our / min_liquidity / 2,
+                                 (min_liquidity - theirs) / min_liquidity / 2 + 0.5))
+
+
+def evaluate(our, total, get_ratio, ppm=None, big_enough_liquidity: int = 0, max_htlc_steps: int = 0):
+    """ Adjusted percentage, ratio, target ppm and max_htlc of many channels at once.
+
+    `get_ratio` is any curve working on arrays, like the `get_ratio*`
+    functions of the plugin. `ppm` is the fee the ratio applies to, one
+    for all or one per channel, without it there is no target ppm.
+    max_htlc is None with `max_htlc_steps` 0, like in the plugin.
+    """
+    total_arr = np.asarray(total, dtype=np.float64)
+    percentage = adjusted_percentages(our, total_arr, big_enough_liquidity)
+    ratio = np.asarray(get_ratio(percentage), dtype=np.float64)
+    result = {"percentage": percentage, "ratio": ratio, "ppm": None, "max_htlc": None}
+    if ppm is not None:
+        result["ppm"] = np.trunc(np.asarray(ppm, dtype=np.float64) * ratio).astype(np.int64)
+    if max_htlc_steps >= 1:
+        result["max_htlc"] = np.trunc(total_arr * np.ceil(max_htlc_steps * percentage)
+                                      / max_htlc_steps).astype(np.int64)
+    return result
@@ -0,0 +1,98 @@
+import bisect
+import threading
+import time
+
+
+class FeeIndex(object):
+    """ Fees of the gossip channels towards each destination, kept sorted.
+
+    Built from `listchannels` results, either all at once or one
+    destination at a time, and reloaded the same way when it gets old.
+    Median and percentile lookups then need no scan of the network.
+    Channels from `exclude_source` (our node) are left out, fees outside
+    0 < fee < `max_fee` don't count for percentiles.
+    """
+    FIELDS = {"base": "base_fee_millisatoshi", "ppm": "fee_per_millionth"}
+
+    def __init__(self, exclude_source: str = None, max_fee: int = 5000):
+        self.lock = threading.Lock()
+        self.exclude_source = exclude_source
+        self.max_fee = max_fee
+        self.entries = {}       # (scid, source) -> (destination, base, ppm)
+        self.destinations = {}  # destination -> {"keys": set(), "base": [], "ppm": []}
+        self.loaded_at = 0      # last full load
+        self.refreshed_at = {}  # destination -> last load of that destination
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        dst = self.destinations[entry[0]]
+        dst["keys"].discard(key)
+        for field, value in (("base", entry[1]), ("ppm", entry[2])):
+            if 0 < value < self.max_fee:
+                values = dst[field]
+                del values[bisect.bisect_left(values, value)]
+
+    def _insert(self, ch: dict):
+        if ch["source"] == self.exclude_source:
+            return
+        key = (ch["short_channel_id"], ch["source"])
+        self._remove(key)
+        entry = (ch["destination"], int(ch[self.FIELDS["base"]]), int(ch[self.FIELDS["ppm"]]))
+        self.entries[key] = entry
+        dst = self.destinations.setdefault(entry[0], {"keys": set(), "base": [], "ppm": []})
+        dst["keys"].add(key)
+        for field, value in (("base", entry[1]), ("ppm", entry[2])):
+            if 0 < value < self.max_fee:
+                bisect.insort(dst[field], value)
+
+    def load(self, channels: list):
+        """ Replaces the whole index with a full `listchannels` """
+        with self.lock:
+            self.entries = {}
+            self.destinations = {}
+            self.refreshed_at = {}
+            for ch in channels:
+                self._insert(ch)
+            self.loaded_at = time.time()
+
+    def load_destination(self, destination: str, channels: list):
+        """ Replaces the channels towards one destination """
+        with self.lock:
+            dst = self.destinations.get(destination)
+            for key in list(dst["keys"]) if dst is not None else []:
+                self._remove(key)
+            for ch in channels:
+                self._insert(ch)
+            self.refreshed_at[destination] = time.time()
+
+    def age(self, destination: str = None):
+        """ Seconds since the destination, or the whole index, was loaded """
+        if destination is None:
+            return time.time() - self.loaded_at
+        return time.time() - max(self.refreshed_at.get(destination, 0), self.loaded_at)
+
+    def expire(self):
+        """ Makes every destination and the full index due for a reload """
+        with self.lock:
+            self.loaded_at = 0
+            self.refreshed_at = {}
+
+    def count(self, destination: str):
+        dst = self.destinations.get(destination)
+        return len(dst["keys"]) if dst is not None else 0
+
+    def percentile(self, destination: str, field: str, percent: float):
+        """ Linearly interpolated percentile of the "base" or "ppm" fees,
+            50 is the median. None without any fees in range.
+        """
+        with self.lock:
+            dst = self.destinations.get(destination)
+            values = dst[field] if dst is not None else []
+            if len(values) == 0:
+                return None
+            pos = (len(values) - 1) * percent / 100
+            lower = int(pos)
+            upper = min(lower + 1, len(values) - 1)
+            return values[lower] + (values[upper] - values[lower]) * (pos - lower)
@@ -0,0 +1,118 @@
+import sqlite3
+import threading
+import time
+
+
+class ForwardIndex(object):
+    """ Forward history of each channel in sqlite, for window queries.
+
+    Every channel has one row per time `bucket` it forwarded in, holding
+    its totals since the start of the index: settled forwards and amount
+    out, fees earned, amount in and failed forwards out. The totals of a
+    window are the difference of two rows, found by primary key, so a
+    query costs the same no matter how many forwards there are.
+    Forwards are counted once, whether they come from a notification or
+    from a `listforwards` catch-up, whose cursor is kept in the index too.
+    History older than `keep` seconds is pruned, once per bucket as
+    forwards come in.
+    """
+    FIELDS = ("out_count", "out_msat", "fee_msat", "in_msat", "failed")
+
+    def __init__(self, path: str = ":memory:", bucket: int = 3600, keep: int = 30 * 24 * 3600):
+        self.lock = threading.Lock()
+        self.bucket = bucket
+        self.keep = keep
+        self.pruned = None  # bucket of the last prune
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # a crash loses at most the last forwards, the catch-up brings them back
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS totals (scid TEXT, bucket INTEGER, out_count INTEGER, "
+                        "out_msat INTEGER, fee_msat INTEGER, in_msat INTEGER, failed INTEGER, "
+                        "PRIMARY KEY (scid, bucket)) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY, bucket INTEGER) WITHOUT ROWID")
+        self.db.execute("CREATE INDEX IF NOT EXISTS seen_bucket ON seen (bucket)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS cursors (name TEXT PRIMARY KEY, value INTEGER)")
+        self.db.commit()
+
+    def _row(self, scid: str, bucket: int):
+        """ The totals of `scid` up to the end of `bucket` """
+        row = self.db.execute("SELECT out_count, out_msat, fee_msat, in_msat, failed FROM totals "
+                              "WHERE scid = ? AND bucket <= ? ORDER BY bucket DESC LIMIT 1",
+                              (scid, bucket)).fetchone()
+        return row if row is not None else (0, 0, 0, 0, 0)
+
+    def _add(self, scid: str, bucket: int, deltas: tuple):
+        if self.db.execute("SELECT 1 FROM totals WHERE scid = ? AND bucket = ?", (scid, bucket)).fetchone() is None:
+            self.db.execute("INSERT INTO totals VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (scid, bucket) + self._row(scid, bucket))
+        # late forwards also count for the later buckets, usually there are none
+        self.db.execute("UPDATE totals SET out_count = out_count + ?, out_msat = out_msat + ?, "
+                        "fee_msat = fee_msat + ?, in_msat = in_msat + ?, failed = failed + ? "
+                        "WHERE scid = ? AND bucket >= ?", deltas + (scid, bucket))
+
+    def add(self, key: str, status: str, in_scid: str, out_scid: str, in_msat: int, out_msat: int,
+            fee_msat: int, resolved_time: float, commit: bool = True):
+        """ Counts a resolved forward, returns False if it was counted before,
+            is still pending or is older than the history kept.
+        """
+        if status not in ("settled", "failed", "local_failed"):
+            return False
+        bucket = int(resolved_time // self.bucket)
+        with self.lock:
+            if bucket < int((time.time() - self.keep) // self.bucket):
+                return False
+            if self.db.execute("SELECT 1 FROM seen WHERE key = ?", (key,)).fetchone() is not None:
+                return False
+            self.db.execute("INSERT INTO seen VALUES (?, ?)", (key, bucket))
+            if status == "settled":
+                self._add(out_scid, bucket, (1, out_msat, fee_msat, 0, 0))
+                self._add(in_scid, bucket, (0, 0, 0, in_msat, 0))
+            elif out_scid is not None:
+                self._add(out_scid, bucket, (0, 0, 0, 0, 1))
+            if self.pruned != int(time.time() // self.bucket):
+                self._prune(time.time())
+            if commit:
+                self.db.commit()
+            return True
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def window(self, scid: str, seconds: float, now: float = None):
+        """ Totals of `scid` over the last `seconds`, in whole buckets """
+        end = int((now or time.time()) // self.bucket)
+        start = end - max(int(seconds // self.bucket), 1)
+        with self.lock:
+            new = self._row(scid, end)
+            old = self._row(scid, start)
+        return {field: n - o for field, n, o in zip(self.FIELDS, new, old)}
+
+    def cursor(self, name: str):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM cursors WHERE name = ?", (name,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def set_cursor(self, name: str, value: int):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO cursors VALUES (?, ?)", (name, value))
+            self.db.commit()
+
+    def _prune(self, now: float):
+        oldest = int((now - self.keep) // self.bucket)
+        self.db.execute("DELETE FROM totals WHERE bucket < ? AND bucket < "
+                        "(SELECT MAX(t.bucket) FROM totals t WHERE t.scid = totals.scid AND t.bucket < ?)",
+                        (oldest, oldest))
+        self.db.execute("DELETE FROM seen WHERE bucket < ?", (oldest,))
+        self.db.commit()
+        self.pruned = int(now // self.bucket)
+
+    def prune(self, now: float = None):
+        """ Drops the history before `keep`, the last row before it stays as the base of later windows """
+        with self.lock:
+            self._prune(now or time.time())
+
+    def close(self):
+        with self.lock:
+            self.db.close()
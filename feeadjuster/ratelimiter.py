@@ -0,0 +1,107 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    """ `rate` tokens per second, at most `burst` saved up """
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait(self, now: float):
+        """ Seconds until a token is available """
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class UpdateLimiter(object):
+    """ Rate limits channel updates with a global and a per-channel token bucket.
+
+    Updates that can't go out yet wait in a queue, a newer update of the
+    same channel replaces the waiting one, so only the latest value is
+    sent once tokens are available. A rate of 0 disables that bucket.
+    """
+    def __init__(self, rate: float = 0, burst: float = 1, channel_rate: float = 0, channel_burst: float = 1):
+        self.lock = threading.Lock()
+        self.bucket = TokenBucket(rate, burst) if rate > 0 else None
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.channels = {}      # key -> TokenBucket
+        self.pending = {}       # key -> latest update, oldest first
+        self.waiting = set()    # keys of pending updates counted as deferred
+        self.deferred = 0       # updates that had to wait
+        self.merged = 0         # updates replaced by a newer one before they were sent
+        self.sent = 0
+
+    def enabled(self):
+        return self.bucket is not None or self.channel_rate > 0
+
+    def _channel(self, key):
+        if self.channel_rate <= 0:
+            return None
+        if key not in self.channels:
+            self.channels[key] = TokenBucket(self.channel_rate, self.channel_burst)
+        return self.channels[key]
+
+    def submit(self, key, update):
+        with self.lock:
+            if key in self.pending:
+                self.merged += 1
+            self.pending[key] = update
+
+    def cancel(self, key):
+        """ Drops a waiting update, e.g. when it was applied another way """
+        with self.lock:
+            self.pending.pop(key, None)
+            self.waiting.discard(key)
+
+    def take_ready(self):
+        """ Pending updates that may go out now, the rest stays queued """
+        now = time.time()
+        ready = []
+        with self.lock:
+            for key in list(self.pending):
+                channel = self._channel(key)
+                if (self.bucket is None or self.bucket.wait(now) == 0) \
+                        and (channel is None or channel.wait(now) == 0):
+                    if self.bucket is not None:
+                        self.bucket.take()
+                    if channel is not None:
+                        channel.take()
+                    ready.append(self.pending.pop(key))
+                    self.waiting.discard(key)
+                    self.sent += 1
+                elif key not in self.waiting:
+                    self.waiting.add(key)
+                    self.deferred += 1
+        return ready
+
+    def next_ready(self):
+        """ Seconds until the next pending update may go out, None if none is pending """
+        now = time.time()
+        with self.lock:
+            if len(self.pending) == 0:
+                return None
+            global_wait = self.bucket.wait(now) if self.bucket is not None else 0
+            channel_wait = min(self._channel(key).wait(now) if self.channel_rate > 0 else 0
+                               for key in self.pending)
+            return max(global_wait, channel_wait)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "queue_depth": len(self.pending),
+                "deferred": self.deferred,
+                "merged": self.merged,
+                "sent": self.sent,
+            }
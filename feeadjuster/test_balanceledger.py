@@ -0,0 +1,46 @@
+from balanceledger import BalanceLedger
+from channelsnapshot import ChannelSnapshot
+
+
+def snapshot(our_a=500, our_b=500):
+    return ChannelSnapshot([
+        {"short_channel_id": "1x1x0", "channel_id": "aa", "peer_id": "02aa", "to_us_msat": our_a, "total_msat": 1000},
+        {"short_channel_id": "1x2x0", "channel_id": "bb", "peer_id": "02bb", "to_us_msat": our_b, "total_msat": 1000},
+    ])
+
+
+def test_ledger_forward_and_move():
+    ledger = BalanceLedger()
+    assert ledger.due(300)
+    ledger.reconcile(snapshot())
+    assert not ledger.due(300)
+    ledger.forward("1x1x0", "1x2x0", 101, 100)
+    assert ledger.balance("1x1x0") == {"our": 601, "total": 1000}
+    assert ledger.balance("1x2x0") == {"our": 400, "total": 1000}
+    # our own payment out of channel bb, amounts are kept within the capacity
+    ledger.move("bb", 0, 1000)
+    assert ledger.balance("1x2x0")["our"] == 0
+    assert not ledger.stale
+
+
+def test_ledger_unknown_channels():
+    ledger = BalanceLedger()
+    ledger.reconcile(snapshot())
+    ledger.forward("9x9x0", "1x2x0", 100, 100)
+    assert ledger.stale and ledger.due(300)
+    assert ledger.balance("9x9x0") is None
+    ledger.reconcile(snapshot(our_b=700))
+    assert not ledger.stale
+    assert ledger.balance("1x2x0")["our"] == 700
+    ledger.drop("1x2x0")
+    assert "1x2x0" not in ledger
+
+
+def test_ledger_string_amounts():
+    # notifications of older versions have amounts like "1000msat"
+    ledger = BalanceLedger()
+    ledger.reconcile(snapshot())
+    ledger.forward("1x1x0", "1x2x0", "101msat", "100msat")
+    ledger.move("aa", "0msat", "1msat")
+    assert ledger.balance("1x1x0")["our"] == 600
+    assert ledger.balance("1x2x0")["our"] == 400
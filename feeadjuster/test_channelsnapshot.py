@@ -0,0 +1,21 @@
+from channelsnapshot import ChannelSnapshot
+
+
+def channel(scid, peer_id, our=1000, total=2000):
+    return {"short_channel_id": scid, "peer_id": peer_id, "to_us_msat": our, "total_msat": total,
+            "fee_base_msat": 1000, "fee_proportional_millionths": 10, "state": "CHANNELD_NORMAL"}
+
+
+def test_snapshot_lookups():
+    pending = channel(None, "02bb")
+    del pending["short_channel_id"]
+    snapshot = ChannelSnapshot([channel("1x1x0", "02aa"), channel("1x2x0", "02aa", 500), pending])
+    assert len(snapshot) == 3
+    assert "1x1x0" in snapshot
+    assert snapshot.peer_id("1x2x0") == "02aa"
+    assert snapshot.peer_id("9x9x9") is None
+    assert [ch["short_channel_id"] for ch in snapshot.peer_channels("02aa")] == ["1x1x0", "1x2x0"]
+    assert snapshot.peer_channels("02bb") == [pending]
+    assert snapshot.fees("1x1x0") == {"base": 1000, "ppm": 10}
+    assert snapshot.balance("1x2x0") == {"our": 500, "total": 2000}
+    assert snapshot.fees("9x9x9") is None
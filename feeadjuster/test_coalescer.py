@@ -0,0 +1,32 @@
+import threading
+from coalescer import Coalescer
+
+
+def test_coalescer_merges():
+    batches = []
+    done = threading.Event()
+
+    def flush(keys):
+        batches.append(keys)
+        done.set()
+    coalescer = Coalescer(0.2, flush)
+    coalescer.add(["1x1x0", "2x1x0"])
+    coalescer.add(["2x1x0", "3x1x0"])
+    assert coalescer.pending() == 3
+    assert done.wait(5)
+    assert batches == [{"1x1x0", "2x1x0", "3x1x0"}]
+    assert (coalescer.added, coalescer.flushes, coalescer.pending()) == (4, 1, 0)
+    # a new batch starts with the next key
+    done.clear()
+    coalescer.add(["1x1x0"])
+    assert done.wait(5)
+    assert batches[1] == {"1x1x0"}
+
+
+def test_coalescer_no_window():
+    batches = []
+    coalescer = Coalescer(0, batches.append)
+    coalescer.add(["1x1x0"])
+    coalescer.add(["2x1x0"])
+    assert batches == [{"1x1x0"}, {"2x1x0"}]
+    assert coalescer.flushes == 2
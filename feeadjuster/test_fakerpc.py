@@ -0,0 +1,49 @@
+import pytest
+from pyln.client import RpcError
+from fakerpc import FakeRpc
+
+
+def test_fakerpc_forward_moves_liquidity():
+    rpc = FakeRpc(channels=4, liquidity=0.5)
+    inc, out = rpc.listpeerchannels()["channels"][:2]
+    event = rpc.forward(inc["short_channel_id"], out["short_channel_id"], 10**6)
+    assert event["status"] == "settled"
+    assert event["in_msat"] == 10**6 + 1000 + 10
+    channels = {ch["short_channel_id"]: ch for ch in rpc.listpeerchannels()["channels"]}
+    assert channels[out["short_channel_id"]]["to_us_msat"] == out["to_us_msat"] - 10**6
+    assert channels[inc["short_channel_id"]]["to_us_msat"] == inc["to_us_msat"] + event["in_msat"]
+    # more than our side of the channel fails and moves nothing
+    event = rpc.forward(inc["short_channel_id"], out["short_channel_id"], int(out["total_msat"]))
+    assert event["status"] == "failed"
+    assert rpc.listpeerchannels(out["peer_id"])["channels"][0]["to_us_msat"] == out["to_us_msat"] - 10**6
+
+
+def test_fakerpc_recorded_channels():
+    rpc = FakeRpc(channels=0, peer_channels=3)
+    event = rpc.forward("700x1x0", "800x5x1", 1000, fee_msat=1)
+    assert len(rpc.listpeerchannels()["channels"]) == 2
+    assert event["fee_msat"] == 1
+    peer = rpc.listpeerchannels()["channels"][0]["peer_id"]
+    assert len(rpc.call("listchannels", {"destination": peer})["channels"]) == 3
+
+
+def test_fakerpc_setchannel():
+    rpc = FakeRpc(channels=2)
+    scid = rpc.listpeerchannels()["channels"][0]["short_channel_id"]
+    rpc.setchannel(scid, 0, 100, None, 10**6)
+    ch = rpc.listpeerchannels()["channels"][0]
+    assert (ch["fee_base_msat"], ch["fee_proportional_millionths"], ch["maximum_htlc_out_msat"]) == (0, 100, 10**6)
+    assert rpc.updates == [(scid, 0, 100, 10**6)]
+    with pytest.raises(RpcError):
+        rpc.setchannel("1x1x1", 0, 100)
+    assert rpc.calls["setchannel"] == 2
+
+
+def test_fakerpc_listforwards():
+    rpc = FakeRpc(channels=2, liquidity=0.5)
+    inc, out = rpc.listpeerchannels()["channels"]
+    for _ in range(3):
+        rpc.forward(inc["short_channel_id"], out["short_channel_id"], 1000)
+    assert len(rpc.listforwards()["forwards"]) == 3
+    forwards = rpc.call("listforwards", {"index": "updated", "start": 2, "limit": 1})["forwards"]
+    assert [fw["updated_index"] for fw in forwards] == [2]
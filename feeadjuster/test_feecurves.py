@@ -0,0 +1,67 @@
+import argparse
+import random
+from types import SimpleNamespace
+
+import pytest
+from pyln.client import Millisatoshi
+
+import benchmark
+import feecurves
+import feeadjuster
+
+np = pytest.importorskip("numpy")
+
+
+def scalar(our, total, big_enough, get_ratio):
+    """ Percentage, ratio and ppm of the plugin's scalar code, max_htlc is
+        compared through `plan_channel` below
+    """
+    plugin = SimpleNamespace(adj_balances={"1x1x0": {"our": our, "total": total}},
+                             big_enough_liquidity=Millisatoshi(big_enough))
+    percentage = feeadjuster.get_adjusted_percentage(plugin, "1x1x0")
+    ratio = get_ratio(percentage)
+    return percentage, ratio, int(300 * ratio)
+
+
+@pytest.mark.parametrize("get_ratio", [feeadjuster.get_ratio, feeadjuster.get_ratio_soft, feeadjuster.get_ratio_hard])
+@pytest.mark.parametrize("big_enough,steps", [(0, 0), (10**8, 0), (0, 5), (3 * 10**8, 10)])
+def test_evaluate_matches_scalar(big_enough, steps, get_ratio):
+    r = random.Random(1)
+    total = [r.choice([10**8, 10**9, 5 * 10**9]) for _ in range(1000)]
+    our = [r.randint(0, t) for t in total] + [0, 10**9]
+    total += [10**9, 10**9]
+    curves = feecurves.evaluate(our, total, get_ratio, ppm=300, big_enough_liquidity=big_enough, max_htlc_steps=steps)
+    for i in range(len(our)):
+        percentage, ratio, ppm = scalar(our[i], total[i], big_enough, get_ratio)
+        assert curves["percentage"][i] == pytest.approx(percentage)
+        assert curves["ratio"][i] == pytest.approx(ratio)
+        assert abs(curves["ppm"][i] - ppm) <= 1
+    assert (curves["max_htlc"] is None) == (steps == 0)
+
+
+def test_evaluate_per_channel_ppm():
+    curves = feecurves.evaluate([0, 50, 100], [100, 100, 100], feeadjuster.get_ratio, ppm=[100, 200, 300])
+    assert curves["ratio"].tolist() == pytest.approx([50**0.5, 1, 50**-0.5])
+    assert curves["ppm"].tolist() == [707, 200, 42]
+
+
+@pytest.mark.parametrize("method", ["default", "soft", "hard"])
+def test_plan_fees_batch_matches_plan_channel(method):
+    args = argparse.Namespace(channels=50, liquidity=None, latency=0.0, seed=1, verbose=False)
+    module, plugin, rpc = benchmark.start_plugin(args, {"feeadjuster-adjustment-method": method,
+                                                        "feeadjuster-enough-liquidity": "300000000msat",
+                                                        "feeadjuster-max-htlc-steps": "5"})
+    r = random.Random(1)
+    for balance in plugin.adj_balances.values():
+        balance["our"] = r.randint(0, balance["total"])
+        balance.pop("last_liquidity", None)
+    scids = list(plugin.adj_balances)
+    plugin.batch_min = 1
+    batch = module.plan_fees(plugin, scids)
+    plugin.batch_min = len(scids) + 1
+    single = module.plan_fees(plugin, scids)
+    assert len(batch) == len(single) > 0
+    for b, s in zip(batch, single):
+        assert b["ratio"] == pytest.approx(s["ratio"])
+        assert abs(b["ppm"] - s["ppm"]) <= 1
+        assert b["max_htlc"] == s["max_htlc"]
@@ -0,0 +1,39 @@
+import random
+import statistics
+from feeindex import FeeIndex
+
+
+def half(scid, source, destination, base, ppm):
+    return {"short_channel_id": scid, "source": source, "destination": destination,
+            "base_fee_millisatoshi": base, "fee_per_millionth": ppm}
+
+
+def test_feeindex_median_matches_statistics():
+    rand = random.Random(1)
+    channels = [half(f"{i}x1x0", f"03{i}", "02aa", rand.randint(0, 6000), rand.randint(0, 6000))
+                for i in range(101)]
+    channels.append(half("999x1x0", "02me", "02aa", 1, 1))
+    index = FeeIndex(exclude_source="02me")
+    index.load(channels)
+    ppms = [ch["fee_per_millionth"] for ch in channels[:-1] if 0 < ch["fee_per_millionth"] < 5000]
+    assert index.count("02aa") == 101
+    assert index.percentile("02aa", "ppm", 50) == statistics.median(ppms)
+    assert index.percentile("02aa", "ppm", 0) == min(ppms)
+    assert index.percentile("02aa", "ppm", 100) == max(ppms)
+    assert index.percentile("02bb", "ppm", 50) is None
+
+
+def test_feeindex_updates():
+    index = FeeIndex()
+    index.load([half("1x1x0", "03a", "02aa", 10, 100), half("1x2x0", "03b", "02aa", 20, 300)])
+    assert index.percentile("02aa", "ppm", 50) == 200
+    # a reload of the destination replaces the old fees of its half-channels
+    index.load_destination("02aa", [half("1x1x0", "03a", "02aa", 10, 100), half("1x2x0", "03b", "02aa", 20, 500)])
+    assert index.percentile("02aa", "ppm", 50) == 300
+    assert index.count("02aa") == 2
+    index.load_destination("02aa", [half("1x3x0", "03c", "02aa", 0, 0)])
+    assert index.count("02aa") == 1
+    assert index.percentile("02aa", "ppm", 50) is None
+    assert index.age("02aa") < 1
+    index.expire()
+    assert index.age("02aa") > 10**6
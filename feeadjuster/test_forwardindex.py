@@ -0,0 +1,43 @@
+import time
+from forwardindex import ForwardIndex
+
+
+def test_forwardindex_windows():
+    index = ForwardIndex(bucket=10)
+    # in the middle of a bucket
+    now = time.time() // 10 * 10 + 5
+    assert index.add("a/1", "settled", "1x1x0", "2x1x0", 1010, 1000, 10, now - 25)
+    assert index.add("a/2", "settled", "1x1x0", "2x1x0", 2020, 2000, 20, now)
+    assert index.add("a/3", "local_failed", "1x1x0", "2x1x0", 0, 0, 0, now)
+    # counted once, from a notification or a catch-up
+    assert not index.add("a/2", "settled", "1x1x0", "2x1x0", 2020, 2000, 20, now)
+    assert not index.add("a/4", "offered", "1x1x0", "2x1x0", 2020, 2000, 20, now)
+    assert index.window("2x1x0", 10, now) == {"out_count": 1, "out_msat": 2000, "fee_msat": 20,
+                                              "in_msat": 0, "failed": 1}
+    assert index.window("2x1x0", 100, now)["out_msat"] == 3000
+    assert index.window("1x1x0", 100, now)["in_msat"] == 3030
+    assert index.window("3x1x0", 100, now)["out_count"] == 0
+    # a late forward also counts for the later windows
+    assert index.add("a/5", "settled", "1x1x0", "2x1x0", 505, 500, 5, now - 45)
+    assert index.window("2x1x0", 100, now)["out_msat"] == 3500
+    assert index.window("2x1x0", 30, now)["out_msat"] == 3000
+
+
+def test_forwardindex_prune_and_cursor(tmp_path):
+    path = str(tmp_path / "forwards.sqlite3")
+    index = ForwardIndex(path, bucket=10, keep=100)
+    now = time.time() // 10 * 10 + 5
+    for i in range(20):
+        index.add(f"a/{i}", "settled", "1x1x0", "2x1x0", 110, 100, 10, now - i * 10)
+    # too old to be kept
+    assert not index.add("a/old", "settled", "1x1x0", "2x1x0", 110, 100, 10, now - 1000)
+    # pruned as forwards come in
+    assert index.pruned == int(time.time() // 10)
+    index.set_cursor("forwards", 42)
+    index.prune(now + 50)
+    assert index.window("2x1x0", 40, now + 50)["out_count"] == 0
+    assert index.window("2x1x0", 60, now + 50)["out_count"] == 1
+    index.close()
+    index = ForwardIndex(path, bucket=10, keep=100)
+    assert index.cursor("forwards") == 42
+    assert index.window("2x1x0", 60, now)["out_count"] == 6
@@ -0,0 +1,131 @@
+import argparse
+import benchmark
+
+
+ARGS = argparse.Namespace(channels=6, liquidity=0.1, latency=0.0, seed=1, verbose=False)
+
+
+def start(**options):
+    module, plugin, rpc = benchmark.start_plugin(ARGS, options)
+    rpc.calls.clear()
+    rpc.updates.clear()
+    return module, plugin, rpc
+
+
+def restart(rpc):
+    """ Counts the calls of the init of a new plugin instance on the same node """
+    rpc.calls.clear()
+    rpc.updates.clear()
+    return benchmark.start_plugin(ARGS, {}, rpc)
+
+
+def test_plan_channel():
+    module, plugin, rpc = start()
+    scid = next(iter(plugin.snapshot))["short_channel_id"]
+    total = plugin.adj_balances[scid]["total"]
+    # fees are set already
+    assert module.plan_channel(plugin, scid) is None
+    plugin.adj_balances[scid]["our"] = total // 4
+    update = module.plan_channel(plugin, scid)
+    assert update["reason"] == "adjusted"
+    assert update["ratio"] == module.get_ratio(update["our"] / total)
+    assert update["ppm"] == int(10 * update["ratio"])
+    assert update["base"] == 1000
+    assert update["max_htlc"] is None
+    # below the threshold
+    plugin.adj_balances[scid]["last_liquidity"] = total // 4 + 1
+    assert module.plan_channel(plugin, scid) is None
+    plugin.exclude_list = {scid}
+    del plugin.adj_balances[scid]["last_liquidity"]
+    assert module.plan_channel(plugin, scid) is None
+
+
+def test_plan_channel_imbalance():
+    module, plugin, rpc = start(**{"feeadjuster-imbalance": "0.2", "feeadjuster-max-htlc-steps": "4"})
+    scid = next(iter(plugin.snapshot))["short_channel_id"]
+    total = plugin.adj_balances[scid]["total"]
+    assert plugin.snapshot.fees(scid)["ppm"] != 10
+    plugin.adj_balances[scid]["our"] = total // 2
+    update = module.plan_channel(plugin, scid)
+    assert (update["reason"], update["base"], update["ppm"], update["max_htlc"]) == ("default", 1000, 10, None)
+    plugin.adj_balances[scid]["our"] = total // 20
+    update = module.plan_channel(plugin, scid)
+    assert update["reason"] == "adjusted"
+    assert update["max_htlc"] == int(total / 4)
+
+
+def test_plan_fees_apply_plan():
+    module, plugin, rpc = start()
+    for scid in plugin.adj_balances:
+        plugin.adj_balances[scid]["our"] = plugin.adj_balances[scid]["total"] * 9 // 10
+    scids = list(plugin.adj_balances)
+    updates = module.plan_fees(plugin, scids)
+    assert sorted(u["scid"] for u in updates) == sorted(scids)
+    assert module.apply_plan(plugin, updates) == len(updates)
+    assert sorted(rpc.updates) == sorted((u["scid"], u["base"], u["ppm"], None) for u in updates)
+    # applied, so nothing is left to change
+    assert module.plan_fees(plugin, scids) == []
+
+
+def test_feeadjust_dry_run():
+    module, plugin, rpc = start()
+    for ch in rpc.channels.values():
+        ch["to_us_msat"] = ch["total_msat"] * 9 // 10
+    snapshot = plugin.snapshot
+    balances = {scid: dict(balance) for scid, balance in plugin.adj_balances.items()}
+    ledger = {scid: plugin.ledger.balance(scid) for scid in plugin.adj_balances}
+    state = dict(rpc.datastore_)
+    result = module.feeadjust(plugin, dry_run=True)
+    assert len(result["plan"]) == 6
+    assert all(u["reason"] == "adjusted" and u["ppm"] < 10 for u in result["plan"])
+    assert rpc.calls["setchannel"] == 0
+    assert plugin.snapshot is snapshot
+    assert plugin.adj_balances == balances
+    assert {scid: plugin.ledger.balance(scid) for scid in balances} == ledger
+    assert rpc.datastore_ == state
+    assert not plugin.mutex.locked()
+    # the real run applies the same plan
+    assert module.feeadjust(plugin) == "6 channel(s) adjusted"
+    assert sorted(rpc.updates) == sorted((u["scid"], u["base"], u["ppm"], None) for u in result["plan"])
+
+
+def test_warm_restart():
+    module, plugin, rpc = start()
+    assert len(rpc.listdatastore(["feeadjuster", "state"])["datastore"]) == 6
+    assert len(plugin.adj_state) == 6
+    # a restart with unchanged balances keeps all fees
+    module, plugin, rpc = restart(rpc)
+    assert rpc.calls["setchannel"] == 0
+    assert rpc.calls["datastore"] == 0
+    # only the moved channel is adjusted and saved
+    inc, out = list(rpc.channels)[:2]
+    rpc.channels[inc]["to_us_msat"] = rpc.channels[inc]["total_msat"] * 9 // 10
+    module, plugin, rpc = restart(rpc)
+    assert [u[0] for u in rpc.updates] == [inc]
+    assert rpc.calls["datastore"] == 1
+    # closed channels are dropped from the datastore
+    del rpc.channels[out]
+    module, plugin, rpc = restart(rpc)
+    assert rpc.calls["setchannel"] == 0
+    assert sorted(plugin.adj_state) == sorted(rpc.channels)
+    assert len(rpc.listdatastore(["feeadjuster", "state"])["datastore"]) == 5
+
+
+def test_forward_counted_once():
+    module, plugin, rpc = start(**{"feeadjuster-feestrategy": "revenue"})
+    inc, out = list(rpc.channels)[:2]
+    handler = plugin.subscriptions["forward_event"]
+    event = rpc.forward(inc, out, 10**6)
+    # older notifications have no in_htlc_id and no indexes
+    old = {k: v for k, v in event.items() if k not in ("in_htlc_id", "created_index", "updated_index")}
+    handler(plugin, forward_event=old)
+    assert plugin.forward_index.cursor("forwards") == 0
+    module.catch_up_forwards(plugin)
+    assert plugin.forward_index.window(out, 3600)["out_count"] == 1
+    assert plugin.forward_index.cursor("forwards") == 1
+    # a notification moves the cursor past its forward
+    handler(plugin, forward_event=rpc.forward(inc, out, 10**6))
+    assert plugin.forward_index.cursor("forwards") == 2
+    module.catch_up_forwards(plugin)
+    assert plugin.forward_index.window(out, 3600)["out_count"] == 2
+    assert rpc.calls["listforwards"] == 2
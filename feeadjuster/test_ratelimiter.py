@@ -0,0 +1,57 @@
+from ratelimiter import TokenBucket, UpdateLimiter
+
+
+def test_tokenbucket():
+    bucket = TokenBucket(1, 2)
+    now = bucket.updated
+    assert bucket.wait(now) == 0
+    bucket.take()
+    bucket.take()
+    assert bucket.wait(now) == 1
+    assert bucket.wait(now + 0.5) == 0.5
+    # never saves up more than the burst
+    assert bucket.wait(now + 100) == 0
+    assert bucket.tokens == 2
+
+
+def test_limiter_disabled():
+    limiter = UpdateLimiter()
+    assert not limiter.enabled()
+    for i in range(10):
+        limiter.submit(f"{i}x1x0", i)
+    assert limiter.take_ready() == list(range(10))
+    assert limiter.next_ready() is None
+
+
+def test_limiter_global():
+    limiter = UpdateLimiter(rate=0.001, burst=2)
+    for i in range(4):
+        limiter.submit(f"{i}x1x0", i)
+    assert limiter.take_ready() == [0, 1]
+    assert limiter.take_ready() == []
+    assert limiter.stats() == {"queue_depth": 2, "deferred": 2, "merged": 0, "sent": 2}
+    assert limiter.next_ready() > 900
+    # tokens are back, the oldest deferred update goes first
+    limiter.bucket.tokens = 1
+    assert limiter.take_ready() == [2]
+
+
+def test_limiter_channel_merges():
+    limiter = UpdateLimiter(channel_rate=0.001, channel_burst=1)
+    limiter.submit("1x1x0", {"ppm": 10})
+    limiter.submit("2x1x0", {"ppm": 20})
+    assert len(limiter.take_ready()) == 2
+    limiter.submit("1x1x0", {"ppm": 11})
+    limiter.submit("1x1x0", {"ppm": 12})
+    assert limiter.take_ready() == []
+    limiter.submit("1x1x0", {"ppm": 13})
+    # other channels are not held back
+    limiter.submit("3x1x0", {"ppm": 30})
+    assert limiter.take_ready() == [{"ppm": 30}]
+    assert limiter.stats() == {"queue_depth": 1, "deferred": 1, "merged": 2, "sent": 3}
+    # only the latest value is sent
+    limiter.channels["1x1x0"].tokens = 1
+    assert limiter.take_ready() == [{"ppm": 13}]
+    limiter.submit("2x1x0", {"ppm": 21})
+    limiter.cancel("2x1x0")
+    assert limiter.next_ready() is None
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+""" Offline benchmark of the rebalance plugin against a simulated network.
+
+Runs `rebalance` with each getroute method, `rebalanceall` or an executed
+`rebalanceplan` against a FakeRpc graph and reports attempts, RPC calls,
+fees and wall-clock time.
+Plugin options can be swept with comma separated values, every
+combination is run on an identical network:
+
+    python3 benchmark.py --methods basic iterative local --failure-rate 0.1
+    python3 benchmark.py --rebalanceall --option rebalance-threads=2,8
+    python3 benchmark.py --plan --methods local
+    python3 benchmark.py --option rebalance-msatfactor=1,4 --option rebalance-maxhops=3,5
+    python3 benchmark.py --parts 4 --invoiceless
+"""
+import argparse
+import importlib
+import itertools
+import random
+import time
+from pyln.client import Millisatoshi
+from fakerpc import FakeRpc
+import rebalance
+
+
+def start_plugin(args, options: dict):
+    """ A fresh plugin instance connected to a fresh simulated network """
+    module = importlib.reload(rebalance)
+    plugin = module.plugin
+    # like rebalance-invoiceless.py, FakeRpc calls the hook itself
+    plugin.invoiceless = args.invoiceless
+    rpc = FakeRpc(nodes=args.nodes, channels_per_node=args.channels_per_node,
+                  our_channels=args.our_channels, liquidity=args.liquidity,
+                  failure_rate=args.failure_rate, latency=args.latency, fee_ppm=args.fee_ppm,
+                  seed=args.seed)
+    plugin.rpc = rpc
+    plugin.log = lambda message, level='info': args.verbose and print(f"  [{level}] {message}")
+
+    def listener(topic, payload):
+        plugin.subscriptions[topic](plugin, **{topic: payload})
+    rpc.listeners.append(listener)
+    rpc.htlc_hook = lambda **kwargs: module.on_htlc_accepted(plugin=plugin, **kwargs)
+    opts = {name: option.default for name, option in plugin.options.items()}
+    opts.update(options)
+    module.init(opts, {}, plugin)
+    # finish the initial report catch-up, it is not part of the benchmark
+    module.catch_up_report()
+    with plugin.report_lock:
+        pass
+    return module, plugin, rpc
+
+
+def pick_pairs(rpc: FakeRpc, count: int, amount: float, seed: int):
+    """ Random (outgoing, incoming, msat) pairs, sending `amount` of what is possible """
+    channels = rpc.listpeerchannels()["channels"]
+    rand = random.Random(seed)
+    pairs = []
+    for _ in range(count):
+        out, inc = rand.sample(channels, 2)
+        possible = min(out["to_us_msat"], inc["total_msat"] - inc["to_us_msat"])
+        pairs.append((out["short_channel_id"], inc["short_channel_id"], Millisatoshi(int(int(possible) * amount))))
+    return pairs
+
+
+def bench_rebalance(args, options: dict, method: str):
+    module, plugin, rpc = start_plugin(args, options)
+    pairs = pick_pairs(rpc, args.pairs, args.amount, args.seed)
+    rpc.calls.clear()
+    stats = {"runs": 0, "ok": 0, "fee": Millisatoshi(0), "amount": Millisatoshi(0)}
+    start = time.time()
+    for out_scid, in_scid, msat in pairs:
+        if int(msat) == 0:
+            continue
+        result = module.rebalance(plugin, out_scid, in_scid, msat, retry_for=args.retry_for,
+                                  getroute_method=method, parts=args.parts)
+        stats["runs"] += 1
+        if result.get("status") == "complete":
+            stats["ok"] += 1
+            stats["fee"] += result["fee"]
+            stats["amount"] += result["received"]
+    stats["time"] = time.time() - start
+    stats["metrics"] = plugin.metrics.report()
+    return stats, rpc
+
+
+def bench_rebalanceall(args, options: dict, method: str):
+    module, plugin, rpc = start_plugin(args, dict(options, **{"rebalance-getroute": method}))
+    health_before = module.rebalancereport(plugin, False)["liquidity_health"]
+    rpc.calls.clear()
+    start = time.time()
+    if args.plan:
+        module.rebalanceplan(plugin, Millisatoshi(args.min_amount), args.feeratio, execute=True)
+    else:
+        module.rebalanceall(plugin, Millisatoshi(args.min_amount), args.feeratio)
+    while plugin.rebalanceall_msg is None:
+        time.sleep(0.01)
+    stats = {"time": time.time() - start, "runs": 0, "ok": 0}
+    stats["fee"] = Millisatoshi(plugin.report.fee)
+    stats["amount"] = Millisatoshi(plugin.report.amount)
+    stats["ok"] = plugin.report.count
+    stats["health"] = f"{health_before} -> {module.rebalancereport(plugin, False)['liquidity_health']}"
+    stats["metrics"] = plugin.metrics.report()
+    return stats, rpc
+
+
+def print_result(name: str, stats: dict, rpc: FakeRpc, verbose: bool = False):
+    ppm = int(stats["fee"]) * 10**6 // int(stats["amount"]) if int(stats["amount"]) > 0 else 0
+    runs = f"{stats['ok']}/{stats['runs']}" if stats["runs"] else f"{stats['ok']}"
+    print(f"{name:<44} {runs:>7} {rpc.calls['sendpay']:>8} {rpc.calls['getroute']:>8} "
+          f"{sum(rpc.calls.values()):>9} {stats['fee'].to_satoshi_str():>14} {ppm:>6} {stats['time']:>8.2f}s"
+          + (f"  health {stats['health']}" if "health" in stats else ""))
+    if verbose:
+        print(f"  rpc calls: {dict(rpc.calls)}")
+        metrics = stats["metrics"]
+        for phase, h in metrics["phases"].items():
+            if h["count"] > 0:
+                print(f"  {phase:<12} count:{h['count']:<6} avg:{h['avg_s']:.4f}s  p90:{h['p90_s']}s  "
+                      f"max:{h['max_s']}s  errors:{metrics['errors'].get(phase, 0)}")
+        print(f"  failcodes: {metrics['failcodes']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--methods", nargs="+", default=["basic", "iterative", "local"],
+                        help="getroute methods to compare")
+    parser.add_argument("--option", action="append", default=[],
+                        help="plugin option name=value[,value...], values are swept")
+    parser.add_argument("--rebalanceall", action="store_true", help="benchmark rebalanceall instead of rebalance")
+    parser.add_argument("--plan", action="store_true", help="benchmark an executed rebalanceplan instead of rebalance")
+    parser.add_argument("--pairs", type=int, default=20, help="rebalance runs per method")
+    parser.add_argument("--amount", type=float, default=0.2, help="share of the possible amount per rebalance")
+    parser.add_argument("--parts", type=int, default=1, help="parts per rebalance")
+    parser.add_argument("--invoiceless", action="store_true",
+                        help="settle the self-payments in the htlc_accepted hook like rebalance-invoiceless.py")
+    parser.add_argument("--retry-for", type=int, default=60)
+    parser.add_argument("--min-amount", default="50000sat", help="rebalanceall min_amount")
+    parser.add_argument("--feeratio", type=float, default=0.5, help="rebalanceall feeratio")
+    parser.add_argument("--nodes", type=int, default=100)
+    parser.add_argument("--channels-per-node", type=int, default=4)
+    parser.add_argument("--our-channels", type=int, default=8)
+    parser.add_argument("--liquidity", type=float, default=None,
+                        help="share of channel capacity on one side, random by default")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="random failure rate per hop")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per hop until a payment settles")
+    parser.add_argument("--fee-ppm", type=int, default=1000, help="our node's fee-per-satoshi")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    sweeps = []
+    for option in args.option:
+        name, values = option.split("=", 1)
+        # flag options are swept as true,false
+        flags = {"true": True, "false": False}
+        sweeps.append([(name, flags.get(v, v)) for v in values.split(",")])
+    bench = bench_rebalanceall if args.rebalanceall or args.plan else bench_rebalance
+
+    print(f"{'benchmark':<44} {'ok':>7} {'sendpay':>8} {'getroute':>8} {'rpc calls':>9} "
+          f"{'fees':>14} {'ppm':>6} {'time':>9}")
+    for combination in itertools.product(*sweeps):
+        options = dict(combination)
+        for method in args.methods:
+            name = " ".join([method] + [f"{n.replace('rebalance-', '')}={v}" for n, v in combination])
+            stats, rpc = bench(args, options, method)
+            print_result(name, stats, rpc, args.verbose)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import json
+import threading
+import time
+
+
+class FailureBackoff(object):
+    """ Recently failed channel pairs ("scid1:scid2") and channels ("scid").
+
+    Every failure doubles the time a key is skipped, starting at `base`
+    seconds and capped at `base * 2**max_doublings`. A key is `in` the
+    backoff only until its time expires, a success forgets it. Keys that
+    did not fail again for a maximal backoff period are dropped.
+    """
+    def __init__(self, base: float = 600, max_doublings: int = 7):
+        self.lock = threading.Lock()
+        self.base = base
+        self.max_doublings = max_doublings
+        self.entries = {}   # key -> {"failures", "until", "time"}
+        self.failures = 0   # failures reported since start, to detect progress
+
+    def __contains__(self, key: str):
+        entry = self.entries.get(key)
+        return entry is not None and entry["until"] > time.time()
+
+    def __len__(self):
+        now = time.time()
+        with self.lock:
+            return sum(1 for e in self.entries.values() if e["until"] > now)
+
+    def backoff(self, failures: int):
+        return self.base * 2 ** min(failures - 1, self.max_doublings)
+
+    def fail(self, key: str):
+        now = time.time()
+        with self.lock:
+            self.failures += 1
+            entry = self.entries.get(key)
+            failures = 1 if entry is None else entry["failures"] + 1
+            self.entries[key] = {"failures": failures, "until": now + self.backoff(failures), "time": now}
+
+    def succeed(self, key: str):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def remaining(self, key: str):
+        """ Seconds until `key` may be tried again """
+        entry = self.entries.get(key)
+        return max(entry["until"] - time.time(), 0) if entry is not None else 0
+
+    def prune(self):
+        now = time.time()
+        forget = self.base * 2 ** self.max_doublings
+        with self.lock:
+            self.entries = {k: e for k, e in self.entries.items()
+                            if e["until"] > now or now - e["time"] < forget}
+
+    def dumps(self):
+        self.prune()
+        with self.lock:
+            return json.dumps(self.entries)
+
+    def loads(self, string: str):
+        with self.lock:
+            self.entries = json.loads(string)
@@ -0,0 +1,369 @@
+import collections
+import hashlib
+import os
+import random
+import threading
+import time
+from pyln.client import Millisatoshi, RpcError
+from routegraph import ChannelGraph
+
+
+WIRE_TEMPORARY_CHANNEL_FAILURE = 0x1007
+
+
+class FakeRpc(object):
+    """ Simulated lightningd RPC for offline benchmarks of the plugin.
+
+    Serves a random channel graph with known liquidity through the calls
+    the plugin uses (`getroute`, `listchannels`, `sendpay`, `waitsendpay`,
+    `invoice`, ...). Payments move liquidity along their route. A hop fails
+    when its channel lacks liquidity, or at random with `failure_rate`.
+    Results settle after `latency` seconds per hop and are also delivered
+    as `sendpay_success`/`sendpay_failure`/`invoice_payment` notifications
+    to the callables in `listeners`. Every call is counted in `calls`.
+
+    Self-payments without an invoice are passed to `htlc_hook`, called like
+    the plugin's `htlc_accepted` hook, if one is set.
+
+    `liquidity` is the share of each channel's capacity on the side of
+    its first node, None picks a random share per channel. `fee_ppm` is
+    our node's configured fee, which limits the fees of `rebalanceall`.
+    """
+    def __init__(self, nodes: int = 100, channels_per_node: int = 4, our_channels: int = 8,
+                 capacity=(10**9, 10**10), liquidity: float = None, failure_rate: float = 0.0,
+                 latency: float = 0.0, fee_ppm: int = 1000, seed: int = 1):
+        self.rand = random.Random(seed)
+        self.lock = threading.RLock()
+        self.cond = threading.Condition(self.lock)
+        self.calls = collections.Counter()
+        self.listeners = []
+        self.htlc_hook = None
+        self.failure_rate = failure_rate
+        self.latency = latency
+        self.fee_ppm = fee_ppm
+        self.me = "02" + "00" * 32
+        self.nodes = [self.me] + ["02" + "%064x" % self.rand.getrandbits(256) for _ in range(nodes)]
+        self.channels = {}   # scid -> {"nodes", "capacity", "balance": {node: msat}, "policy": {node: {...}}}
+        self.invoices = {}   # label -> invoice
+        self.payments = {}   # payment_hash -> {partid: part}
+        self.datastore_ = {}
+        self.forwards = []
+        self.sendpay_ids = 0
+        self.invoice_index = 0
+        block = 100
+        for node in self.nodes[1:]:
+            for peer in self.rand.sample(self.nodes[1:], channels_per_node):
+                if peer != node:
+                    block += 1
+                    self._open(f"{block}x1x0", node, peer, self.rand.randint(*capacity), liquidity)
+        for peer in self.rand.sample(self.nodes[1:], our_channels):
+            block += 1
+            self._open(f"{block}x1x0", self.me, peer, self.rand.randint(*capacity), liquidity)
+        self.graph = ChannelGraph()
+        self.graph.load(self._halfchannels())
+
+    def _open(self, scid: str, a: str, b: str, capacity: int, liquidity: float):
+        share = self.rand.random() if liquidity is None else liquidity
+        self.channels[scid] = {
+            "nodes": (a, b),
+            "capacity": capacity,
+            "balance": {a: int(capacity * share), b: capacity - int(capacity * share)},
+            "policy": {n: {"base": self.rand.choice([0, 1000]), "ppm": self.rand.randint(1, 500),
+                           "delay": self.rand.choice([6, 40, 144])} for n in (a, b)},
+        }
+
+    def _halfchannels(self, scid: str = None, source: str = None, destination: str = None):
+        result = []
+        for s, ch in self.channels.items():
+            if scid is not None and s != scid:
+                continue
+            for src in ch["nodes"]:
+                dst = ch["nodes"][1] if src == ch["nodes"][0] else ch["nodes"][0]
+                if source is not None and src != source or destination is not None and dst != destination:
+                    continue
+                policy = ch["policy"][src]
+                result.append({
+                    "source": src, "destination": dst, "short_channel_id": s,
+                    "direction": int(src > dst), "public": True, "active": True,
+                    "amount_msat": Millisatoshi(ch["capacity"]),
+                    "base_fee_millisatoshi": policy["base"], "fee_per_millionth": policy["ppm"],
+                    "delay": policy["delay"], "htlc_minimum_msat": Millisatoshi(0),
+                    "htlc_maximum_msat": Millisatoshi(ch["capacity"]),
+                })
+        return result
+
+    def _ours(self):
+        return {s: ch for s, ch in self.channels.items() if self.me in ch["nodes"]}
+
+    def _peer(self, ch):
+        return ch["nodes"][1] if ch["nodes"][0] == self.me else ch["nodes"][0]
+
+    def _notify(self, topic: str, payload: dict):
+        for listener in self.listeners:
+            listener(topic, payload)
+
+    def call(self, method: str, payload: dict = None):
+        return getattr(self, method)(**(payload or {}))
+
+    # node and configuration
+
+    def getinfo(self):
+        self.calls["getinfo"] += 1
+        return {"id": self.me, "version": "v24.02", "blockheight": 800000}
+
+    def help(self, command=None):
+        self.calls["help"] += 1
+        return {"help": [{"command": "listpeerchannels [id]"},
+                         {"command": "listchannels [short_channel_id] [source] [destination]"}]}
+
+    def listconfigs(self, config=None):
+        self.calls["listconfigs"] += 1
+        return {"configs": {"cltv-final": {"value_int": 18}, "fee-base": {"value_int": 1000},
+                            "fee-per-satoshi": {"value_int": self.fee_ppm}}}
+
+    def listnodes(self, id=None):
+        self.calls["listnodes"] += 1
+        return {"nodes": [{"nodeid": id, "alias": "node-" + id[2:8]}]}
+
+    # channels
+
+    def listchannels(self, short_channel_id=None, source=None, destination=None):
+        self.calls["listchannels"] += 1
+        with self.lock:
+            return {"channels": self._halfchannels(short_channel_id, source, destination)}
+
+    def listpeerchannels(self, id=None):
+        self.calls["listpeerchannels"] += 1
+        result = []
+        with self.lock:
+            for scid, ch in self._ours().items():
+                peer = self._peer(ch)
+                if id is not None and peer != id:
+                    continue
+                policy = ch["policy"][self.me]
+                result.append({
+                    "peer_id": peer, "peer_connected": True, "state": "CHANNELD_NORMAL",
+                    "short_channel_id": scid, "private": False,
+                    "to_us_msat": Millisatoshi(ch["balance"][self.me]),
+                    "total_msat": Millisatoshi(ch["capacity"]),
+                    "fee_base_msat": Millisatoshi(policy["base"]),
+                    "fee_proportional_millionths": policy["ppm"], "htlcs": [],
+                })
+        return {"channels": result}
+
+    def listpeers(self, id=None):
+        self.calls["listpeers"] += 1
+        peers = {self._peer(ch) for ch in self._ours().values()}
+        return {"peers": [{"id": p, "connected": True} for p in peers if id is None or p == id]}
+
+    def listfunds(self):
+        self.calls["listfunds"] += 1
+        with self.lock:
+            return {"outputs": [], "channels": [{
+                "peer_id": self._peer(ch), "short_channel_id": scid, "state": "CHANNELD_NORMAL",
+                "connected": True, "our_amount_msat": Millisatoshi(ch["balance"][self.me]),
+                "amount_msat": Millisatoshi(ch["capacity"]),
+            } for scid, ch in self._ours().items()]}
+
+    # routing and payments
+
+    def getroute(self, id, amount_msat=None, riskfactor=None, cltv=9, fromid=None, fuzzpercent=None,
+                 exclude=None, maxhops=20, msatoshi=None):
+        self.calls["getroute"] += 1
+        amount = int(Millisatoshi(amount_msat if amount_msat is not None else msatoshi))
+        route = self.graph.shortest_route(fromid or self.me, id, amount, maxhops or 20, exclude or [])
+        if route is None:
+            raise RpcError("getroute", {"id": id}, {"code": 205, "message": "Could not find a route"})
+        return {"route": [{"id": e["destination"], "channel": e["scid"], "direction": e["direction"],
+                           "amount_msat": Millisatoshi(amount), "delay": e["delay"], "style": "tlv"}
+                          for e in route]}
+
+    def invoice(self, amount_msat, label, description, expiry=None, **kwargs):
+        self.calls["invoice"] += 1
+        preimage = os.urandom(32)
+        invoice = {"label": label, "description": description, "status": "unpaid",
+                   "amount_msat": Millisatoshi(amount_msat), "preimage": preimage.hex(),
+                   "payment_hash": hashlib.sha256(preimage).hexdigest(),
+                   "payment_secret": os.urandom(32).hex()}
+        with self.lock:
+            self.invoice_index += 1
+            invoice["created_index"] = invoice["updated_index"] = self.invoice_index
+            self.invoices[label] = invoice
+        return {"payment_hash": invoice["payment_hash"], "payment_secret": invoice["payment_secret"],
+                "expires_at": int(time.time()) + (expiry or 3600)}
+
+    def delinvoice(self, label, status):
+        self.calls["delinvoice"] += 1
+        with self.lock:
+            invoice = self.invoices[label]
+            if invoice["status"] != status:
+                raise RpcError("delinvoice", {"label": label},
+                               {"code": 905, "message": f"Invoice status is {invoice['status']} not {status}"})
+            return self.invoices.pop(label)
+
+    def listinvoices(self, label=None, payment_hash=None, index=None, start=None, limit=None, **kwargs):
+        self.calls["listinvoices"] += 1
+        with self.lock:
+            invoices = [dict(i) for i in self.invoices.values() if label in (None, i["label"])
+                        and (index is None or i[f"{index}_index"] >= start)]
+        return {"invoices": invoices[:limit]}
+
+    def sendpay(self, route, payment_hash, label=None, amount_msat=None, bolt11=None,
+                payment_secret=None, partid=None, groupid=None, **kwargs):
+        self.calls["sendpay"] += 1
+        with self.lock:
+            self.sendpay_ids += 1
+            part = {"id": self.sendpay_ids, "payment_hash": payment_hash, "partid": partid or 0,
+                    "route": route, "status": "pending", "arrived": False, "error": None,
+                    "destination": route[-1]["id"],
+                    "total": int(Millisatoshi(amount_msat if amount_msat is not None else route[-1]["amount_msat"])),
+                    "amount_msat": Millisatoshi(route[-1]["amount_msat"]),
+                    "amount_sent_msat": Millisatoshi(route[0]["amount_msat"]),
+                    "locked": []}
+            self.payments.setdefault(payment_hash, {})[part["partid"]] = part
+            # lock the HTLC amounts hop by hop until one fails
+            source = self.me
+            for i, hop in enumerate(route):
+                ch = self.channels[hop["channel"]]
+                amount = int(Millisatoshi(hop["amount_msat"]))
+                if ch["balance"][source] < amount or (i > 0 and self.rand.random() < self.failure_rate):
+                    part["error"] = {"code": 204, "message": "failed: WIRE_TEMPORARY_CHANNEL_FAILURE",
+                                     "data": {"id": part["id"], "payment_hash": payment_hash,
+                                              "partid": part["partid"], "erring_index": i,
+                                              "failcode": WIRE_TEMPORARY_CHANNEL_FAILURE,
+                                              "erring_node": source, "erring_channel": hop["channel"],
+                                              "erring_direction": hop["direction"]}}
+                    break
+                ch["balance"][source] -= amount
+                part["locked"].append((hop["channel"], source, hop["id"], amount))
+                source = hop["id"]
+            result = {"id": part["id"], "payment_hash": payment_hash, "partid": part["partid"], "status": "pending"}
+        if self.latency > 0:
+            hops = len(part["locked"]) + 1
+            threading.Timer(self.latency * hops, self._arrive, args=(part,)).start()
+        else:
+            self._arrive(part)
+        return result
+
+    def _fail(self, part: dict, error: dict):
+        for scid, source, dest, amount in part["locked"]:
+            self.channels[scid]["balance"][source] += amount
+        part["status"] = "failed"
+        part["error"] = error
+        return ("sendpay_failure", error)
+
+    def _settle(self, part: dict):
+        for scid, source, dest, amount in part["locked"]:
+            self.channels[scid]["balance"][dest] += amount
+        part["status"] = "complete"
+        return ("sendpay_success", self._payment(part))
+
+    def _arrive(self, part: dict):
+        notifications = []
+        hook = False
+        with self.lock:
+            if part["error"] is not None:
+                notifications.append(self._fail(part, part["error"]))
+            else:
+                part["arrived"] = True
+                parts = self.payments[part["payment_hash"]].values()
+                arrived = [p for p in parts if p["arrived"] and p["status"] == "pending"]
+                invoice = next((i for i in self.invoices.values()
+                                if i["payment_hash"] == part["payment_hash"]), None)
+                if invoice is None and self.htlc_hook is not None:
+                    hook = True
+                elif sum(int(p["amount_msat"]) for p in arrived) >= part["total"]:
+                    if invoice is not None and invoice["status"] == "unpaid":
+                        invoice["status"] = "paid"
+                        self.invoice_index += 1
+                        invoice["updated_index"] = self.invoice_index
+                        notifications.append(("invoice_payment", {"label": invoice["label"],
+                                                                  "preimage": invoice["preimage"],
+                                                                  "msat": str(invoice["amount_msat"])}))
+                    for p in arrived:
+                        notifications.append(self._settle(p))
+            self.cond.notify_all()
+        for topic, payload in notifications:
+            self._notify(topic, payload)
+        if hook:
+            htlc = {"payment_hash": part["payment_hash"], "amount_msat": part["amount_msat"]}
+            self.htlc_hook(htlc=htlc, onion={"total_msat": Millisatoshi(part["total"])},
+                           request=HookRequest(self, part))
+
+    def _hook_result(self, part: dict, result: dict):
+        with self.lock:
+            if part["status"] != "pending":
+                return
+            if result["result"] == "resolve":
+                notification = self._settle(part)
+            else:
+                # no invoice behind a 'continue', lightningd fails it
+                last = len(part["route"]) - 1
+                notification = self._fail(part, {
+                    "code": 204, "message": "failed: WIRE_INCORRECT_OR_UNKNOWN_PAYMENT_DETAILS",
+                    "data": {"id": part["id"], "payment_hash": part["payment_hash"], "partid": part["partid"],
+                             "erring_index": last + 1, "failcode": 0x400f, "erring_node": self.me}})
+            self.cond.notify_all()
+        self._notify(*notification)
+
+    def _payment(self, part: dict):
+        return {"id": part["id"], "payment_hash": part["payment_hash"], "partid": part["partid"],
+                "destination": part["destination"], "status": part["status"],
+                "amount_msat": part["amount_msat"], "amount_sent_msat": part["amount_sent_msat"],
+                "created_index": part["id"], "updated_index": part["id"]}
+
+    def waitsendpay(self, payment_hash, timeout=None, partid=None, groupid=None):
+        self.calls["waitsendpay"] += 1
+        deadline = time.time() + (timeout if timeout is not None else 3600)
+        with self.cond:
+            part = self.payments[payment_hash][partid or 0]
+            while part["status"] == "pending":
+                if time.time() >= deadline:
+                    raise RpcError("waitsendpay", {"payment_hash": payment_hash},
+                                   {"code": 200, "message": "Timed out while waiting"})
+                self.cond.wait(deadline - time.time())
+            if part["status"] == "failed":
+                raise RpcError("waitsendpay", {"payment_hash": payment_hash}, part["error"])
+            return self._payment(part)
+
+    def listsendpays(self, bolt11=None, payment_hash=None, status=None, index=None, start=None, limit=None):
+        self.calls["listsendpays"] += 1
+        with self.lock:
+            payments = [self._payment(p) for h, parts in self.payments.items() for p in parts.values()
+                        if payment_hash in (None, h) and status in (None, p["status"])
+                        and (index is None or p["id"] >= start)]
+        return {"payments": sorted(payments, key=lambda p: p["id"])[:limit]}
+
+    def listforwards(self, status=None, in_channel=None, out_channel=None, index=None, start=None, limit=None):
+        self.calls["listforwards"] += 1
+        return {"forwards": [f for f in self.forwards if status in (None, f["status"])]}
+
+    # datastore
+
+    def datastore(self, key, string=None, hex=None, mode=None, generation=None):
+        self.calls["datastore"] += 1
+        with self.lock:
+            self.datastore_[tuple(key)] = string
+        return {"key": key, "string": string}
+
+    def listdatastore(self, key=None):
+        self.calls["listdatastore"] += 1
+        key = tuple(key or [])
+        with self.lock:
+            return {"datastore": [{"key": list(k), "string": v} for k, v in self.datastore_.items()
+                                  if k[:len(key)] == key]}
+
+    def deldatastore(self, key, generation=None):
+        self.calls["deldatastore"] += 1
+        with self.lock:
+            return {"key": key, "string": self.datastore_.pop(tuple(key), None)}
+
+
+class HookRequest(object):
+    """ Stands in for the pyln request of an `htlc_accepted` hook call """
+    def __init__(self, rpc: FakeRpc, part: dict):
+        self.rpc = rpc
+        self.part = part
+
+    def set_result(self, result: dict):
+        self.rpc._hook_result(self.part, result)
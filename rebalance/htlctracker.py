@@ -0,0 +1,81 @@
+import threading
+import time
+
+
+class HtlcTracker(object):
+    """ Counts in-flight HTLCs on our channels from plugin notifications.
+
+    Counts are seeded from `listpeerchannels`, raised by our own `sendpay`
+    calls and offered forwards, and lowered again by `sendpay_success`,
+    `sendpay_failure` and resolved `forward_event`s. Threads can wait for a
+    channel to become idle without polling lightningd.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.counts = {}    # scid -> number of pending HTLCs
+        self.pending = {}   # payment or forward key -> list of scids we counted
+        self.early = {}     # payment keys resolved before they were offered
+
+    def _add(self, scids: list, n: int):
+        for scid in scids:
+            if scid is None:
+                continue
+            count = max(self.counts.get(scid, 0) + n, 0)
+            if count == 0:
+                self.counts.pop(scid, None)
+            else:
+                self.counts[scid] = count
+
+    def seed(self, channels: list):
+        with self.cond:
+            self.counts = {}
+            for ch in channels:
+                if ch.get('short_channel_id') is not None and len(ch.get('htlcs', [])) > 0:
+                    self.counts[ch['short_channel_id']] = len(ch['htlcs'])
+            self.cond.notify_all()
+
+    def count(self, scid: str):
+        with self.cond:
+            return self.counts.get(scid, 0)
+
+    def offered(self, key, scids: list):
+        with self.cond:
+            if key in self.pending or self.early.pop(key, None) is not None:
+                return
+            self.pending[key] = scids
+            self._add(scids, 1)
+
+    def resolved(self, key, early: bool = False):
+        """ `early` remembers unknown keys, for notifications that can
+            overtake the `sendpay` result that offered them.
+        """
+        with self.cond:
+            scids = self.pending.pop(key, None)
+            if scids is None:
+                if early:
+                    now = time.time()
+                    self.early = {k: ts for k, ts in self.early.items() if ts > now - 600}
+                    self.early[key] = now
+                return
+            self._add(scids, -1)
+            self.cond.notify_all()
+
+    def reset(self, scid: str):
+        """ Forget a channel, i.e. after it closed or was found idle """
+        with self.cond:
+            self.counts.pop(scid, None)
+            for scids in self.pending.values():
+                while scid in scids:
+                    scids.remove(scid)
+            self.cond.notify_all()
+
+    def wait(self, scids: list, timeout: float = 60):
+        """ Wait until all `scids` are idle, returns False on timeout """
+        deadline = time.time() + timeout
+        with self.cond:
+            while any(self.counts.get(scid, 0) > 0 for scid in scids):
+                time_left = deadline - time.time()
+                if time_left <= 0:
+                    return False
+                self.cond.wait(time_left)
+        return True
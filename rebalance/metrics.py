@@ -0,0 +1,122 @@
+import bisect
+import contextlib
+import threading
+import time
+from collections import Counter
+
+
+class Histogram(object):
+    """ Latency histogram with fixed, roughly logarithmic buckets """
+    BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+              1, 2, 5, 10, 20, 60, 120, 300)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.buckets[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q: float):
+        """ Upper bound of the bucket holding the q-quantile """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n > 0:
+                return self.BOUNDS[i] if i < len(self.BOUNDS) else self.max
+        return self.max
+
+    def report(self):
+        bounds = [f"le_{b}s" for b in self.BOUNDS] + ["inf"]
+        return {
+            "count": self.count,
+            "total_s": round(self.total, 3),
+            "avg_s": round(self.total / self.count, 4) if self.count else 0.0,
+            "max_s": round(self.max, 4),
+            "p50_s": self.quantile(0.5),
+            "p90_s": self.quantile(0.9),
+            "p99_s": self.quantile(0.99),
+            "buckets": {b: n for b, n in zip(bounds, self.buckets) if n > 0},
+        }
+
+
+class RebalanceMetrics(object):
+    """ Timings and counters of rebalance attempts, kept for the lifetime
+        of the plugin, across `rebalanceall` runs.
+
+    Phases are 'getroute', 'fees', 'sendpay', 'waitsendpay', 'htlc_wait'
+    and 'rebalance' for whole requests. Errors are counted per phase,
+    failed payment attempts also by failcode and erring node.
+    """
+    PHASES = ("getroute", "fees", "sendpay", "waitsendpay", "htlc_wait", "rebalance")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.since = time.time()
+            self.phases = {phase: Histogram() for phase in self.PHASES}
+            self.errors = Counter()         # phase -> errors
+            self.results = Counter()        # rebalance status -> count
+            self.attempts = Counter()       # 'success' / 'failure' of payment attempts
+            self.failcodes = Counter()
+            self.erring_nodes = Counter()
+
+    def observe(self, phase: str, seconds: float):
+        with self.lock:
+            self.phases[phase].observe(seconds)
+
+    @contextlib.contextmanager
+    def timed(self, phase: str):
+        """ Times the block, an exception counts as an error of the phase """
+        start = time.time()
+        try:
+            yield
+        except BaseException:
+            self.error(phase)
+            raise
+        finally:
+            self.observe(phase, time.time() - start)
+
+    def error(self, phase: str):
+        with self.lock:
+            self.errors[phase] += 1
+
+    def result(self, status: str):
+        with self.lock:
+            self.results[status] += 1
+
+    def attempt(self, error_data: dict = None):
+        """ Counts a payment attempt, `error_data` is the `data` of a failure """
+        with self.lock:
+            if error_data is None:
+                self.attempts["success"] += 1
+                return
+            self.attempts["failure"] += 1
+            failcode = error_data.get("failcodename") or error_data.get("failcode")
+            if failcode is not None:
+                self.failcodes[str(failcode)] += 1
+            if error_data.get("erring_node") is not None:
+                self.erring_nodes[error_data["erring_node"]] += 1
+
+    def report(self, top: int = 10):
+        with self.lock:
+            return {
+                "since": int(self.since),
+                "rebalances": dict(self.results),
+                "attempts": dict(self.attempts),
+                "errors": dict(self.errors),
+                "failcodes": dict(self.failcodes.most_common()),
+                "erring_nodes": dict(self.erring_nodes.most_common(top)),
+                "phases": {phase: h.report() for phase, h in self.phases.items()},
+            }
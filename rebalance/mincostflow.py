@@ -0,0 +1,278 @@
+import collections
+import heapq
+
+
+class FlowNetwork(object):
+    """ Min-cost flow by successive shortest paths with node potentials.
+
+    Arc costs may be negative as long as the network has no negative
+    cycles; initial potentials come from a Bellman-Ford pass. `solve`
+    augments along cheapest paths as long as they have a negative cost,
+    i.e. it finds the flow amount with the minimal total cost.
+    """
+    def __init__(self):
+        self.arcs = []      # [head, capacity, cost, reverse arc index]
+        self.outgoing = {}  # node -> list of arc indexes
+
+    def add_arc(self, tail, head, capacity: int, cost: int):
+        self.outgoing.setdefault(tail, []).append(len(self.arcs))
+        self.arcs.append([head, capacity, cost, len(self.arcs) + 1])
+        self.outgoing.setdefault(head, []).append(len(self.arcs))
+        self.arcs.append([tail, 0, -cost, len(self.arcs) - 1])
+        return len(self.arcs) - 2
+
+    def flow(self, arc: int):
+        # the residual capacity of the reverse arc is the flow
+        return self.arcs[self.arcs[arc][3]][1]
+
+    def push(self, arc: int, amount: int):
+        """ Sends `amount` more along a residual arc, negative amounts take it back """
+        self.arcs[arc][1] -= amount
+        self.arcs[self.arcs[arc][3]][1] += amount
+
+    def tail(self, arc: int):
+        return self.arcs[self.arcs[arc][3]][0]
+
+    def potentials(self):
+        """ Potentials that give every residual arc a non-negative reduced
+            cost, the network must not have a negative cycle.
+        """
+        # Bellman-Ford from all nodes at once, relaxing only from nodes that changed
+        dist = dict.fromkeys(self.outgoing, 0)
+        queue = collections.deque(self.outgoing)
+        queued = set(queue)
+        while queue:
+            tail = queue.popleft()
+            queued.discard(tail)
+            for i in self.outgoing[tail]:
+                head, capacity, cost, _ = self.arcs[i]
+                if capacity > 0 and dist[tail] + cost < dist[head]:
+                    dist[head] = dist[tail] + cost
+                    if head not in queued:
+                        queue.append(head)
+                        queued.add(head)
+        return dist
+
+    def _bellman_ford(self, source):
+        dist = {source: 0}
+        for _ in range(len(self.outgoing)):
+            changed = False
+            for tail, indexes in self.outgoing.items():
+                if tail not in dist:
+                    continue
+                for i in indexes:
+                    head, capacity, cost, _ = self.arcs[i]
+                    if capacity > 0 and dist[tail] + cost < dist.get(head, dist[tail] + cost + 1):
+                        dist[head] = dist[tail] + cost
+                        changed = True
+            if not changed:
+                break
+        return dist
+
+    def _dijkstra(self, source, potential: dict, target=None):
+        """ Reduced cost distances from `source`, settled up to `target` """
+        dist = {source: 0}
+        prev = {}
+        heap = [(0, 0, source)]
+        counter = 0
+        while heap:
+            d, _, node = heapq.heappop(heap)
+            if d > dist[node]:
+                continue
+            if node == target:
+                break
+            for i in self.outgoing.get(node, []):
+                head, capacity, cost, _ = self.arcs[i]
+                if capacity <= 0 or head not in potential:
+                    continue
+                nd = d + cost + potential[node] - potential[head]
+                if nd < dist.get(head, nd + 1):
+                    dist[head] = nd
+                    prev[head] = i
+                    counter += 1
+                    heapq.heappush(heap, (nd, counter, head))
+        return dist, prev
+
+    def solve(self, source, sink):
+        """ Returns (total flow, total cost) """
+        potential = self._bellman_ford(source)
+        total_flow = total_cost = 0
+        while True:
+            dist, prev = self._dijkstra(source, potential, sink)
+            if sink not in dist:
+                break
+            # nodes beyond the sink weren't settled, they move as far as the sink
+            for node in potential:
+                potential[node] += min(dist.get(node, dist[sink]), dist[sink])
+            path_cost = potential[sink] - potential[source]
+            if path_cost >= 0:
+                break
+            # bottleneck along the path
+            amount = None
+            node = sink
+            while node != source:
+                arc = self.arcs[prev[node]]
+                amount = arc[1] if amount is None else min(amount, arc[1])
+                node = self.arcs[arc[3]][0]
+            node = sink
+            while node != source:
+                arc = self.arcs[prev[node]]
+                arc[1] -= amount
+                self.arcs[arc[3]][1] += amount
+                node = self.arcs[arc[3]][0]
+            total_flow += amount
+            total_cost += amount * path_cost
+        return total_flow, total_cost
+
+
+def min_cost_transfers(senders: dict, receivers: dict, arc_cost):
+    """ Cheapest set of transfers from senders to receivers.
+
+    `senders` and `receivers` map a key to a list of (amount, cost) tiers,
+    negative tier costs are the benefit of moving that amount. `arc_cost`
+    gives the cost per unit between a sender and a receiver, or None if
+    the transfer is not possible. Returns {(sender, receiver): amount}.
+    """
+    network = FlowNetwork()
+    for key, tiers in senders.items():
+        for amount, cost in tiers:
+            if amount > 0:
+                network.add_arc("source", ("out", key), amount, cost)
+    for key, tiers in receivers.items():
+        for amount, cost in tiers:
+            if amount > 0:
+                network.add_arc(("in", key), "sink", amount, cost)
+    arcs = {}
+    total = sum(amount for tiers in senders.values() for amount, _ in tiers)
+    for s in senders:
+        for r in receivers:
+            cost = arc_cost(s, r)
+            if cost is not None:
+                arcs[(s, r)] = network.add_arc(("out", s), ("in", r), total, cost)
+    network.solve("source", "sink")
+    return {key: network.flow(arc) for key, arc in arcs.items() if network.flow(arc) > 0}
+
+
+class TransferPlan(object):
+    """ `min_cost_transfers` that can be updated while it is executed.
+
+    The flow network is kept as a circulation: the flow returns from the
+    sink to the source over an arc of cost 0. Node potentials keep every
+    residual arc at a non-negative reduced cost, which proves the flow
+    optimal. When the tiers of a sender or receiver change, or a transfer
+    is not possible anymore, only their arcs change: flow that breaks the
+    potentials is moved, and the nodes left with too much or too little
+    flow are evened out along shortest paths, like `FlowNetwork.solve`
+    does, without solving everything from scratch.
+    """
+    UNLIMITED = 2**62
+
+    def __init__(self, senders: dict, receivers: dict, arc_cost):
+        self.network = FlowNetwork()
+        self.tiers = {}   # ("out", sender) or ("in", receiver) -> tier arcs
+        self.pairs = {}   # (sender, receiver) -> transfer arc
+        # tiers without an amount get an arc too, they may grow later
+        for key, tiers in senders.items():
+            self.tiers[("out", key)] = [self.network.add_arc("source", ("out", key), max(amount, 0), cost)
+                                        for amount, cost in tiers]
+        for key, tiers in receivers.items():
+            self.tiers[("in", key)] = [self.network.add_arc(("in", key), "sink", max(amount, 0), cost)
+                                       for amount, cost in tiers]
+        for s in senders:
+            for r in receivers:
+                cost = arc_cost(s, r)
+                if cost is not None:
+                    self.pairs[(s, r)] = self.network.add_arc(("out", s), ("in", r), self.UNLIMITED, cost)
+        flow, _ = self.network.solve("source", "sink")
+        self.back = self.network.add_arc("sink", "source", self.UNLIMITED, 0)
+        self.network.push(self.back, flow)
+        self.potential = self.network.potentials()
+        self.excess = {}  # node -> flow in minus flow out, while it is repaired
+
+    def transfers(self):
+        """ {(sender, receiver): amount} """
+        flows = {pair: self.network.flow(arc) for pair, arc in self.pairs.items()}
+        return {pair: flow for pair, flow in flows.items() if flow > 0}
+
+    def _set_capacity(self, arc: int, capacity: int):
+        tail = self.network.tail(arc)
+        head, _, cost, _ = self.network.arcs[arc]
+        flow = self.network.flow(arc)
+        # arcs with a negative reduced cost stay saturated, all others keep what still fits
+        if cost + self.potential[tail] - self.potential[head] < 0:
+            new_flow = capacity
+        else:
+            new_flow = min(flow, capacity)
+        self.network.arcs[arc][1] = capacity - flow
+        self.network.push(arc, new_flow - flow)
+        self.excess[tail] = self.excess.get(tail, 0) - (new_flow - flow)
+        self.excess[head] = self.excess.get(head, 0) + (new_flow - flow)
+
+    def _repair(self):
+        """ Sends the excess flow of nodes to the nodes lacking it along
+            shortest paths, which keeps the potentials valid.
+        """
+        arcs = self.network.arcs
+        while True:
+            sources = [node for node, excess in self.excess.items() if excess > 0]
+            if len(sources) == 0:
+                break
+            dist = dict.fromkeys(sources, 0)
+            prev = {}
+            heap = [(0, i, node) for i, node in enumerate(sources)]
+            counter = len(heap)
+            target = None
+            while heap:
+                d, _, node = heapq.heappop(heap)
+                if d > dist[node]:
+                    continue
+                if self.excess.get(node, 0) < 0:
+                    target = node
+                    break
+                for i in self.network.outgoing[node]:
+                    head, capacity, cost, _ = arcs[i]
+                    if capacity <= 0:
+                        continue
+                    nd = d + cost + self.potential[node] - self.potential[head]
+                    if nd < dist.get(head, nd + 1):
+                        dist[head] = nd
+                        prev[head] = i
+                        counter += 1
+                        heapq.heappush(heap, (nd, counter, head))
+            # a zero flow is always possible, so there is a path
+            assert target is not None
+            for node in self.potential:
+                self.potential[node] += min(dist.get(node, dist[target]), dist[target])
+            path = []
+            node = target
+            while node in prev:
+                path.append(prev[node])
+                node = self.network.tail(prev[node])
+            amount = min([self.excess[node], -self.excess[target]] + [arcs[i][1] for i in path])
+            for i in path:
+                self.network.push(i, amount)
+            self.excess[node] -= amount
+            self.excess[target] += amount
+        self.excess = {}
+
+    def _set_tiers(self, node, tiers: list):
+        for arc, (amount, _) in zip(self.tiers[node], tiers):
+            self._set_capacity(arc, max(amount, 0))
+
+    def update(self, tiers: dict):
+        """ New tier amounts, {key: (sender tiers, receiver tiers)}, either
+            may be None. The tier costs stay the same.
+        """
+        for key, (sender_tiers, receiver_tiers) in tiers.items():
+            if sender_tiers is not None and ("out", key) in self.tiers:
+                self._set_tiers(("out", key), sender_tiers)
+            if receiver_tiers is not None and ("in", key) in self.tiers:
+                self._set_tiers(("in", key), receiver_tiers)
+        self._repair()
+
+    def remove(self, sender, receiver):
+        """ The transfer is not possible anymore """
+        if (sender, receiver) not in self.pairs:
+            return
+        self._set_capacity(self.pairs.pop((sender, receiver)), 0)
+        self._repair()
@@ -0,0 +1,125 @@
+import json
+import math
+import threading
+import time
+
+
+# BOLT #4 failure codes that tell something about a channel
+WIRE_TEMPORARY_CHANNEL_FAILURE = 0x1007
+WIRE_CHANNEL_DISABLED = 0x1014
+WIRE_PERMANENT_CHANNEL_FAILURE = 0x4008
+WIRE_UNKNOWN_NEXT_PEER = 0x400a
+
+# assumed upper liquidity bound for channels with unknown capacity
+MAX_LIQUIDITY = 10**12
+
+
+class MissionControl(object):
+    """ Learned liquidity bounds per channel direction ("scid/direction").
+
+    A success of amount `a` proves the channel can forward at least `a`
+    (lower bound), a liquidity failure proves it cannot forward `a` (upper
+    bound). Bounds decay back to 'unknown' with the given half-life. Within
+    the bounds liquidity is assumed to be uniformly distributed, which gives
+    the success probability of an amount.
+    """
+    def __init__(self, halflife: float = 3600):
+        self.lock = threading.Lock()
+        self.halflife = halflife
+        self.channels = {}  # "scid/direction" -> {"lower", "upper", "capacity", "time"}
+
+    def __len__(self):
+        return len(self.channels)
+
+    def _bounds(self, entry, now: float):
+        factor = 0.5 ** (max(now - entry["time"], 0) / self.halflife)
+        lower = entry["lower"] * factor
+        if entry.get("capacity"):
+            upper = entry["capacity"] - (entry["capacity"] - entry["upper"]) * factor
+        else:
+            # without a capacity the upper bound doubles every half-life
+            upper = min(max(entry["upper"], 1) / factor, MAX_LIQUIDITY)
+        return round(lower), round(upper)
+
+    def _update(self, key: str, capacity: int, lower=None, upper=None):
+        now = time.time()
+        with self.lock:
+            entry = self.channels.get(key)
+            if entry is None:
+                entry = {"lower": 0, "upper": capacity or MAX_LIQUIDITY, "capacity": capacity, "time": now}
+            old_lower, old_upper = self._bounds(entry, now)
+            if lower is not None:
+                old_lower = max(old_lower, lower)
+                # newer knowledge wins over contradicting old one
+                if old_upper <= old_lower:
+                    old_upper = entry.get("capacity") or MAX_LIQUIDITY
+            if upper is not None:
+                old_upper = min(old_upper, upper)
+                if old_lower >= old_upper:
+                    old_lower = 0
+            self.channels[key] = {"lower": int(old_lower), "upper": int(old_upper),
+                                  "capacity": capacity or entry.get("capacity"), "time": now}
+
+    def success(self, key: str, amount: int, capacity: int = None):
+        self._update(key, capacity, lower=int(amount))
+
+    def failure(self, key: str, amount: int, capacity: int = None):
+        self._update(key, capacity, upper=int(amount))
+
+    def learn_success(self, route: list, amounts: list, capacities: list):
+        """ Learn from a payment along `route` (hop dicts with 'channel' and
+            'direction'), `amounts` and `capacities` are given per hop.
+        """
+        for i in range(len(route)):
+            self.success(f"{route[i]['channel']}/{route[i]['direction']}", amounts[i], capacities[i])
+
+    def learn_failure(self, route: list, amounts: list, capacities: list, erring_index: int, failcode: int):
+        self.learn_success(route[:erring_index], amounts, capacities)
+        if erring_index >= len(route):
+            return
+        key = f"{route[erring_index]['channel']}/{route[erring_index]['direction']}"
+        if failcode == WIRE_TEMPORARY_CHANNEL_FAILURE:
+            self.failure(key, amounts[erring_index], capacities[erring_index])
+        elif failcode in (WIRE_CHANNEL_DISABLED, WIRE_PERMANENT_CHANNEL_FAILURE, WIRE_UNKNOWN_NEXT_PEER):
+            self.failure(key, 0, capacities[erring_index])
+
+    def probability(self, key: str, amount: int, capacity: int = None):
+        entry = self.channels.get(key)
+        if entry is None:
+            if capacity:
+                return max(capacity - amount, 0) / capacity
+            return 1.0
+        lower, upper = self._bounds(entry, time.time())
+        if amount <= lower:
+            return 1.0
+        if amount >= upper:
+            return 0.0
+        return (upper - amount) / (upper - lower)
+
+    def penalty(self, key: str, amount: int, capacity: int = None,
+                base: int = 1000, ppm: int = 1000):
+        """ Cost in msat added to a channel's weight: scales with -log(p) """
+        p = self.probability(key, amount, capacity)
+        return -math.log(max(p, 1e-9)) * (base + amount * ppm // 10**6)
+
+    def unlikely(self, amount: int, threshold: float = 0.01):
+        """ Channel directions that most likely fail for `amount` """
+        with self.lock:
+            keys = list(self.channels.keys())
+        return [k for k in keys if self.probability(k, amount) < threshold]
+
+    def prune(self):
+        # forget entries whose knowledge has decayed to nearly nothing
+        now = time.time()
+        with self.lock:
+            self.channels = {k: e for k, e in self.channels.items()
+                             if now - e["time"] < self.halflife * 10}
+
+    def dumps(self):
+        self.prune()
+        with self.lock:
+            return json.dumps(self.channels)
+
+    def loads(self, string: str):
+        with self.lock:
+            self.channels = json.loads(string)
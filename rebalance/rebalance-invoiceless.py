@@ -0,0 +1,15 @@
+#!/usr/bin/env python3
+""" The rebalance plugin with invoice-less self-payments.
+
+Load this file instead of rebalance.py. The plugin then holds the
+preimages of its circular payments itself and settles them in its
+`htlc_accepted` hook. Every HTLC the node receives passes that hook, so
+the plain plugin does not register it.
+"""
+from rebalance import plugin, on_htlc_accepted
+
+plugin.invoiceless = True
+plugin.add_hook("htlc_accepted", on_htlc_accepted, background=True)
+
+if __name__ == "__main__":
+    plugin.run()
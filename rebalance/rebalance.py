@@ -1,18 +1,50 @@
 #!/usr/bin/env python3
 from clnutils import cln_parse_rpcversion
+from failurebackoff import FailureBackoff
 from datetime import timedelta
 from functools import reduce
 from pyln.client import Plugin, Millisatoshi, RpcError
+from htlctracker import HtlcTracker
+from metrics import RebalanceMetrics
+from mincostflow import TransferPlan
+from missioncontrol import MissionControl
+from reportindex import ReportIndex
+from routegraph import ChannelGraph
+from routesearch import RouteSearch, ThreadStats
+from scheduler import PairScheduler
+from sendpayengine import SendpayEngine
+from ttlcache import TTLCache
 import threading
 import time
 import uuid
 import concurrent.futures
+import hashlib
+import secrets
 
 plugin = Plugin()
 plugin.rebalance_stop_by_user = False
 plugin.rebalance_stop_by_thread = False
 plugin.rebalance_stop_by_event = False
 plugin.threadids = {}
+plugin.graph = ChannelGraph()
+plugin.thread_stats = ThreadStats()
+plugin.metrics = RebalanceMetrics()
+# fee policies by "scid/direction" and aliases by node_id, see `get_policy`
+plugin.policies = TTLCache(300)
+plugin.aliases = TTLCache(300)
+plugin.htlcs = HtlcTracker()
+plugin.mc = MissionControl()
+plugin.mc_saved_at = 0
+plugin.failures = FailureBackoff()
+plugin.report = ReportIndex()
+plugin.report_lock = threading.Lock()
+plugin.report_saved_at = 0
+plugin.report_timer = None
+plugin.invoiceless = False  # set by rebalance-invoiceless.py, which also registers `on_htlc_accepted`
+plugin.preimages = {}     # payment_hash -> self-payment held by the plugin instead of an invoice
+plugin.preimages_lock = threading.Lock()
+plugin.plan = None        # plan of a running `rebalanceplan`, forwards update it
+plugin.channel_peers = {}  # scid -> peer_id of our channels, to list just that peer's channels
 
 
 def rebalance_stopping():
@@ -26,6 +58,13 @@ def get_thread_id_str():
     return f"{plugin.threadids.get(threading.get_ident(), 0):{'0' + str(max_digits)}}"
 
 
+def get_thread_name():
+    # rebalance threads are numbered, direct `rebalance` calls are not
+    if threading.get_ident() in plugin.threadids:
+        return f"thread{get_thread_id_str()}"
+    return "rebalance"
+
+
 # The route msat helpers are needed because older versions of cln
 # had different msat/msatoshi fields with different types Millisatoshi/int
 def route_set_msat(obj, msat):
@@ -40,18 +79,47 @@ def route_get_msat(r):
     return Millisatoshi(r[plugin.msatfield])
 
 
+def get_policy(scid: str, direction: int):
+    key = f"{scid}/{direction}"
+    policy = plugin.policies.get(key)
+    if policy is not None:
+        return policy
+    edge = plugin.graph.get(scid, direction)
+    if edge is not None:
+        policy = {'destination': edge['destination'],
+                  'fee_base': Millisatoshi(edge['base_fee']),
+                  'fee_ppm': edge['ppm'],
+                  'delay': edge['delay'],
+                  'capacity': edge['capacity']}
+        plugin.policies.put(key, policy)
+        return policy
+    # one `listchannels` call caches both directions of the channel
+    for ch in plugin.rpc.listchannels(scid).get('channels'):
+        p = {'destination': ch['destination'],
+             'fee_base': Millisatoshi(ch['base_fee_millisatoshi']),
+             'fee_ppm': ch['fee_per_millionth'],
+             'delay': ch['delay'],
+             'capacity': int(Millisatoshi(ch['amount_msat']))}
+        d = ch.get('direction', int(ch['source'] > ch['destination']))
+        plugin.policies.put(f"{scid}/{d}", p)
+        if d == direction:
+            policy = p
+    if policy is None:
+        raise RpcError("rebalance", {'channel': key}, {'message': 'Cannot find fee policy for channel: ' + key})
+    return policy
+
+
 def setup_routing_fees(route, msat):
     delay = plugin.cltv_final
     for r in reversed(route):
         route_set_msat(r, msat)
         r['delay'] = delay
-        channels = plugin.rpc.listchannels(r['channel'])
-        ch = next(c for c in channels.get('channels') if c['destination'] == r['id'])
-        fee = Millisatoshi(ch['base_fee_millisatoshi'])
+        policy = get_policy(r['channel'], r['direction'])
+        fee = policy['fee_base']
         # BOLT #7 requires fee >= fee_base_msat + ( amount_to_forward * fee_proportional_millionths / 1000000 )
-        fee += (msat * ch['fee_per_millionth'] + 10**6 - 1) // 10**6  # integer math trick to round up
+        fee += (msat * policy['fee_ppm'] + 10**6 - 1) // 10**6  # integer math trick to round up
         msat += fee
-        delay += ch['delay']
+        delay += policy['delay']
 
 
 def get_channel(payload, peer_id, scid, check_state: bool = False):
@@ -91,13 +159,16 @@ def peer_from_scid(short_channel_id, my_node_id, payload):
 
 
 def get_node_alias(node_id):
+    alias = plugin.aliases.get(node_id)
+    if alias is not None:
+        return alias
     node = plugin.rpc.listnodes(node_id)['nodes']
-    s = ""
     if len(node) != 0 and 'alias' in node[0]:
-        s += node[0]['alias']
+        alias = node[0]['alias']
     else:
-        s += node_id[0:7]
-    return s
+        alias = node_id[0:7]
+    plugin.aliases.put(node_id, alias)
+    return alias
 
 
 def find_worst_channel(route):
@@ -114,13 +185,94 @@ def find_worst_channel(route):
     return worst
 
 
-def cleanup(label, payload, rpc_result, error=None):
+def load_mission_control():
+    try:
+        data = plugin.rpc.listdatastore(['rebalance', 'missioncontrol'])['datastore']
+    except RpcError as e:
+        plugin.log(f"Could not load mission control: {e}", 'debug')
+        return
+    if len(data) > 0 and 'string' in data[0]:
+        plugin.mc.loads(data[0]['string'])
+
+
+def save_mission_control(force: bool = False):
+    # at most once a minute, rebalanceall forces it at the end of a run
+    if not force and time.time() - plugin.mc_saved_at < 60:
+        return
+    plugin.mc_saved_at = time.time()
+    try:
+        plugin.rpc.datastore(['rebalance', 'missioncontrol'], string=plugin.mc.dumps(),
+                             mode='create-or-replace')
+    except RpcError as e:
+        plugin.log(f"Could not save mission control: {e}", 'debug')
+
+
+def load_failures():
     try:
-        plugin.rpc.delinvoice(label, 'unpaid')
+        data = plugin.rpc.listdatastore(['rebalance', 'failures'])['datastore']
     except RpcError as e:
-        # race condition: waitsendpay timed out, but invoice get paid
-        if 'status is paid' in e.error.get('message', ""):
+        plugin.log(f"Could not load failed pairs: {e}", 'debug')
+        return
+    if len(data) > 0 and 'string' in data[0]:
+        plugin.failures.loads(data[0]['string'])
+
+
+def save_failures():
+    # known-bad pairs are skipped by the next run until their backoff expires
+    try:
+        plugin.rpc.datastore(['rebalance', 'failures'], string=plugin.failures.dumps(),
+                             mode='create-or-replace')
+    except RpcError as e:
+        plugin.log(f"Could not save failed pairs: {e}", 'debug')
+
+
+def create_payment(msatoshi: Millisatoshi, label: str, description: str, expiry: int):
+    """ Returns payment_hash and payment_secret of a new invoice, or of a
+        preimage the plugin holds itself with rebalance-invoiceless.py.
+    """
+    if not plugin.invoiceless:
+        invoice = plugin.rpc.invoice(msatoshi, label, description, expiry)
+        # The requirement for payment_secret coincided with its addition to the invoice output.
+        return invoice['payment_hash'], invoice.get('payment_secret')
+    preimage = secrets.token_bytes(32)
+    payment_hash = hashlib.sha256(preimage).hexdigest()
+    with plugin.preimages_lock:
+        plugin.preimages[payment_hash] = {
+            "label": label,
+            "preimage": preimage.hex(),
+            "msatoshi": int(msatoshi),
+            "held": [],          # (request, amount) of HTLC parts waiting for the rest
+            "settled": False,
+        }
+    return payment_hash, secrets.token_hex(32)
+
+
+def drop_payment(label: str):
+    """ Forgets a self-payment, returns True if it was settled already """
+    with plugin.preimages_lock:
+        payment_hash = next((h for h, p in plugin.preimages.items() if p["label"] == label), None)
+        if payment_hash is None:
+            return False
+        payment = plugin.preimages.pop(payment_hash)
+        # incomplete multi-part payments are failed back like lightningd would
+        for request, _ in payment["held"]:
+            request.set_result({"result": "fail", "failure_message": "0017"})  # mpp_timeout
+        return payment["settled"]
+
+
+def cleanup(label, payload, rpc_result, error=None):
+    save_mission_control()
+    if plugin.invoiceless:
+        # race condition: waitsendpay timed out, but the payment got settled
+        if drop_payment(label):
             return rpc_result
+    else:
+        try:
+            plugin.rpc.delinvoice(label, 'unpaid')
+        except RpcError as e:
+            # race condition: waitsendpay timed out, but invoice get paid
+            if 'status is paid' in e.error.get('message', ""):
+                return rpc_result
 
     if error is not None:
         if isinstance(error, RpcError):
@@ -182,7 +334,7 @@ class NoRouteException(Exception):
     pass
 
 
-def getroute_basic(targetid, fromid, excludes, amount_msat: Millisatoshi):
+def getroute_basic(search: RouteSearch, targetid, fromid, excludes, amount_msat: Millisatoshi):
     try:
         """ This does not make special assumptions and tries all routes
             it gets. Uses less CPU and does not filter any routes.
@@ -200,7 +352,7 @@ def getroute_basic(targetid, fromid, excludes, amount_msat: Millisatoshi):
         raise e
 
 
-def getroute_iterative(targetid, fromid, excludes, amount_msat: Millisatoshi):
+def getroute_iterative(search: RouteSearch, targetid, fromid, excludes, amount_msat: Millisatoshi):
     """ This searches for 'shorter and bigger pipes' first in order
         to increase likelyhood of success on short timeout.
         Can be useful for manual `rebalance`.
@@ -209,61 +361,250 @@ def getroute_iterative(targetid, fromid, excludes, amount_msat: Millisatoshi):
         return plugin.rpc.getroute(targetid,
                                    fromid=fromid,
                                    exclude=excludes,
-                                   amount_msat=amount_msat * plugin.msatfactoridx,
-                                   maxhops=plugin.maxhopidx,
+                                   amount_msat=amount_msat * search.msatfactoridx,
+                                   maxhops=search.maxhopidx,
                                    riskfactor=10, cltv=9)
     except RpcError as e:
         # could not find route -> change params and restart loop
         if e.method == "getroute" and e.error.get('code') == 205:
-            # reduce _msatfactor to look for smaller channels now
-            plugin.msatfactoridx -= 1
-            if plugin.msatfactoridx < 1:
-                # when we reached neutral msat factor:
-                # increase _maxhops and restart with msatfactor
-                plugin.maxhopidx += 1
-                plugin.msatfactoridx = plugin.msatfactor
             # abort if we reached maxhop limit
-            if plugin.maxhops > 0 and plugin.maxhopidx > plugin.maxhops:
+            if not search.widen():
                 raise NoRouteException
         raise e
 
 
+def refresh_graph():
+    with plugin.graph.lock:
+        if time.time() - plugin.graph.loaded_at < plugin.graph_refresh:
+            return
+        plugin.graph.load(plugin.rpc.listchannels()['channels'])
+        plugin.policies.clear()
+    plugin.log(f"Loaded channel graph with {len(plugin.graph)} channel directions", 'debug')
+
+
+def gossip_update(scid):
+    # drop cached fee policies, the channel_update may have changed them
+    plugin.policies.invalidate(f"{scid}/0")
+    plugin.policies.invalidate(f"{scid}/1")
+    # only keep the graph current if the local route search uses it
+    if plugin.graph.loaded_at == 0:
+        return
+    plugin.graph.update(plugin.rpc.listchannels(scid)['channels'])
+
+
+def mission_control_weight(edge, amount: int):
+    # prefer channels with a high success probability
+    key = f"{edge['scid']}/{edge['direction']}"
+    return plugin.graph.weight(edge, amount) + plugin.mc.penalty(key, amount, edge['capacity'])
+
+
+def getroute_local(search: RouteSearch, targetid, fromid, excludes, amount_msat: Millisatoshi):
+    """ This enumerates the k-shortest routes on the plugins own channel
+        graph, cheapest first, without `getroute` round trips.
+    """
+    refresh_graph()
+    maxhops = plugin.maxhops if plugin.maxhops > 0 else 20
+    key = (fromid, targetid, int(amount_msat))
+    if key not in search.routes:
+        search.routes[key] = plugin.graph.k_shortest_routes(fromid, targetid, int(amount_msat),
+                                                            maxhops, excludes, mission_control_weight)
+    route = next(search.routes[key], None)
+    if route is None:
+        raise NoRouteException
+    return {'route': [{'id': e['destination'], 'channel': e['scid'],
+                       'direction': e['direction'], 'style': 'tlv'} for e in route]}
+
+
 def getroute_switch(method_name):
     switch = {
         "basic": getroute_basic,
-        "iterative": getroute_iterative
+        "iterative": getroute_iterative,
+        "local": getroute_local
     }
     return switch.get(method_name, getroute_iterative)
 
 
-def waitsendpay(payment_hash, start_ts, retry_for):
+def sendpay(route: list, payment_hash, scids: list, **kwargs):
+    """ Starts a sendpay attempt on the engine, returns its future """
+    times = {"start": time.time()}
+
+    def sent(result):
+        times["sent"] = time.time()
+        plugin.metrics.observe("sendpay", times["sent"] - times["start"])
+        plugin.htlcs.offered(("sendpay", result.get('id')), scids)
+
+    def resolved(future):
+        error = future.exception()
+        if "sent" in times:
+            plugin.metrics.observe("waitsendpay", time.time() - times["sent"])
+        if error is not None:
+            plugin.metrics.error("waitsendpay" if "sent" in times else "sendpay")
+        if isinstance(error, RpcError):
+            plugin.metrics.attempt(error.error.get('data', {}))
+        elif error is None:
+            plugin.metrics.attempt()
+
+    future = plugin.engine.submit(route, payment_hash, sent=sent, **kwargs)
+    future.add_done_callback(resolved)
+    return future
+
+
+def waitsendpay(future, start_ts, retry_for):
     while True:
+        timeout = min(max(retry_for + start_ts - int(time.time()), 0), 10)
         try:
-            timeout = min(max(retry_for + start_ts - int(time.time()), 0), 10)
-            result = plugin.rpc.waitsendpay(payment_hash, timeout)
-            return result
-        except RpcError as e:
-            if e.method == "waitsendpay" and e.error.get('code') == 200:
-                if rebalance_stopping():
-                    raise e
-                if int(time.time()) - start_ts >= retry_for:
-                    raise e
-            else:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            if rebalance_stopping() or int(time.time()) - start_ts >= retry_for:
+                raise RpcError("waitsendpay", {}, {'code': 200, 'message': 'Timed out while waiting'})
+
+
+def learn_from_route(route: list, error: RpcError = None):
+    amounts = [int(route_get_msat(r)) for r in route]
+    capacities = [get_policy(r['channel'], r['direction'])['capacity'] for r in route]
+    if error is None:
+        plugin.mc.learn_success(route, amounts, capacities)
+        return
+    erring_index = error.error.get('data', {}).get('erring_index')
+    if erring_index is not None:
+        plugin.mc.learn_failure(route, amounts, capacities, erring_index,
+                                error.error.get('data', {}).get('failcode'))
+
+
+def handle_sendpay_error(e: RpcError, route: list, payload, excludes: list, nodes: dict):
+    outgoing_scid = route[0]['channel']
+    incoming_scid = route[-1]['channel']
+    learn_from_route(route, e)
+    # check if we have problems with our own channels
+    erring_node = e.error.get('data', {}).get('erring_node')
+    erring_channel = e.error.get('data', {}).get('erring_channel')
+    erring_direction = e.error.get('data', {}).get('erring_direction')
+    if erring_channel == incoming_scid:
+        raise RpcError("rebalance", payload, {'message': 'Error with incoming channel'})
+    if erring_channel == outgoing_scid:
+        raise RpcError("rebalance", payload, {'message': 'Error with outgoing channel'})
+    # failures usually carry a channel_update, pick it up
+    if erring_channel is not None:
+        gossip_update(erring_channel)
+    # exclude other erroring channels
+    if erring_channel is not None and erring_direction is not None:
+        excludes.append(erring_channel + '/' + str(erring_direction))
+    # count and exclude nodes that produce a lot of errors
+    if erring_node and plugin.erringnodes > 0:
+        if nodes.get(erring_node) is None:
+            nodes[erring_node] = 0
+        nodes[erring_node] += 1
+        if nodes[erring_node] >= plugin.erringnodes:
+            excludes.append(erring_node)
+
+
+def split_amount(msatoshi: Millisatoshi, parts: int):
+    part = Millisatoshi(int(msatoshi) // parts)
+    return [part] * (parts - 1) + [msatoshi - part * (parts - 1)]
+
+
+def send_parts(payload, route_out, route_in, incoming_node_id, msatoshi: Millisatoshi, parts: int,
+               payment_hash, payment_secret, excludes: list, nodes: dict, getroute, search: RouteSearch,
+               start_ts, retry_for, maxfeepercent, exemptfee: Millisatoshi):
+    """ Pays the rebalance invoice with `parts` circular routes in parallel.
+
+    Parts in flight block each others middle channels, so every part takes
+    different middle hops. Each part has to meet `maxfeepercent` on its own,
+    `exemptfee` is shared proportionally.
+    """
+    todo = split_amount(msatoshi, parts)
+    inflight = {}   # partid -> (route, future, sent at)
+    done = []       # routes of completed parts
+    partid = 0
+    while len(todo) > 0 or len(inflight) > 0:
+        if int(time.time()) - start_ts >= retry_for or rebalance_stopping():
+            raise RpcError("rebalance", payload, {'message': 'Timeout reached'})
+        while len(todo) > 0:
+            amount = todo[0]
+            busy = [f"{r['channel']}/{r['direction']}" for route, _, _ in inflight.values() for r in route[1:-1]]
+            try:
+                time_start = time.time()
+                with plugin.metrics.timed("getroute"):
+                    r = getroute(search,
+                                 targetid=incoming_node_id,
+                                 fromid=route_out['id'],
+                                 excludes=excludes + busy,
+                                 amount_msat=amount)
+                search.getroute_done(time_start)
+            except NoRouteException:
+                if len(inflight) == 0:
+                    raise RpcError("rebalance", payload, {'message': 'No suitable routes found'})
+                break
+            except RpcError as e:
+                if e.method == "getroute" and e.error.get('code') == 205:
+                    continue
                 raise e
+            route = [dict(route_out)] + r['route'] + [dict(route_in)]
+            with plugin.metrics.timed("fees"):
+                setup_routing_fees(route, amount)
+            fees = route_get_msat(route[0]) - amount
+            if fees > exemptfee * int(amount) // int(msatoshi) and int(fees) > int(amount) * maxfeepercent / 100:
+                plugin.metrics.error("fees")
+                worst_channel = find_worst_channel(route)
+                if worst_channel is None:
+                    raise RpcError("rebalance", payload, {'message': 'Insufficient fee'})
+                excludes.append(worst_channel['channel'] + '/' + str(worst_channel['direction']))
+                continue
+            partid += 1
+            future = sendpay(route, payment_hash, [route_out['channel'], route_in['channel']],
+                             payment_secret=payment_secret, partid=partid, amount_msat=msatoshi)
+            plugin.log(f"Thread{get_thread_id_str()} part {partid}: {len(route)} hops and {fees.to_satoshi_str()} fees for {amount.to_satoshi_str()}", 'debug')
+            inflight[partid] = (route, future, time.time())
+            todo.pop(0)
+
+        # our node holds the parts until all arrived, the engine resolves them
+        finished, _ = concurrent.futures.wait([f for _, f, _ in inflight.values()], timeout=1,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+        for pid, (route, future, time_start) in list(inflight.items()):
+            if future not in finished:
+                continue
+            del inflight[pid]
+            search.sendpay_done(time_start)
+            try:
+                future.result()
+            except RpcError as e:
+                handle_sendpay_error(e, route, payload, excludes, nodes)
+                todo.append(route_get_msat(route[-1]))
+                continue
+            learn_from_route(route)
+            done.append(route)
+    return done
 
 
-@plugin.method("rebalance")
-def rebalance(plugin, outgoing_scid, incoming_scid, msatoshi: Millisatoshi = None,
-              retry_for: int = 60, maxfeepercent: float = 0.5,
-              exemptfee: Millisatoshi = Millisatoshi(5000),
-              getroute_method=None):
+@plugin.async_method("rebalance")
+def rebalance_command(plugin, request, outgoing_scid, incoming_scid, msatoshi: Millisatoshi = None,
+                      retry_for: int = 60, maxfeepercent: float = 0.5,
+                      exemptfee: Millisatoshi = Millisatoshi(5000),
+                      getroute_method=None, parts: int = 1):
     """Rebalancing channel liquidity with circular payments.
 
     This tool helps to move some msatoshis between your channels.
+    With `parts` > 1 the amount is split over that many parallel routes.
     """
+    # runs in its own thread, so the plugin keeps receiving the sendpay
+    # notifications that resolve its attempts while it waits for them
+    def run():
+        try:
+            request.set_result(rebalance(plugin, outgoing_scid, incoming_scid, msatoshi, retry_for,
+                                         maxfeepercent, exemptfee, getroute_method, parts))
+        except Exception as e:
+            request.set_exception(e)
+    threading.Thread(target=run, daemon=True).start()
+
+
+def rebalance(plugin, outgoing_scid, incoming_scid, msatoshi: Millisatoshi = None,
+              retry_for: int = 60, maxfeepercent: float = 0.5,
+              exemptfee: Millisatoshi = Millisatoshi(5000),
+              getroute_method=None, parts: int = 1):
     if msatoshi:
         msatoshi = Millisatoshi(msatoshi)
     retry_for = int(retry_for)
+    parts = int(parts)
     maxfeepercent = float(maxfeepercent)
     if getroute_method is None:
         getroute = plugin.getroute
@@ -276,7 +617,8 @@ def rebalance(plugin, outgoing_scid, incoming_scid, msatoshi: Millisatoshi = Non
         "msatoshi": msatoshi,
         "retry_for": retry_for,
         "maxfeepercent": maxfeepercent,
-        "exemptfee": exemptfee
+        "exemptfee": exemptfee,
+        "parts": parts
     }
     my_node_id = plugin.getinfo.get('id')
     outgoing_node_id = peer_from_scid(outgoing_scid, my_node_id, payload)
@@ -302,39 +644,52 @@ def rebalance(plugin, outgoing_scid, incoming_scid, msatoshi: Millisatoshi = Non
     start_ts = int(time.time())
     label = "Rebalance-" + str(uuid.uuid4())
     description = "%s to %s" % (outgoing_scid, incoming_scid)
-    invoice = plugin.rpc.invoice(msatoshi, label, description, retry_for + 60)
-    payment_hash = invoice['payment_hash']
-    # The requirement for payment_secret coincided with its addition to the invoice output.
-    payment_secret = invoice.get('payment_secret')
+    payment_hash, payment_secret = create_payment(msatoshi, label, description, retry_for + 60)
 
     rpc_result = None
     excludes = [my_node_id]   # excude all own channels to prevent shortcuts
     nodes = {}                # here we store erring node counts
-    plugin.maxhopidx = 1      # start with short routes and increase
-    plugin.msatfactoridx = plugin.msatfactor  # start with high capacity factor
-    # and decrease to reduce WIRE_TEMPORARY failures because of imbalances
-
-    # 'disable' maxhops filter if set to <= 0
-    # I know this is ugly, but we don't ruin the rest of the code this way
-    if plugin.maxhops <= 0:
-        plugin.maxhopidx = 20
-
-    # trace stats
-    count = 0
-    count_sendpay = 0
-    time_getroute = 0
-    time_sendpay = 0
+    # skip channels that mission control knows to fail for this amount
+    excludes += [k for k in plugin.mc.unlikely(int(msatoshi))
+                 if k.split('/')[0] not in (outgoing_scid, incoming_scid)]
+    # route search state and trace stats of this request only
+    search = RouteSearch(plugin.maxhops, plugin.msatfactor)
 
     try:
+        if parts > 1:
+            if payment_secret is None:
+                raise RpcError("rebalance", payload, {'message': 'Multi-part rebalance needs a payment_secret'})
+            routes = send_parts(payload, route_out, route_in, incoming_node_id, msatoshi, parts,
+                                payment_hash, payment_secret, excludes, nodes, getroute, search,
+                                start_ts, retry_for, maxfeepercent, exemptfee)
+            fees = sum((route_get_msat(route[0]) for route in routes), Millisatoshi(0)) - msatoshi
+            hops = max(len(route) for route in routes)
+            rpc_result = {
+                "sent": msatoshi + fees,
+                "received": msatoshi,
+                "fee": fees,
+                "hops": hops,
+                "parts": len(routes),
+                "outgoing_scid": outgoing_scid,
+                "incoming_scid": incoming_scid,
+                "status": "complete",
+                "message": f"{msatoshi + fees} sent in {len(routes)} parts over up to {hops} hops to rebalance {msatoshi}",
+            }
+            plugin.log(f"Thread{get_thread_id_str()} {len(routes)} parts and {fees.to_satoshi_str()} fees for {msatoshi.to_satoshi_str()}")
+            search.success = True
+            rpc_result["stats"] = str(search)
+            return cleanup(label, payload, rpc_result)
+
         while int(time.time()) - start_ts < retry_for and not rebalance_stopping():
-            count += 1
             try:
                 time_start = time.time()
-                r = getroute(targetid=incoming_node_id,
-                             fromid=outgoing_node_id,
-                             excludes=excludes,
-                             amount_msat=msatoshi)
-                time_getroute += time.time() - time_start
+                with plugin.metrics.timed("getroute"):
+                    r = getroute(search,
+                                 targetid=incoming_node_id,
+                                 fromid=outgoing_node_id,
+                                 excludes=excludes,
+                                 amount_msat=msatoshi)
+                search.getroute_done(time_start)
             except NoRouteException:
                 # no more chance for a successful getroute
                 rpc_result = {'status': 'error', 'message': 'No suitable routes found'}
@@ -348,12 +703,14 @@ def rebalance(plugin, outgoing_scid, incoming_scid, msatoshi: Millisatoshi = Non
 
             route_mid = r['route']
             route = [route_out] + route_mid + [route_in]
-            setup_routing_fees(route, msatoshi)
+            with plugin.metrics.timed("fees"):
+                setup_routing_fees(route, msatoshi)
             fees = route_get_msat(route[0]) - msatoshi
 
             # check fee and exclude worst channel the next time
             # NOTE: the int(msat) casts are just a workaround for outdated pylightning versions
             if fees > exemptfee and int(fees) > int(msatoshi) * maxfeepercent / 100:
+                plugin.metrics.error("fees")
                 worst_channel = find_worst_channel(route)
                 if worst_channel is None:
                     raise RpcError("rebalance", payload, {'message': 'Insufficient fee'})
@@ -377,43 +734,31 @@ def rebalance(plugin, outgoing_scid, incoming_scid, msatoshi: Millisatoshi = Non
                 plugin.log("    - %s  %14s  %s" % (r['id'], r['channel'], route_get_msat(r)), 'debug')
 
             time_start = time.time()
-            count_sendpay += 1
             try:
-                plugin.rpc.sendpay(route, payment_hash, payment_secret=payment_secret)
-                result = waitsendpay(payment_hash, start_ts, retry_for)
-                time_sendpay += time.time() - time_start
+                future = sendpay(route, payment_hash, [outgoing_scid, incoming_scid], payment_secret=payment_secret)
+                result = waitsendpay(future, start_ts, retry_for)
+                search.sendpay_done(time_start)
                 if result.get('status') == "complete":
-                    rpc_result["stats"] = f"running_for:{int(time.time()) - start_ts}  count_getroute:{count}  time_getroute:{time_getroute}  time_getroute_avg:{time_getroute / count}  count_sendpay:{count_sendpay}  time_sendpay:{time_sendpay}  time_sendpay_avg:{time_sendpay / count_sendpay}"
+                    learn_from_route(route)
+                    search.success = True
+                    rpc_result["stats"] = str(search)
                     return cleanup(label, payload, rpc_result)
 
             except RpcError as e:
-                time_sendpay += time.time() - time_start
-                plugin.log(f"maxhops:{plugin.maxhopidx}  msatfactor:{plugin.msatfactoridx}  running_for:{int(time.time()) - start_ts}  count_getroute:{count}  time_getroute:{time_getroute}  time_getroute_avg:{time_getroute / count}  count_sendpay:{count_sendpay}  time_sendpay:{time_sendpay}  time_sendpay_avg:{time_sendpay / count_sendpay}", 'debug')
+                search.sendpay_done(time_start)
+                plugin.log(f"Thread{get_thread_id_str()} {search}", 'debug')
                 # plugin.log(f"RpcError: {str(e)}", 'debug')
                 # check if we ran into the `rpc.waitsendpay` timeout
                 if e.method == "waitsendpay" and e.error.get('code') == 200:
                     raise RpcError("rebalance", payload, {'message': 'Timeout reached'})
-                # check if we have problems with our own channels
-                erring_node = e.error.get('data', {}).get('erring_node')
-                erring_channel = e.error.get('data', {}).get('erring_channel')
-                erring_direction = e.error.get('data', {}).get('erring_direction')
-                if erring_channel == incoming_scid:
-                    raise RpcError("rebalance", payload, {'message': 'Error with incoming channel'})
-                if erring_channel == outgoing_scid:
-                    raise RpcError("rebalance", payload, {'message': 'Error with outgoing channel'})
-                # exclude other erroring channels
-                if erring_channel is not None and erring_direction is not None:
-                    excludes.append(erring_channel + '/' + str(erring_direction))
-                # count and exclude nodes that produce a lot of errors
-                if erring_node and plugin.erringnodes > 0:
-                    if nodes.get(erring_node) is None:
-                        nodes[erring_node] = 0
-                    nodes[erring_node] += 1
-                    if nodes[erring_node] >= plugin.erringnodes:
-                        excludes.append(erring_node)
+                handle_sendpay_error(e, route, payload, excludes, nodes)
 
     except Exception as e:
         return cleanup(label, payload, rpc_result, e)
+    finally:
+        plugin.thread_stats.add(get_thread_name(), search)
+        plugin.metrics.observe("rebalance", time.time() - search.start_ts)
+        plugin.metrics.result("complete" if search.success else "failed")
     rpc_result = {'status': 'error', 'message': 'Timeout reached'}
     return cleanup(label, payload, rpc_result)
 
@@ -458,11 +803,13 @@ def get_open_channels(plugin: Plugin):
     if plugin.listpeerchannels:
         channels = plugin.rpc.listpeerchannels()['channels']
         for ch in channels:
+            plugin.channel_peers[ch.get("short_channel_id")] = ch["peer_id"]
             if ch["state"] == "CHANNELD_NORMAL" and not ch["private"]:
                 result.append(ch)
     else:
         for peer in plugin.rpc.listpeers()["peers"]:
             for ch in peer["channels"]:
+                plugin.channel_peers[ch.get("short_channel_id")] = peer["id"]
                 if ch["state"] == "CHANNELD_NORMAL" and not ch["private"]:
                     result.append(ch)
     return result
@@ -536,13 +883,15 @@ def get_max_fee(msat: Millisatoshi):
 
 
 def get_chan(scid: str):
+    # just the channels of the peer, if get_open_channels saw it
+    peer_id = plugin.channel_peers.get(scid)
     if plugin.listpeerchannels:
-        channels = plugin.rpc.listpeerchannels()['channels']
+        channels = plugin.rpc.listpeerchannels(peer_id)['channels']
         for chan in channels:
             if chan.get("short_channel_id") == scid:
                 return chan
     else:
-        for peer in plugin.rpc.listpeers()["peers"]:
+        for peer in plugin.rpc.listpeers(peer_id)["peers"]:
             if len(peer["channels"]) == 0:
                 continue
             for chan in peer["channels"]:
@@ -579,53 +928,64 @@ def wait_for(success, timeout: int = 60):
     return True
 
 
-def wait_for_htlcs(failed_channels: list, scids: list = None):
-    # HTLC settlement helper
-    # taken and modified from pyln-testing/pyln/testing/utils.py
+def htlcs_settled(scid: str):
+    chan = get_chan(scid)
+    return chan is None or len(chan.get('htlcs', [])) == 0
+
+
+def wait_for_htlcs(scids: list):
+    # HTLC settlement helper: sleeps until notifications report our channels
+    # idle, then lets lightningd confirm (or poll on if our counts drifted)
+    time_start = time.time()
     result = True
-    peers = plugin.rpc.listpeers()['peers']
-    for p, peer in enumerate(peers):
-        pid = peer['id']
-        channels = []
-        if 'channels' in peer:
-            channels = peer['channels']
-        elif 'num_channels' in peer and peer['num_channels'] > 0:
-            channels = plugin.rpc.listpeerchannels(peer['id'])['channels']
-        for c, channel in enumerate(channels):
-            scid = channel.get('short_channel_id')
-            if scids is not None and scid not in scids:
-                continue
-            if scid in failed_channels:
-                result = False
-                continue
-            if 'htlcs' in channel:
-                lam = lambda: len(plugin.rpc.listpeers()['peers'][p]['channels'][c]['htlcs']) == 0
-                if plugin.listpeerchannels:
-                    lam = lambda: len(plugin.rpc.listpeerchannels(pid)['channels'][c]['htlcs']) == 0
-                if not wait_for(lam):
-                    failed_channels.append(scid)
-                    plugin.log(f"Thread{get_thread_id_str()} timeout while waiting for htlc settlement in channel {scid}")
-                    result = False
+    for scid in scids:
+        if scid in plugin.failures:
+            result = False
+            continue
+        start_ts = time.time()
+        plugin.htlcs.wait([scid], 60)
+        if not wait_for(lambda: htlcs_settled(scid), 60 - (time.time() - start_ts)):
+            plugin.failures.fail(scid)
+            plugin.log(f"Thread{get_thread_id_str()} timeout while waiting for htlc settlement in channel {scid}")
+            plugin.metrics.error("htlc_wait")
+            result = False
+        elif plugin.htlcs.count(scid) > 0:
+            plugin.htlcs.reset(scid)
+    plugin.metrics.observe("htlc_wait", time.time() - time_start)
     return result
 
 
-def maybe_rebalance_pairs(ch1, ch2, failed_channels: list):
+def get_pair_amount(liquidity1, liquidity2):
+    amount1 = min(must_send(liquidity1), could_receive(liquidity2))
+    amount2 = min(should_send(liquidity1), should_receive(liquidity2))
+    amount3 = min(could_send(liquidity1), must_receive(liquidity2))
+    return max(amount1, amount2, amount3)
+
+
+def get_pair_score(liquidity1, liquidity2):
+    # expected liquidity gain per msat of max fee, must_* moves count double
+    amount = min(get_pair_amount(liquidity1, liquidity2), get_max_amount(0, plugin))
+    if amount < plugin.min_amount:
+        return 0
+    gain = (int(amount) + int(min(must_send(liquidity1), amount))
+            + int(min(must_receive(liquidity2), amount)))
+    return gain / max(int(get_max_fee(amount)), 1)
+
+
+def maybe_rebalance_pairs(ch1, ch2):
     scid1 = ch1["short_channel_id"]
     scid2 = ch2["short_channel_id"]
     result = {"success": False, "fee_spent": Millisatoshi(0)}
-    if scid1 + ":" + scid2 in failed_channels:
+    if scid1 + ":" + scid2 in plugin.failures:
         return result
     # check if HTLCs are settled
-    if not wait_for_htlcs(failed_channels, [scid1, scid2]):
+    if not wait_for_htlcs([scid1, scid2]):
         return result
     i = 0
     while not rebalance_stopping():
         liquidity1 = liquidity_info(ch1, plugin.enough_liquidity, plugin.ideal_ratio)
         liquidity2 = liquidity_info(ch2, plugin.enough_liquidity, plugin.ideal_ratio)
-        amount1 = min(must_send(liquidity1), could_receive(liquidity2))
-        amount2 = min(should_send(liquidity1), should_receive(liquidity2))
-        amount3 = min(could_send(liquidity1), must_receive(liquidity2))
-        amount = max(amount1, amount2, amount3)
+        amount = get_pair_amount(liquidity1, liquidity2)
         if amount < plugin.min_amount:
             return result
         amount = min(amount, get_max_amount(i, plugin))
@@ -635,23 +995,26 @@ def maybe_rebalance_pairs(ch1, ch2, failed_channels: list):
         try:
             res = rebalance(plugin, outgoing_scid=scid1, incoming_scid=scid2,
                             msatoshi=amount, retry_for=1200, maxfeepercent=0,
-                            exemptfee=maxfee)
+                            exemptfee=maxfee, parts=plugin.parts)
             if not res.get('status') == 'complete':
                 raise Exception  # fall into exception handler below
         except Exception:
-            failed_channels.append(scid1 + ":" + scid2)
             # rebalance failed, let's try with a smaller amount
             while (get_max_amount(i, plugin) >= amount and
                    get_max_amount(i, plugin) != get_max_amount(i + 1, plugin)):
                 i += 1
             if amount > get_max_amount(i, plugin):
                 continue
+            # skip the pair in the next rounds, unless it worked with a smaller amount
+            if not result["success"]:
+                plugin.failures.fail(scid1 + ":" + scid2)
             return result
+        plugin.failures.succeed(scid1 + ":" + scid2)
         result["success"] = True
         result["fee_spent"] += res["fee"]
         htlc_start_ts = time.time()
         # wait for settlement
-        htlc_success = wait_for_htlcs(failed_channels, [scid1, scid2])
+        htlc_success = wait_for_htlcs([scid1, scid2])
         current_ts = time.time()
         res["elapsed_time"] = str(timedelta(seconds=current_ts - start_ts))[:-3]
         res["htlc_time"] = str(timedelta(seconds=current_ts - htlc_start_ts))[:-3]
@@ -665,57 +1028,47 @@ def maybe_rebalance_pairs(ch1, ch2, failed_channels: list):
     return result
 
 
-def rebalance_pair_picker(threadid, channel_pairs: list, failed_channels: list):
+def rebalance_pair_picker(threadid, scheduler: PairScheduler):
     plugin.threadids[threading.get_ident()] = threadid
     result = {"success": False, "fee_spent": Millisatoshi(0)}
-    idle_count = 0
     while not rebalance_stopping():
-        idle_count += 1
-        for pair in channel_pairs:
-            if rebalance_stopping():
-                return result
-            ch1 = pair[0]
-            ch2 = pair[1]
-            processed = pair[2]
-            if processed:
-                continue
-            if ch1["lock"].acquire(blocking=False):
-                if ch2["lock"].acquire(blocking=False):
-                    idle_count = 0
-                    pair[2] = True
-                    result = maybe_rebalance_pairs(ch1, ch2, failed_channels)
-                    ch2["lock"].release()
-                ch1["lock"].release()
-            if result["success"]:
-                plugin.log(f"Thread{get_thread_id_str()} restarts rebalance threads after successful rebalance")
-                plugin.rebalance_stop_by_thread = True
-                return result
-        unprocessed = [p for p in channel_pairs if not p[2]]
-        if len(unprocessed) == 0:
+        pair = scheduler.take(rebalance_stopping)
+        if pair is None:
+            return result
+        try:
+            result = maybe_rebalance_pairs(pair[0], pair[1])
+        finally:
+            scheduler.done(pair)
+        if result["success"]:
+            plugin.log(f"Thread{get_thread_id_str()} restarts rebalance threads after successful rebalance")
+            plugin.rebalance_stop_by_thread = True
             return result
-        if idle_count == 1:
-            plugin.log(f"Thread{get_thread_id_str()} is idle, {len(unprocessed)} possible channel pairs remained")
-        if idle_count > 0:
-            time.sleep(10)
     return result
 
 
-def maybe_rebalance_once(failed_channels: list):
+def maybe_rebalance_once():
     channels = get_open_channels(plugin)
-    for ch in channels:
-        ch["lock"] = threading.Lock()
+    liquidities = {ch["short_channel_id"]: liquidity_info(ch, plugin.enough_liquidity, plugin.ideal_ratio)
+                   for ch in channels}
     channel_pairs = []
     for ch1 in channels:
         for ch2 in channels:
             if ch1 == ch2:
                 continue
-            channel_pairs.append([ch1, ch2, False])
+            scid1 = ch1["short_channel_id"]
+            scid2 = ch2["short_channel_id"]
+            if scid1 + ":" + scid2 in plugin.failures:
+                continue
+            score = get_pair_score(liquidities[scid1], liquidities[scid2])
+            if score > 0:
+                channel_pairs.append((score, ch1, ch2))
 
-    plugin.log(f"Start to rebalance {len(channel_pairs)} possible channel pairs")
+    scheduler = PairScheduler(channel_pairs)
+    plugin.log(f"Start to rebalance {len(channel_pairs)} possible channel pairs out of {len(channels) * (len(channels) - 1)}")
     executor = concurrent.futures.ThreadPoolExecutor(max_workers=plugin.threads)
     futures = set()
     for threadid in range(plugin.threads):
-        futures.add(executor.submit(rebalance_pair_picker, threadid, channel_pairs, failed_channels))
+        futures.add(executor.submit(rebalance_pair_picker, threadid, scheduler))
     result = {"success": False, "fee_spent": Millisatoshi(0)}
     for future in concurrent.futures.as_completed(futures):
         r2 = future.result()
@@ -754,13 +1107,13 @@ def rebalanceall_thread():
     try:
         start_ts = time.time()
         feeadjuster_state = feeadjuster_toggle(False)
+        plugin.thread_stats.clear()
         plugin.log(f"Automatic rebalance started")
-        failed_channels = []
         success = 0
         fee_spent = Millisatoshi(0)
         while True:
             refresh_parameters()
-            result = maybe_rebalance_once(failed_channels)
+            result = maybe_rebalance_once()
             if not result["success"] and not plugin.rebalance_stop_by_event:
                 break
             if result["success"]:
@@ -769,6 +1122,8 @@ def rebalanceall_thread():
             plugin.rebalance_stop_by_event = False
             if rebalance_stopping():
                 break
+        save_mission_control(force=True)
+        save_failures()
         feeadjust_would_be_nice()
         feeadjuster_toggle(feeadjuster_state)
         elapsed_time = timedelta(seconds=time.time() - start_ts)
@@ -779,8 +1134,52 @@ def rebalanceall_thread():
         plugin.mutex.release()
 
 
+def get_all_channels():
+    if plugin.listpeerchannels:
+        return plugin.rpc.listpeerchannels()['channels']
+    return [ch for peer in plugin.rpc.listpeers()["peers"] for ch in peer["channels"]]
+
+
+def on_htlc_accepted(htlc, onion, plugin, request, **kwargs):
+    # settles our own invoice-less rebalances, anything else just continues
+    with plugin.preimages_lock:
+        payment = plugin.preimages.get(htlc.get('payment_hash'))
+        if payment is None:
+            request.set_result({"result": "continue"})
+            return
+        # hold multi-part HTLCs until the whole amount arrived
+        payment["held"].append((request, int(Millisatoshi(htlc['amount_msat']))))
+        if sum(amount for _, amount in payment["held"]) < payment["msatoshi"]:
+            return
+        for req, _ in payment["held"]:
+            req.set_result({"result": "resolve", "payment_key": payment["preimage"]})
+        payment["held"] = []
+        payment["settled"] = True
+    if plugin.report.invoice_paid(htlc['payment_hash']):
+        report_changed()
+
+
 @plugin.subscribe("forward_event")
 def forward_event(plugin: Plugin, forward_event: dict, **kwargs):
+    key = ("forward", forward_event.get("payment_hash"), forward_event.get("in_channel"),
+           forward_event.get("in_htlc_id"))
+    if forward_event["status"] == "offered":
+        plugin.htlcs.offered(key, [forward_event.get("in_channel"), forward_event.get("out_channel")])
+    else:
+        plugin.htlcs.resolved(key)
+    if forward_event["status"] == "settled":
+        plugin.report.forward_notified(forward_key(forward_event), forward_event.get('resolved_time', time.time()),
+                                       int(Millisatoshi(forward_event['out_msat'])),
+                                       int(Millisatoshi(forward_event['fee_msat'])))
+        # fold notified forwards into the persisted buckets now and then
+        if len(plugin.report.recent) >= 1000:
+            start_report_catch_up()
+    plan = plugin.plan
+    if forward_event["status"] == "settled" and plan is not None:
+        # the running plan only needs the flow network arcs of these channels updated
+        plan_changed(plan, forward_event.get("in_channel"), int(Millisatoshi(forward_event['in_msat'])))
+        plan_changed(plan, forward_event.get("out_channel"), -int(Millisatoshi(forward_event['out_msat'])))
+        return
     if not plugin.mutex.locked():
         return
     if forward_event["status"] == "settled":
@@ -790,6 +1189,10 @@ def forward_event(plugin: Plugin, forward_event: dict, **kwargs):
 
 @plugin.subscribe("invoice_payment")
 def invoice_payment(plugin: Plugin, invoice_payment: dict, **kwargs):
+    if invoice_payment.get('label', '').startswith("Rebalance") and invoice_payment.get('preimage'):
+        payment_hash = hashlib.sha256(bytes.fromhex(invoice_payment['preimage'])).hexdigest()
+        if plugin.report.invoice_paid(payment_hash):
+            report_changed()
     if not plugin.mutex.locked():
         return
     if invoice_payment.get('label').startswith("Rebalance"):
@@ -800,17 +1203,33 @@ def invoice_payment(plugin: Plugin, invoice_payment: dict, **kwargs):
 
 @plugin.subscribe("sendpay_success")
 def sendpay_success(plugin: Plugin, sendpay_success: dict, **kwargs):
+    plugin.htlcs.resolved(("sendpay", sendpay_success.get('id')), early=True)
+    plugin.engine.success(sendpay_success)
+    my_node_id = plugin.getinfo.get('id')
+    if sendpay_success.get('destination') == my_node_id and sendpay_success.get('amount_sent_msat') is not None:
+        payment_hash = sendpay_success.get('payment_hash')
+        if plugin.report.part_complete(payment_hash, sendpay_success.get('id'),
+                                       int(Millisatoshi(sendpay_success['amount_msat'])),
+                                       int(Millisatoshi(sendpay_success['amount_sent_msat']))):
+            report_changed()
     if not plugin.mutex.locked():
         return
-    my_node_id = plugin.getinfo.get('id')
     if sendpay_success.get('destination') == my_node_id:
         return
     plugin.log("Sendpay success restarts rebalance threads")
     plugin.rebalance_stop_by_event = True
 
 
+@plugin.subscribe("sendpay_failure")
+def sendpay_failure(plugin: Plugin, sendpay_failure: dict, **kwargs):
+    plugin.htlcs.resolved(("sendpay", sendpay_failure.get('data', {}).get('id')), early=True)
+    plugin.engine.failure(sendpay_failure)
+
+
 @plugin.subscribe("channel_state_changed")
 def channel_state_changed(plugin: Plugin, channel_state_changed: dict, **kwargs):
+    if channel_state_changed.get('new_state') != 'CHANNELD_NORMAL':
+        plugin.htlcs.reset(channel_state_changed.get('short_channel_id'))
     if not plugin.mutex.locked():
         return
     if channel_state_changed.get('old_state') != 'CHANNELD_NORMAL' and channel_state_changed.get('new_state') != 'CHANNELD_NORMAL':
@@ -848,6 +1267,286 @@ def rebalanceall(plugin: Plugin, min_amount: Millisatoshi = Millisatoshi("50000s
     return {"message": f"Rebalance started with min rebalancable amount: {plugin.min_amount}, feeratio: {plugin.feeratio}"}
 
 
+# benefit per msat of moving must_*, should_* and could_* liquidity, far above any fee ppm
+PLAN_MUST = -2 * 10**9
+PLAN_SHOULD = -10**9
+PLAN_COULD = 0
+# a transfer needs must+could or should+should benefits, like get_pair_amount
+PLAN_TRANSFER = 3 * 10**9 // 2
+
+
+def get_inbound_ppm(channel, my_node_id):
+    # fee ppm the peer charges for the last hop into this channel
+    peer_id = channel.get("peer_id", my_node_id)
+    try:
+        return get_policy(channel["short_channel_id"], int(peer_id > my_node_id))['fee_ppm']
+    except RpcError:
+        return None
+
+
+def plan_tiers(channel):
+    """ (sender tiers, receiver tiers) of a channel for the flow network """
+    lq = liquidity_info(channel, plugin.enough_liquidity, plugin.ideal_ratio)
+    return ([(int(must_send(lq)), PLAN_MUST),
+             (int(a_minus_b(should_send(lq), must_send(lq))), PLAN_SHOULD),
+             (int(a_minus_b(could_send(lq), should_send(lq))), PLAN_COULD)],
+            [(int(must_receive(lq)), PLAN_MUST),
+             (int(a_minus_b(should_receive(lq), must_receive(lq))), PLAN_SHOULD),
+             (int(a_minus_b(could_receive(lq), should_receive(lq))), PLAN_COULD)])
+
+
+def get_rebalance_plan(channels: list):
+    """ Transfers that move all channels towards their ideal liquidity.
+
+    Solves one min-cost flow from channels with too much to channels with
+    too little liquidity. must_* amounts are preferred over should_*
+    amounts, and could_* amounts only fill up must_* amounts on the other
+    side. Transfers whose last hop alone exceeds the fee budget are left
+    out, the cheapest inbound channels are filled first. Pairs and
+    channels in their failure backoff are not planned.
+    The plan keeps the liquidity it assumes per channel, `plan_changed`
+    updates it, and `plan_transfers` lists the transfers.
+    """
+    my_node_id = plugin.getinfo.get('id')
+    budget_ppm = plugin.fee_ppm * plugin.feeratio
+    plan = {
+        "channels": {ch["short_channel_id"]: dict(ch) for ch in channels},
+        "inbound_ppm": {},
+        "changed": set(),       # scids whose liquidity changed since the last update
+        "lock": threading.Lock(),
+    }
+    senders = {}
+    receivers = {}
+    for ch in channels:
+        scid = ch["short_channel_id"]
+        senders[scid], receiver = plan_tiers(ch)
+        ppm = get_inbound_ppm(ch, my_node_id)
+        if ppm is None or ppm > budget_ppm:
+            continue
+        plan["inbound_ppm"][scid] = ppm
+        receivers[scid] = receiver
+
+    def best_tier(tiers):
+        return min((cost for amount, cost in tiers if amount > 0), default=None)
+    best_send = {scid: best_tier(tiers) for scid, tiers in senders.items()}
+    best_receive = {scid: best_tier(tiers) for scid, tiers in receivers.items()}
+
+    def transfer_cost(scid1, scid2):
+        if scid1 == scid2 or scid1 + ":" + scid2 in plugin.failures:
+            return None
+        if scid1 in plugin.failures or scid2 in plugin.failures:
+            return None
+        # only pairs that gain something get an arc, it keeps the network small
+        if best_send[scid1] is None or best_receive[scid2] is None:
+            return None
+        cost = PLAN_TRANSFER + plan["inbound_ppm"][scid2]
+        if best_send[scid1] + best_receive[scid2] + cost >= 0:
+            return None
+        return cost
+
+    plan["flow"] = TransferPlan(senders, receivers, transfer_cost)
+    return plan
+
+
+def plan_changed(plan: dict, scid: str, msat: int):
+    """ Our liquidity in `scid` changed by `msat`, the next `update_plan` applies it """
+    with plan["lock"]:
+        ch = plan["channels"].get(scid)
+        if ch is None:
+            return
+        ch["to_us_msat"] = Millisatoshi(min(max(int(ch["to_us_msat"]) + msat, 0), int(ch["total_msat"])))
+        plan["changed"].add(scid)
+
+
+def update_plan(plan: dict):
+    # only the flow network arcs of changed channels are updated
+    with plan["lock"]:
+        if len(plan["changed"]) > 0:
+            plan["flow"].update({scid: plan_tiers(plan["channels"][scid]) for scid in plan["changed"]})
+            plan["changed"] = set()
+
+
+def plan_amount(plan: dict, scid1: str, scid2: str):
+    with plan["lock"]:
+        return Millisatoshi(plan["flow"].transfers().get((scid1, scid2), 0))
+
+
+def plan_transfers(plan: dict):
+    with plan["lock"]:
+        flows = plan["flow"].transfers()
+    transfers = []
+    for (scid1, scid2), amount in flows.items():
+        amount = Millisatoshi(amount)
+        if amount < plugin.min_amount:
+            continue
+        transfers.append({
+            "outgoing_scid": scid1,
+            "incoming_scid": scid2,
+            "amount": amount,
+            "maxfee": get_max_fee(amount),
+            "inbound_fee_ppm": plan["inbound_ppm"][scid2],
+        })
+    return sorted(transfers, key=lambda t: t["amount"], reverse=True)
+
+
+def execute_transfer(plan: dict, scid1: str, scid2: str):
+    """ Rebalances the planned amount, in smaller steps if it fails """
+    result = {"success_count": 0, "fee_spent": Millisatoshi(0)}
+    i = 0
+    while not rebalance_stopping():
+        if not wait_for_htlcs([scid1, scid2]):
+            return result
+        # forwards and the other transfers may have changed the plan meanwhile
+        update_plan(plan)
+        amount = plan_amount(plan, scid1, scid2)
+        if amount < plugin.min_amount:
+            return result
+        msat = min(amount, get_max_amount(i, plugin))
+        maxfee = get_max_fee(msat)
+        plugin.log(f"Thread{get_thread_id_str()} executes plan: {scid1} -> {scid2}; amount={msat.to_satoshi_str()}; maxfee={maxfee.to_satoshi_str()}")
+        try:
+            res = rebalance(plugin, outgoing_scid=scid1, incoming_scid=scid2,
+                            msatoshi=msat, retry_for=1200, maxfeepercent=0,
+                            exemptfee=maxfee, parts=plugin.parts)
+        except Exception as e:
+            res = {"status": "exception", "message": str(e)}
+        if res.get('status') != 'complete':
+            # try smaller amounts, until they get too small
+            while get_max_amount(i, plugin) >= msat and get_max_amount(i, plugin) != get_max_amount(i + 1, plugin):
+                i += 1
+            if msat <= get_max_amount(i, plugin):
+                plugin.failures.fail(scid1 + ":" + scid2)
+                with plan["lock"]:
+                    plan["flow"].remove(scid1, scid2)
+                return result
+            continue
+        plugin.failures.succeed(scid1 + ":" + scid2)
+        result["success_count"] += 1
+        result["fee_spent"] += res["fee"]
+        plan_changed(plan, scid1, -int(res["sent"]))
+        plan_changed(plan, scid2, int(res["received"]))
+    return result
+
+
+def plan_transfer_picker(threadid, scheduler: PairScheduler, plan: dict):
+    plugin.threadids[threading.get_ident()] = threadid
+    result = {"success_count": 0, "fee_spent": Millisatoshi(0)}
+    while not rebalance_stopping():
+        pair = scheduler.take(rebalance_stopping)
+        if pair is None:
+            break
+        try:
+            r = execute_transfer(plan, pair[0]["short_channel_id"], pair[1]["short_channel_id"])
+        finally:
+            scheduler.done(pair)
+        result["success_count"] += r["success_count"]
+        result["fee_spent"] += r["fee_spent"]
+    return result
+
+
+def execute_plan(plan: dict):
+    transfers = plan_transfers(plan)
+    scheduler = PairScheduler([(int(t["amount"]), {"short_channel_id": t["outgoing_scid"]},
+                                {"short_channel_id": t["incoming_scid"]}) for t in transfers])
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=plugin.threads)
+    futures = [executor.submit(plan_transfer_picker, threadid, scheduler, plan)
+               for threadid in range(plugin.threads)]
+    result = {"success_count": 0, "fee_spent": Millisatoshi(0)}
+    for future in concurrent.futures.as_completed(futures):
+        r = future.result()
+        result["success_count"] += r["success_count"]
+        result["fee_spent"] += r["fee_spent"]
+    return result
+
+
+def rebalanceplan_thread(plan: dict):
+    # the caller acquired plugin.mutex for this thread
+    try:
+        start_ts = time.time()
+        feeadjuster_state = feeadjuster_toggle(False)
+        plugin.thread_stats.clear()
+        plugin.log(f"Rebalance plan with {len(plan_transfers(plan))} transfers started")
+        success = 0
+        fee_spent = Millisatoshi(0)
+        while True:
+            # forwards update the running plan, they don't restart it
+            plugin.plan = plan
+            update_plan(plan)
+            failed_before = plugin.failures.failures
+            result = execute_plan(plan)
+            success += result["success_count"]
+            fee_spent += result["fee_spent"]
+            if plugin.rebalance_stop_by_user:
+                break
+            if plugin.rebalance_stop_by_event:
+                # other payments or channel state changes: plan again from the current channels
+                plugin.rebalance_stop_by_event = False
+                refresh_parameters()
+                plan = get_rebalance_plan(get_open_channels(plugin))
+                continue
+            # transfers the last round could not run yet, or that changed meanwhile
+            if result["success_count"] == 0 and plugin.failures.failures == failed_before:
+                break
+        save_mission_control(force=True)
+        save_failures()
+        feeadjust_would_be_nice()
+        feeadjuster_toggle(feeadjuster_state)
+        elapsed_time = timedelta(seconds=time.time() - start_ts)
+        plugin.rebalanceall_msg = (f"Rebalance plan finished: {success} successful rebalance, "
+                                   f"{fee_spent.to_satoshi_str()} fee spent, it took {str(elapsed_time)[:-3]}")
+        plugin.log(plugin.rebalanceall_msg)
+    finally:
+        plugin.plan = None
+        plugin.mutex.release()
+
+
+@plugin.async_method("rebalanceplan")
+def rebalanceplan_command(plugin: Plugin, request, min_amount: Millisatoshi = Millisatoshi("50000sat"),
+                          feeratio: float = 0.5, execute: bool = False):
+    """Plan the rebalances that bring all channels to their ideal liquidity.
+    One min-cost flow over all channels' surpluses and deficits gives the transfers, preferring
+    the channels which need it most and the cheapest inbound channels. Parameters are the same
+    as for rebalanceall. With execute=true the plan is run in the background, rebalancestop stops it.
+    """
+    # solving the plan takes seconds on big nodes, notifications and
+    # htlc_accepted must not wait for it
+    def run():
+        try:
+            request.set_result(rebalanceplan(plugin, min_amount, feeratio, execute))
+        except Exception as e:
+            request.set_exception(e)
+    threading.Thread(target=run, daemon=True).start()
+
+
+def rebalanceplan(plugin: Plugin, min_amount: Millisatoshi = Millisatoshi("50000sat"), feeratio: float = 0.5,
+                  execute: bool = False):
+    if plugin.mutex.locked():
+        return {"message": "Rebalance is already running, this may take a while. To stop it use the cli method 'rebalancestop'."}
+    channels = get_open_channels(plugin)
+    if len(channels) <= 1:
+        return {"message": "Error: Not enough open channels to rebalance anything"}
+    plugin.feeratio = float(feeratio)
+    plugin.min_amount = Millisatoshi(min_amount)
+    refresh_parameters()
+    plan = get_rebalance_plan(channels)
+    transfers = plan_transfers(plan)
+    res = {
+        "enough_liquidity_threshold": plugin.enough_liquidity,
+        "ideal_liquidity_ratio": f"{plugin.ideal_ratio * 100:.2f}%",
+        "total_amount": sum((t["amount"] for t in transfers), Millisatoshi(0)),
+        "total_maxfee": sum((t["maxfee"] for t in transfers), Millisatoshi(0)),
+        "transfers": transfers,
+    }
+    if execute and len(transfers) > 0:
+        # taken here, so a rebalance started meanwhile can't make the plan silently not run
+        if not plugin.mutex.acquire(blocking=False):
+            return {"message": "Rebalance is already running, this may take a while. To stop it use the cli method 'rebalancestop'."}
+        t = threading.Thread(target=rebalanceplan_thread, args=(plan,))
+        t.start()
+        res["message"] = f"Executing {len(transfers)} transfers in the background"
+    return res
+
+
 @plugin.method("rebalancestop")
 def rebalancestop(plugin: Plugin):
     """It stops the ongoing rebalanceall.
@@ -882,31 +1581,98 @@ def health_score(liquidity):
 
 
 def get_avg_forward_fees(intervals):
-    now = time.time()
-    max_interval = max(intervals)
-    total = [0] * len(intervals)
-    fees = [0] * len(intervals)
-    res = [0] * len(intervals)
-    all_forwards = list(filter(lambda fwd: fwd.get("status") == "settled"
-                               and fwd.get("resolved_time", 0)
-                               + max_interval * 60 * 60 * 24 > now,
-                               plugin.rpc.listforwards()["forwards"]))
-
-    # build intermediate result per interval
-    for fwd in all_forwards:
-        for idx, i in enumerate(intervals):
-            if now > fwd["resolved_time"] + i * 60 * 60 * 24:
-                continue
-            total[idx] += fwd["out_msat"]
-            fees[idx] += fwd["fee_msat"]
+    return plugin.report.forward_fee_ppm(intervals)
 
-    # return average intermediate
-    for idx, i in enumerate(res):
-        if int(total[idx]) > 0:
-            res[idx] = fees[idx] / total[idx] * 10**6
-        else:
-            res[idx] = 0
-    return res
+
+def forward_key(fwd: dict):
+    # in_htlc_id is missing in older notifications, the payment hash and
+    # the time the HTLC came in are the same in listforwards
+    return f"{fwd.get('in_channel')}/{fwd.get('payment_hash')}/{float(fwd.get('received_time', 0)):.3f}"
+
+
+def load_report():
+    try:
+        state = plugin.rpc.listdatastore(['rebalance', 'report', 'state'])['datastore']
+    except RpcError as e:
+        plugin.log(f"Could not load rebalance report: {e}", 'debug')
+        return
+    if len(state) > 0 and 'string' in state[0]:
+        plugin.report.loads(state[0]['string'])
+
+
+def start_report_catch_up():
+    if not plugin.report_lock.locked():
+        threading.Thread(target=catch_up_report, daemon=True).start()
+
+
+def report_timer():
+    plugin.report_timer = None
+    catch_up_report()
+
+
+def report_changed():
+    # a catch-up saves the report, at most once a minute
+    if plugin.report_timer is not None:
+        return
+    plugin.report_timer = threading.Timer(max(plugin.report_saved_at + 60 - time.time(), 0), report_timer)
+    plugin.report_timer.daemon = True
+    plugin.report_timer.start()
+
+
+def updated_items(method: str, key: str, cursor: str):
+    """ Yields the items of a list command updated after the report cursor,
+        falls back to a full listing if lightningd lacks the indexes.
+    """
+    start = plugin.report.cursors[cursor]
+    while True:
+        try:
+            items = plugin.rpc.call(method, {"index": "updated", "start": start + 1, "limit": 1000})[key]
+        except RpcError as e:
+            plugin.log(f"Full {method} for rebalance report: {e}", 'debug')
+            if cursor == "forwards":
+                plugin.report.reset_forwards()
+            if cursor == "invoices":
+                plugin.report.reset_rebalances()
+            yield from plugin.rpc.call(method)[key]
+            return
+        yield from items
+        last = max([start] + [i.get('updated_index', 0) for i in items])
+        if len(items) < 1000 or last == start:
+            return
+        start = last
+
+
+def catch_up_report():
+    # just one catch-up at a time, a running one does the job
+    if not plugin.report_lock.acquire(blocking=False):
+        return
+    try:
+        report = plugin.report
+        my_node_id = plugin.getinfo.get('id')
+        started = time.time()
+        report.start_catch_up()
+        for inv in updated_items("listinvoices", "invoices", "invoices"):
+            report.cursors["invoices"] = max(report.cursors["invoices"], inv.get('updated_index', 0))
+            if inv.get('status') == 'paid' and inv.get('label', '').startswith("Rebalance"):
+                report.invoice_paid(inv['payment_hash'])
+        for pay in updated_items("listsendpays", "payments", "sendpays"):
+            report.cursors["sendpays"] = max(report.cursors["sendpays"], pay.get('updated_index', 0))
+            if pay.get('status') == 'complete' and pay.get('destination') == my_node_id:
+                report.part_complete(pay['payment_hash'], pay['id'], int(Millisatoshi(pay['amount_msat'])),
+                                     int(Millisatoshi(pay['amount_sent_msat'])))
+        for fwd in updated_items("listforwards", "forwards", "forwards"):
+            report.cursors["forwards"] = max(report.cursors["forwards"], fwd.get('updated_index', 0))
+            if fwd.get('status') == 'settled':
+                report.forward_caught_up(forward_key(fwd), fwd['resolved_time'],
+                                         int(Millisatoshi(fwd['out_msat'])), int(Millisatoshi(fwd['fee_msat'])))
+        # the cursors passed older rebalances, their parts are all counted
+        report.forget_rebalances(started - 3600)
+        plugin.report_saved_at = time.time()
+        plugin.rpc.datastore(['rebalance', 'report', 'state'], string=report.dumps(), mode='create-or-replace')
+    except RpcError as e:
+        plugin.log(f"Could not update rebalance report: {e}", 'debug')
+    finally:
+        plugin.report_lock.release()
 
 
 @plugin.method("rebalancereport")
@@ -919,6 +1685,9 @@ def rebalancereport(plugin: Plugin, include_avg_fees: bool = True):
     res["maxhops_threshold"] = plugin.maxhops
     res["msatfactor"] = plugin.msatfactor
     res["erringnodes_threshold"] = plugin.erringnodes
+    res["failed_pairs_in_backoff"] = len(plugin.failures)
+    # route search stats of the last rebalanceall or plan run, and of direct calls
+    res["thread_stats"] = plugin.thread_stats.report()
     channels = get_open_channels(plugin)
     health_percent = 0.0
     if len(channels) > 1:
@@ -934,26 +1703,12 @@ def rebalancereport(plugin: Plugin, include_avg_fees: bool = True):
         res["enough_liquidity_threshold"] = Millisatoshi(0)
         res["ideal_liquidity_ratio"] = "0%"
     res["liquidity_health"] = f"{health_percent:.2f}%"
-    invoices = plugin.rpc.listinvoices()['invoices']
-    rebalances = [i for i in invoices if i.get('status') == 'paid' and i.get('label').startswith("Rebalance")]
-    total_fee = Millisatoshi(0)
-    total_amount = Millisatoshi(0)
-    res["total_successful_rebalances"] = len(rebalances)
-
-    # iterate if cln doesn't already support `status` on listpays since v0.10.2
-    if plugin.rpcversion[0] == 0 and plugin.rpcversion[1] <= 10 and plugin.rpcversion[2] < 2:
-        pays = plugin.rpc.listpays()["pays"]
-        pays = [p for p in pays if p.get('status') == 'complete']
-    else:
-        pays = plugin.rpc.listpays(status="complete")["pays"]
-
-    for r in rebalances:
-        try:
-            pay = next(p for p in pays if p["payment_hash"] == r["payment_hash"])
-            total_amount += pay["amount_msat"]
-            total_fee += pay["amount_sent_msat"] - pay["amount_msat"]
-        except Exception:
-            res["total_successful_rebalances"] -= 1
+    # the totals are kept up to date by notifications, the catch-up
+    # only picks up what they missed and runs in the background
+    start_report_catch_up()
+    total_fee = Millisatoshi(plugin.report.fee)
+    total_amount = Millisatoshi(plugin.report.amount)
+    res["total_successful_rebalances"] = plugin.report.count
     res["total_rebalanced_amount"] = total_amount
     res["total_rebalance_fee"] = total_fee
     if total_amount > Millisatoshi(0):
@@ -970,6 +1725,19 @@ def rebalancereport(plugin: Plugin, include_avg_fees: bool = True):
     return res
 
 
+@plugin.method("rebalancestats")
+def rebalancestats(plugin: Plugin, reset: bool = False):
+    """Show timings and counters of rebalance attempts.
+
+    Latency histograms per phase, results, and payment failures by failcode
+    and erring node since the plugin started or the last `reset`.
+    """
+    res = plugin.metrics.report()
+    if reset:
+        plugin.metrics.reset()
+    return res
+
+
 @plugin.init()
 def init(options: dict, configuration: dict, plugin: Plugin, **kwargs):
     rpchelp = plugin.rpc.help().get('help')
@@ -992,8 +1760,21 @@ def init(options: dict, configuration: dict, plugin: Plugin, **kwargs):
     plugin.msatfactor = float(options.get("rebalance-msatfactor"))
     plugin.erringnodes = int(options.get("rebalance-erringnodes"))
     plugin.threads = int(options.get("rebalance-threads"))
+    plugin.parts = int(options.get("rebalance-parts"))
+    plugin.engine = SendpayEngine(plugin.rpc, int(options.get("rebalance-inflight")))
     plugin.getroute = getroute_switch(options.get("rebalance-getroute"))
+    plugin.graph_refresh = int(options.get("rebalance-graph-refresh"))
+    plugin.policies.ttl = plugin.aliases.ttl = int(options.get("rebalance-cache-ttl"))
     plugin.rebalanceall_msg = None
+    plugin.htlcs.seed(get_all_channels())
+    plugin.mc.halflife = int(options.get("rebalance-mc-halflife"))
+    if plugin.mc.halflife <= 0:
+        raise ValueError("rebalance-mc-halflife must be greater than 0.")
+    load_mission_control()
+    plugin.failures.base = int(options.get("rebalance-failure-backoff"))
+    load_failures()
+    load_report()
+    start_report_catch_up()
 
     # use getroute amount_msat/msatoshi field depending on version
     plugin.msatfield = 'amount_msat'
@@ -1006,15 +1787,50 @@ def init(options: dict, configuration: dict, plugin: Plugin, **kwargs):
                f"msatfactor:{plugin.msatfactor}  "
                f"erringnodes:{plugin.erringnodes}  "
                f"getroute:{plugin.getroute.__name__}  "
-               f"threads:{plugin.threads}  ")
+               f"graph_refresh:{plugin.graph_refresh}  "
+               f"cache_ttl:{plugin.policies.ttl}  "
+               f"mc_halflife:{plugin.mc.halflife}  "
+               f"failure_backoff:{plugin.failures.base}  "
+               f"threads:{plugin.threads}  "
+               f"parts:{plugin.parts}  "
+               f"inflight:{plugin.engine.inflight}  "
+               f"invoiceless:{plugin.invoiceless}  ")
 
 
 plugin.add_option(
     "rebalance-getroute",
     "iterative",
-    "Getroute method for route search can be 'basic' or 'iterative'."
+    "Getroute method for route search can be 'basic', 'iterative' or 'local'."
     "'basic': Tries all routes sequentially. "
-    "'iterative': Tries shorter and bigger routes first.",
+    "'iterative': Tries shorter and bigger routes first. "
+    "'local': Tries the k-shortest routes of the plugins own channel graph.",
+    "string"
+)
+plugin.add_option(
+    "rebalance-graph-refresh",
+    "600",
+    "Seconds after which the channel graph of the 'local' getroute method "
+    "is reloaded from `listchannels`. Erring channels are updated immediately.",
+    "string"
+)
+plugin.add_option(
+    "rebalance-cache-ttl",
+    "300",
+    "Seconds to cache channel fee policies and node aliases. "
+    "Policies of erring channels are dropped immediately.",
+    "string"
+)
+plugin.add_option(
+    "rebalance-mc-halflife",
+    "3600",
+    "Half-life in seconds of the learned channel liquidity (mission control). "
+    "Known failing channels are skipped, 'local' getroute prefers likely ones.",
+    "string"
+)
+plugin.add_option(
+    "rebalance-failure-backoff",
+    "600",
+    "Seconds a failed channel pair is skipped by rebalanceall, doubled with every further failure.",
     "string"
 )
 plugin.add_option(
@@ -1050,4 +1866,21 @@ plugin.add_option(
     "string"
 )
 
-plugin.run()
+plugin.add_option(
+    "rebalance-parts",
+    "1",
+    "Number of parallel routes (multi-part payment) `rebalanceall` uses "
+    "for one rebalance. Each part must meet the fee limit on its own.",
+    "string"
+)
+
+plugin.add_option(
+    "rebalance-inflight",
+    "32",
+    "Maximum number of sendpay attempts in flight at once over all "
+    "rebalances. Attempts are resolved from sendpay notifications.",
+    "string"
+)
+
+if __name__ == "__main__":
+    plugin.run()
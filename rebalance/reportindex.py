@@ -0,0 +1,153 @@
+import json
+import threading
+import time
+
+
+DAY = 24 * 60 * 60
+
+
+class ReportIndex(object):
+    """ Incremental aggregates for `rebalancereport`.
+
+    Rebalances are indexed by payment_hash: a paid 'Rebalance-' invoice
+    creates a record, completed self-payment parts (by sendpay id) add
+    their amount and fee to it and to the totals. Settled forwards are
+    summed up in buckets per day. Items are counted once, no matter if
+    they come from a notification or from a catch-up via the
+    created/updated indexes. Records are only needed for that until the
+    catch-up cursors passed them, so just recent ones are kept, and the
+    report only sums up totals and a few day buckets.
+    """
+    def __init__(self, days: int = 31):
+        self.lock = threading.Lock()
+        self.keep_days = days
+        self.rebalances = {}  # payment_hash -> {"ids", "amount", "fee", "time"} of recent rebalances
+        self.unmatched = {}   # payment_hash -> {"time", "parts": {id: (amount, fee)}}
+        self.count = 0
+        self.amount = 0
+        self.fee = 0
+        self.cursors = {"invoices": 0, "sendpays": 0, "forwards": 0}
+        self.days = {}        # day -> [out_msat, fee_msat] up to the forwards cursor
+        self.recent = {}      # forward key -> (day, out_msat, fee_msat) from notifications
+        self.caught_up = set()  # forward keys of the last catch-up batch
+
+    def _add_part(self, record, id, amount: int, fee: int):
+        if id in record["ids"]:
+            return False
+        if len(record["ids"]) == 0:
+            self.count += 1
+        record["ids"].append(id)
+        record["amount"] += amount
+        record["fee"] += fee
+        self.amount += amount
+        self.fee += fee
+        return True
+
+    def invoice_paid(self, payment_hash: str):
+        """ Returns True if the record of `payment_hash` changed """
+        with self.lock:
+            if payment_hash in self.rebalances:
+                return False
+            record = {"ids": [], "amount": 0, "fee": 0, "time": time.time()}
+            self.rebalances[payment_hash] = record
+            for id, (amount, fee) in self.unmatched.pop(payment_hash, {"parts": {}})["parts"].items():
+                self._add_part(record, id, amount, fee)
+            return True
+
+    def part_complete(self, payment_hash: str, id: int, amount: int, sent: int):
+        """ A completed payment part to ourselves, returns True if the
+            record of `payment_hash` changed.
+        """
+        with self.lock:
+            record = self.rebalances.get(payment_hash)
+            if record is not None:
+                return self._add_part(record, id, amount, sent - amount)
+            # the invoice may not be known yet or this is no rebalance
+            now = time.time()
+            self.unmatched = {h: u for h, u in self.unmatched.items() if u["time"] > now - 3600}
+            entry = self.unmatched.setdefault(payment_hash, {"time": now, "parts": {}})
+            entry["parts"][id] = (amount, sent - amount)
+            return False
+
+    def forward_notified(self, key, resolved_time: float, out_msat: int, fee_msat: int):
+        with self.lock:
+            if key in self.caught_up:
+                return
+            self.recent[key] = (int(resolved_time // DAY), out_msat, fee_msat)
+
+    def forward_caught_up(self, key, resolved_time: float, out_msat: int, fee_msat: int):
+        with self.lock:
+            # counted now, but maybe notified before
+            self.recent.pop(key, None)
+            self.caught_up.add(key)
+            bucket = self.days.setdefault(str(int(resolved_time // DAY)), [0, 0])
+            bucket[0] += out_msat
+            bucket[1] += fee_msat
+
+    def start_catch_up(self):
+        with self.lock:
+            self.caught_up = set()
+
+    def reset_rebalances(self):
+        """ For a full rescan of invoices and sendpays without indexes """
+        with self.lock:
+            self.rebalances = {}
+            self.unmatched = {}
+            self.count = self.amount = self.fee = 0
+            self.cursors["invoices"] = self.cursors["sendpays"] = 0
+
+    def forget_rebalances(self, before: float):
+        """ Drops the records created before `before`, once the catch-up
+            cursors passed all their parts.
+        """
+        with self.lock:
+            self.rebalances = {h: r for h, r in self.rebalances.items() if r["time"] >= before}
+
+    def reset_forwards(self):
+        """ For a full rescan of forwards without indexes """
+        with self.lock:
+            self.days = {}
+            self.recent = {}
+            self.cursors["forwards"] = 0
+
+    def prune(self, now: float = None):
+        oldest = int((now or time.time()) // DAY) - self.keep_days
+        with self.lock:
+            self.days = {d: b for d, b in self.days.items() if int(d) >= oldest}
+
+    def forward_fee_ppm(self, intervals: list, now: float = None):
+        """ Average forward fee ppm of the last `intervals` days """
+        today = int((now or time.time()) // DAY)
+        with self.lock:
+            buckets = {int(d): list(b) for d, b in self.days.items()}
+            for day, out_msat, fee_msat in self.recent.values():
+                bucket = buckets.setdefault(day, [0, 0])
+                bucket[0] += out_msat
+                bucket[1] += fee_msat
+        res = []
+        for i in intervals:
+            total = sum(b[0] for d, b in buckets.items() if d > today - i)
+            fees = sum(b[1] for d, b in buckets.items() if d > today - i)
+            res.append(fees / total * 10**6 if total > 0 else 0)
+        return res
+
+    def dumps(self):
+        """ Totals, cursors, forward buckets and the recent records """
+        self.prune()
+        with self.lock:
+            return json.dumps({"cursors": self.cursors, "days": self.days,
+                               "count": self.count, "amount": self.amount, "fee": self.fee,
+                               "rebalances": self.rebalances, "unmatched": self.unmatched})
+
+    def loads(self, string: str):
+        state = json.loads(string)
+        with self.lock:
+            self.cursors.update(state["cursors"])
+            self.days = state["days"]
+            self.count = state["count"]
+            self.amount = state["amount"]
+            self.fee = state["fee"]
+            self.rebalances = state["rebalances"]
+            # JSON keys are strings, sendpay ids are not
+            self.unmatched = {h: {"time": u["time"], "parts": {int(id): tuple(part) for id, part in u["parts"].items()}}
+                              for h, u in state["unmatched"].items()}
@@ -0,0 +1,211 @@
+import heapq
+import threading
+import time
+
+
+# Same riskfactor/blocks-per-year weighting lightningd's `getroute` uses
+RISKFACTOR = 10
+BLOCKS_PER_YEAR = 52596
+
+
+def edge_from_gossip(ch):
+    """ Convert a `listchannels` entry into a graph edge """
+    direction = ch.get('direction')
+    if direction is None:
+        direction = int(ch['source'] > ch['destination'])
+    htlc_max = ch.get('htlc_maximum_msat')
+    return {
+        'source': ch['source'],
+        'destination': ch['destination'],
+        'scid': ch['short_channel_id'],
+        'direction': direction,
+        'active': ch.get('active', True),
+        'base_fee': int(ch['base_fee_millisatoshi']),
+        'ppm': int(ch['fee_per_millionth']),
+        'delay': int(ch['delay']),
+        'htlc_min': int(ch.get('htlc_minimum_msat', 0)),
+        'htlc_max': int(htlc_max) if htlc_max is not None else None,
+        'capacity': int(ch['amount_msat']),
+    }
+
+
+def edge_fee(edge, amount: int):
+    # BOLT #7: fee_base_msat + ( amount_to_forward * fee_proportional_millionths / 1000000 )
+    return edge['base_fee'] + (amount * edge['ppm'] + 10**6 - 1) // 10**6
+
+
+def route_excluded(route: list, excludes):
+    excludes = set(excludes)
+    for edge in route:
+        if f"{edge['scid']}/{edge['direction']}" in excludes:
+            return True
+    return any(edge['destination'] in excludes for edge in route[:-1])
+
+
+class ChannelGraph(object):
+    """ In-memory copy of the gossip channel graph.
+
+    Edges are stored per channel direction and indexed by source node, so
+    route searches can run locally without `getroute` round trips.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.edges = {}       # "scid/direction" -> edge
+        self.outgoing = {}    # source node_id -> {"scid/direction": edge}
+        self.loaded_at = 0
+
+    def __len__(self):
+        return len(self.edges)
+
+    def _add(self, edge):
+        key = f"{edge['scid']}/{edge['direction']}"
+        old = self.edges.get(key)
+        if old is not None:
+            self.outgoing[old['source']].pop(key, None)
+        self.edges[key] = edge
+        self.outgoing.setdefault(edge['source'], {})[key] = edge
+        return old
+
+    def load(self, channels: list):
+        """ Replace the whole graph by a `listchannels` result """
+        with self.lock:
+            self.edges = {}
+            self.outgoing = {}
+            for ch in channels:
+                self._add(edge_from_gossip(ch))
+            self.loaded_at = time.time()
+
+    def update(self, channels: list):
+        """ Apply newer gossip for single channels, returns changed edge keys """
+        changed = []
+        with self.lock:
+            for ch in channels:
+                edge = edge_from_gossip(ch)
+                old = self._add(edge)
+                if old != edge:
+                    changed.append(f"{edge['scid']}/{edge['direction']}")
+        return changed
+
+    def remove(self, scid: str):
+        with self.lock:
+            for direction in (0, 1):
+                edge = self.edges.pop(f"{scid}/{direction}", None)
+                if edge is not None:
+                    self.outgoing[edge['source']].pop(f"{scid}/{direction}", None)
+
+    def get(self, scid: str, direction: int):
+        return self.edges.get(f"{scid}/{direction}")
+
+    def usable(self, edge, amount: int):
+        if not edge['active'] or edge['capacity'] < amount:
+            return False
+        if amount < edge['htlc_min']:
+            return False
+        if edge['htlc_max'] is not None and amount > edge['htlc_max']:
+            return False
+        return True
+
+    def shortest_route(self, source: str, target: str, amount: int, maxhops: int,
+                       excludes=(), banned_edges=(), weight=None):
+        """ Cheapest route from `source` to `target` with at most `maxhops` edges.
+
+        Labels are (node, hops) pairs, so a more expensive but shorter path is
+        still found when the cheapest one would exceed the hop limit.
+        `excludes` takes the same "scid/direction" and node_id strings as
+        `getroute`. Returns a list of edges or None.
+        """
+        if weight is None:
+            weight = self.weight
+        excludes = set(excludes)
+        if source in excludes or target in excludes:
+            return None
+        best_hops = {}
+        heap = [(0, 0, source, None)]
+        prev = {}
+        counter = 0
+        while heap:
+            cost, hops, node, label = heapq.heappop(heap)
+            if best_hops.get(node, maxhops + 1) <= hops:
+                continue
+            best_hops[node] = hops
+            if node == target:
+                route = []
+                while label is not None:
+                    edge, label = prev[label]
+                    route.append(edge)
+                route.reverse()
+                return route
+            if hops >= maxhops:
+                continue
+            for key, edge in self.outgoing.get(node, {}).items():
+                dest = edge['destination']
+                if key in excludes or key in banned_edges or dest in excludes:
+                    continue
+                if best_hops.get(dest, maxhops + 1) <= hops + 1:
+                    continue
+                if not self.usable(edge, amount):
+                    continue
+                counter += 1
+                prev[counter] = (edge, label)
+                heapq.heappush(heap, (cost + weight(edge, amount), hops + 1, dest, counter))
+        return None
+
+    def weight(self, edge, amount: int):
+        # fee plus a small lightningd-alike risk premium for the htlc lock time
+        risk = amount * edge['delay'] * RISKFACTOR // (BLOCKS_PER_YEAR * 100)
+        return edge_fee(edge, amount) + risk + 1
+
+    def route_cost(self, route: list, amount: int, weight=None):
+        if weight is None:
+            weight = self.weight
+        return sum(weight(edge, amount) for edge in route)
+
+    def k_shortest_routes(self, source: str, target: str, amount: int, maxhops: int,
+                          excludes=(), weight=None):
+        """ Yen's algorithm: yields loopless routes in order of increasing cost.
+
+        `excludes` is read again for every spur search, so a caller can extend
+        it while consuming the generator. Candidates are checked against the
+        current `excludes` before they are yielded.
+        """
+        with self.lock:
+            first = self.shortest_route(source, target, amount, maxhops, excludes, (), weight)
+        if first is None:
+            return
+        found = [first]
+        seen = {tuple(e['scid'] for e in first)}
+        candidates = []
+        counter = 0
+        yield first
+        while True:
+            last = found[-1]
+            with self.lock:
+                for i in range(len(last)):
+                    root = last[:i]
+                    spur_node = last[i - 1]['destination'] if i > 0 else source
+                    banned_edges = set()
+                    for path in found:
+                        if len(path) > i and [e['scid'] for e in path[:i]] == [e['scid'] for e in root]:
+                            banned_edges.add(f"{path[i]['scid']}/{path[i]['direction']}")
+                    # keep routes loopless: the root path nodes are off limits
+                    banned_nodes = [source] + [e['destination'] for e in root[:-1]] if i > 0 else []
+                    spur = self.shortest_route(spur_node, target, amount, maxhops - i,
+                                               list(excludes) + banned_nodes, banned_edges, weight)
+                    if spur is None:
+                        continue
+                    path = root + spur
+                    key = tuple(e['scid'] for e in path)
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    counter += 1
+                    heapq.heappush(candidates, (self.route_cost(path, amount, weight), counter, path))
+            while candidates:
+                _, _, path = heapq.heappop(candidates)
+                if route_excluded(path, excludes):
+                    continue
+                found.append(path)
+                yield path
+                break
+            else:
+                return
@@ -0,0 +1,93 @@
+import threading
+import time
+
+
+class RouteSearch(object):
+    """ Route search state and trace stats of a single rebalance request.
+
+    Every `rebalance` call gets its own instance, so concurrent rebalance
+    threads never share the progress of the iterative search or the
+    k-shortest route candidates of the 'local' search.
+    """
+    def __init__(self, maxhops: int, msatfactor: float):
+        self.maxhops = maxhops
+        self.msatfactor = msatfactor
+        # start with short routes and high capacity factor, and decrease
+        # the factor to reduce WIRE_TEMPORARY failures because of imbalances
+        self.maxhopidx = 1 if maxhops > 0 else 20
+        self.msatfactoridx = msatfactor
+        self.routes = {}    # (fromid, targetid, msat) -> k-shortest candidates for 'local'
+        self.start_ts = time.time()
+        self.count_getroute = 0
+        self.time_getroute = 0.0
+        self.count_sendpay = 0
+        self.time_sendpay = 0.0
+        self.success = False
+
+    def widen(self):
+        """ Relaxes the iterative search after `getroute` found nothing,
+            returns False when the maxhops limit is exceeded.
+        """
+        # reduce msatfactor to look for smaller channels now
+        self.msatfactoridx -= 1
+        if self.msatfactoridx < 1:
+            # when we reached neutral msat factor:
+            # increase maxhops and restart with msatfactor
+            self.maxhopidx += 1
+            self.msatfactoridx = self.msatfactor
+        return self.maxhops <= 0 or self.maxhopidx <= self.maxhops
+
+    def getroute_done(self, time_start: float):
+        self.count_getroute += 1
+        self.time_getroute += time.time() - time_start
+
+    def sendpay_done(self, time_start: float):
+        self.count_sendpay += 1
+        self.time_sendpay += time.time() - time_start
+
+    def __str__(self):
+        return (f"maxhops:{self.maxhopidx}  msatfactor:{self.msatfactoridx}  "
+                f"running_for:{int(time.time() - self.start_ts)}  "
+                f"count_getroute:{self.count_getroute}  time_getroute:{self.time_getroute:.3f}  "
+                f"time_getroute_avg:{self.time_getroute / max(self.count_getroute, 1):.3f}  "
+                f"count_sendpay:{self.count_sendpay}  time_sendpay:{self.time_sendpay:.3f}  "
+                f"time_sendpay_avg:{self.time_sendpay / max(self.count_sendpay, 1):.3f}")
+
+
+class ThreadStats(object):
+    """ Route search stats of finished rebalance requests summed per thread """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.threads = {}
+
+    def add(self, thread: str, search: RouteSearch):
+        with self.lock:
+            stats = self.threads.setdefault(thread, {
+                "rebalances": 0, "successful": 0, "running_for": 0.0,
+                "count_getroute": 0, "time_getroute": 0.0,
+                "count_sendpay": 0, "time_sendpay": 0.0,
+            })
+            stats["rebalances"] += 1
+            stats["successful"] += int(search.success)
+            stats["running_for"] += time.time() - search.start_ts
+            stats["count_getroute"] += search.count_getroute
+            stats["time_getroute"] += search.time_getroute
+            stats["count_sendpay"] += search.count_sendpay
+            stats["time_sendpay"] += search.time_sendpay
+
+    def clear(self):
+        with self.lock:
+            self.threads.clear()
+
+    def report(self):
+        """ {thread: stats} with rounded times and averages """
+        with self.lock:
+            result = {}
+            for thread, stats in sorted(self.threads.items()):
+                r = dict(stats)
+                for name in ("getroute", "sendpay"):
+                    r[f"time_{name}_avg"] = round(stats[f"time_{name}"] / max(stats[f"count_{name}"], 1), 3)
+                    r[f"time_{name}"] = round(stats[f"time_{name}"], 3)
+                r["running_for"] = round(stats["running_for"], 3)
+                result[thread] = r
+            return result
@@ -0,0 +1,47 @@
+import threading
+
+
+class PairScheduler(object):
+    """ Hands out channel pairs to rebalance threads, best score first.
+
+    A pair is only handed out when neither of its channels is used by another
+    thread. Threads waiting for a free pair sleep on a condition variable and
+    are woken as soon as a running pair is done.
+    """
+    def __init__(self, pairs: list):
+        # pairs: list of (score, ch1, ch2), higher scores are served first
+        self.cond = threading.Condition()
+        self.queue = sorted(pairs, key=lambda p: p[0], reverse=True)
+        self.busy = set()
+        self.running = 0
+
+    def __len__(self):
+        return len(self.queue)
+
+    def take(self, stopping=lambda: False, poll: float = 1.0):
+        """ Returns the best free (ch1, ch2) pair, or None when all are done.
+
+        `stopping` is checked every `poll` seconds while waiting.
+        """
+        with self.cond:
+            while not stopping():
+                for i, (_, ch1, ch2) in enumerate(self.queue):
+                    scid1, scid2 = ch1["short_channel_id"], ch2["short_channel_id"]
+                    if scid1 in self.busy or scid2 in self.busy:
+                        continue
+                    del self.queue[i]
+                    self.busy.update((scid1, scid2))
+                    self.running += 1
+                    return ch1, ch2
+                # nothing left, or only pairs that no running thread can free
+                if len(self.queue) == 0 or self.running == 0:
+                    return None
+                self.cond.wait(poll)
+            return None
+
+    def done(self, pair):
+        with self.cond:
+            self.busy.discard(pair[0]["short_channel_id"])
+            self.busy.discard(pair[1]["short_channel_id"])
+            self.running -= 1
+            self.cond.notify_all()
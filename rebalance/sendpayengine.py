@@ -0,0 +1,122 @@
+import asyncio
+import concurrent.futures
+import functools
+import threading
+from pyln.client import RpcError
+
+
+class SendpayEngine(object):
+    """ Keeps many `sendpay` attempts in flight on one asyncio loop.
+
+    Every attempt is a coroutine on a single loop thread. `sendpay` calls
+    go through a small executor, i.e. a few RPC connections, and attempts
+    are resolved by `sendpay_success`/`sendpay_failure` notifications
+    instead of blocking `waitsendpay` calls. Only when no notification
+    arrives in time, i.e. because the plugin main loop is busy, the
+    attempt is checked with a non-blocking `waitsendpay`.
+
+    Callers get a `concurrent.futures.Future` that resolves to the
+    `sendpay_success` result or raises the `RpcError` of the failure.
+    """
+    def __init__(self, rpc, inflight: int = 32, connections: int = 4, check: float = 1, max_check: float = 10):
+        self.rpc = rpc
+        self.inflight = inflight
+        self.check = check
+        self.max_check = max_check
+        self.executor = concurrent.futures.ThreadPoolExecutor(connections, thread_name_prefix="sendpay")
+        self.loop = None
+        self.semaphore = None
+        self.waiters = {}   # (payment_hash, partid) -> {"future", "id", "early"}
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.loop is not None:
+                return
+            started = threading.Event()
+            threading.Thread(target=self._run, args=(started,), name="sendpayengine", daemon=True).start()
+            started.wait()
+
+    def _run(self, started: threading.Event):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.semaphore = asyncio.Semaphore(self.inflight)
+        started.set()
+        self.loop.run_forever()
+
+    def pending(self):
+        return len(self.waiters)
+
+    def submit(self, route: list, payment_hash: str, sent=None, **kwargs):
+        """ Starts a `sendpay` attempt, `kwargs` are passed to `sendpay`.
+            `sent` is called with the `sendpay` result once it was sent.
+        """
+        self.start()
+        coro = self._attempt(route, payment_hash, sent, kwargs)
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def _attempt(self, route: list, payment_hash: str, sent, kwargs: dict):
+        key = (payment_hash, kwargs.get('partid') or 0)
+        async with self.semaphore:
+            waiter = {"future": self.loop.create_future(), "id": None, "early": []}
+            self.waiters[key] = waiter
+            try:
+                call = functools.partial(self.rpc.sendpay, route, payment_hash, **kwargs)
+                result = await self.loop.run_in_executor(self.executor, call)
+                if sent is not None:
+                    sent(result)
+                # notifications can overtake the `sendpay` result
+                waiter["id"] = result.get('id')
+                for args in waiter["early"]:
+                    self._resolve(key, *args)
+                check = self.check
+                while True:
+                    try:
+                        return await asyncio.wait_for(asyncio.shield(waiter["future"]), check)
+                    except asyncio.TimeoutError:
+                        result = await self.loop.run_in_executor(self.executor, self._check, key)
+                        if result is not None:
+                            return result
+                        check = min(check * 2, self.max_check)
+            finally:
+                if self.waiters.get(key) is waiter:
+                    del self.waiters[key]
+
+    def _check(self, key):
+        try:
+            return self.rpc.waitsendpay(key[0], 0, partid=key[1])
+        except RpcError as e:
+            if e.method == "waitsendpay" and e.error.get('code') == 200:
+                return None
+            raise e
+
+    def _resolve(self, key, id, result=None, error=None):
+        waiter = self.waiters.get(key)
+        if waiter is None or waiter["future"].done():
+            return
+        if waiter["id"] is None:
+            waiter["early"].append((id, result, error))
+            return
+        # ignore late notifications of earlier attempts with the same partid
+        if id is not None and id != waiter["id"]:
+            return
+        if error is not None:
+            waiter["future"].set_exception(error)
+        else:
+            waiter["future"].set_result(result)
+
+    def success(self, payment: dict):
+        """ To be called with `sendpay_success` notifications """
+        if self.loop is None:
+            return
+        key = (payment.get('payment_hash'), payment.get('partid') or 0)
+        self.loop.call_soon_threadsafe(self._resolve, key, payment.get('id'), payment)
+
+    def failure(self, failure: dict):
+        """ To be called with `sendpay_failure` notifications """
+        if self.loop is None:
+            return
+        data = failure.get('data', {})
+        key = (data.get('payment_hash'), data.get('partid') or 0)
+        error = RpcError("waitsendpay", {"payment_hash": key[0], "partid": key[1]}, failure)
+        self.loop.call_soon_threadsafe(self._resolve, key, data.get('id'), None, error)
@@ -0,0 +1,40 @@
+import time
+from failurebackoff import FailureBackoff
+
+
+def test_backoff_doubles():
+    failures = FailureBackoff(base=600, max_doublings=3)
+    failures.fail("1x1x1:2x2x2")
+    assert "1x1x1:2x2x2" in failures
+    assert "2x2x2:1x1x1" not in failures
+    assert 599 < failures.remaining("1x1x1:2x2x2") <= 600
+    for _ in range(5):
+        failures.fail("1x1x1:2x2x2")
+    # capped at base * 2**max_doublings
+    assert 4799 < failures.remaining("1x1x1:2x2x2") <= 4800
+    assert failures.failures == 6
+    failures.succeed("1x1x1:2x2x2")
+    assert "1x1x1:2x2x2" not in failures
+    assert len(failures) == 0
+
+
+def test_backoff_expires():
+    failures = FailureBackoff(base=600, max_doublings=1)
+    failures.fail("1x1x1")
+    failures.entries["1x1x1"]["until"] = time.time() - 1
+    assert "1x1x1" not in failures
+    # the failure count is remembered for a while, then forgotten
+    failures.prune()
+    assert failures.entries["1x1x1"]["failures"] == 1
+    failures.entries["1x1x1"]["time"] = time.time() - 1201
+    failures.prune()
+    assert failures.entries == {}
+
+
+def test_backoff_dumps():
+    failures = FailureBackoff()
+    failures.fail("1x1x1:2x2x2")
+    loaded = FailureBackoff()
+    loaded.loads(failures.dumps())
+    assert "1x1x1:2x2x2" in loaded
+    assert loaded.failures == 0
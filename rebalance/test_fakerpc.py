@@ -0,0 +1,57 @@
+import pytest
+from pyln.client import Millisatoshi, RpcError
+from fakerpc import FakeRpc
+
+
+def test_fakerpc_payment_moves_liquidity():
+    rpc = FakeRpc(nodes=20, our_channels=4, liquidity=0.5)
+    notifications = []
+    rpc.listeners.append(lambda topic, payload: notifications.append(topic))
+    channels = rpc.listpeerchannels()['channels']
+    out, inc = channels[0], channels[1]
+    route = rpc.getroute(inc['peer_id'], 10**6, fromid=out['peer_id'], exclude=[rpc.me])['route']
+    invoice = rpc.invoice(10**6, "label", "description")
+    route = [{'id': out['peer_id'], 'channel': out['short_channel_id'], 'direction': 0}] + route \
+        + [{'id': rpc.me, 'channel': inc['short_channel_id'], 'direction': 0}]
+    for hop in route:
+        hop['amount_msat'] = Millisatoshi(10**6)
+    rpc.sendpay(route, invoice['payment_hash'], payment_secret=invoice['payment_secret'])
+    assert rpc.waitsendpay(invoice['payment_hash'])['status'] == 'complete'
+    assert notifications == ['invoice_payment', 'sendpay_success']
+    channels = {ch['short_channel_id']: ch for ch in rpc.listpeerchannels()['channels']}
+    assert channels[out['short_channel_id']]['to_us_msat'] == out['to_us_msat'] - 10**6
+    assert channels[inc['short_channel_id']]['to_us_msat'] == inc['to_us_msat'] + 10**6
+    with pytest.raises(RpcError):
+        rpc.delinvoice("label", "unpaid")
+
+
+def test_fakerpc_liquidity_failure():
+    rpc = FakeRpc(nodes=20, our_channels=4, liquidity=0.5)
+    out = rpc.listpeerchannels()['channels'][0]
+    amount = Millisatoshi(int(out['to_us_msat']) + 1)
+    route = [{'id': out['peer_id'], 'channel': out['short_channel_id'], 'direction': 0, 'amount_msat': amount}]
+    rpc.sendpay(route, 'hash')
+    with pytest.raises(RpcError) as e:
+        rpc.waitsendpay('hash', 0)
+    assert e.value.error['data']['erring_index'] == 0
+    assert rpc.calls['sendpay'] == 1
+
+
+def test_fakerpc_htlc_hook():
+    rpc = FakeRpc(nodes=20, our_channels=4, liquidity=0.5)
+    results = iter([{'result': 'resolve', 'payment_key': '00' * 32}, {'result': 'fail', 'failure_message': '0017'}])
+    rpc.htlc_hook = lambda htlc, onion, request: request.set_result(next(results))
+    channels = rpc.listpeerchannels()['channels']
+    out, inc = channels[0], channels[1]
+    route = rpc.getroute(inc['peer_id'], 10**6, fromid=out['peer_id'], exclude=[rpc.me])['route']
+    route = [{'id': out['peer_id'], 'channel': out['short_channel_id'], 'direction': 0}] + route \
+        + [{'id': rpc.me, 'channel': inc['short_channel_id'], 'direction': 0}]
+    for hop in route:
+        hop['amount_msat'] = Millisatoshi(10**6)
+    rpc.sendpay(route, 'hash', partid=1)
+    rpc.sendpay(route, 'hash', partid=2)
+    assert rpc.waitsendpay('hash', partid=1)['status'] == 'complete'
+    with pytest.raises(RpcError):
+        rpc.waitsendpay('hash', partid=2)
+    channels = {ch['short_channel_id']: ch for ch in rpc.listpeerchannels()['channels']}
+    assert channels[out['short_channel_id']]['to_us_msat'] == out['to_us_msat'] - 10**6
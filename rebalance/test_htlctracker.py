@@ -0,0 +1,47 @@
+import threading
+from htlctracker import HtlcTracker
+
+
+def test_htlctracker_counts():
+    tracker = HtlcTracker()
+    tracker.seed([{'short_channel_id': '1x1x1', 'htlcs': [{}, {}]},
+                  {'short_channel_id': '1x2x1', 'htlcs': []},
+                  {'state': 'OPENINGD'}])
+    assert tracker.count('1x1x1') == 2
+    assert tracker.count('1x2x1') == 0
+    tracker.offered(('forward', 'hash', '1x1x1', 0), ['1x1x1', '1x2x1'])
+    # duplicate notifications are not counted twice
+    tracker.offered(('forward', 'hash', '1x1x1', 0), ['1x1x1', '1x2x1'])
+    assert tracker.count('1x1x1') == 3
+    assert tracker.count('1x2x1') == 1
+    tracker.resolved(('forward', 'hash', '1x1x1', 0))
+    tracker.resolved(('forward', 'hash', '1x1x1', 0))
+    assert tracker.count('1x1x1') == 2
+    assert tracker.count('1x2x1') == 0
+    tracker.reset('1x1x1')
+    assert tracker.count('1x1x1') == 0
+
+
+def test_htlctracker_early_resolution():
+    tracker = HtlcTracker()
+    # the failure notification overtook the sendpay result
+    tracker.resolved(('sendpay', 1), early=True)
+    tracker.offered(('sendpay', 1), ['1x1x1'])
+    assert tracker.count('1x1x1') == 0
+    # unknown forward resolutions are simply ignored
+    tracker.resolved(('forward', 'hash', '1x1x1', 0))
+    tracker.offered(('forward', 'hash', '1x1x1', 0), ['1x1x1'])
+    assert tracker.count('1x1x1') == 1
+
+
+def test_htlctracker_wait():
+    tracker = HtlcTracker()
+    assert tracker.wait(['1x1x1'], 0)
+    tracker.offered(('sendpay', 1), ['1x1x1', '1x2x1'])
+    assert not tracker.wait(['1x1x1'], 0.01)
+    result = []
+    t = threading.Thread(target=lambda: result.append(tracker.wait(['1x1x1', '1x2x1'], 30)))
+    t.start()
+    tracker.resolved(('sendpay', 1))
+    t.join(5)
+    assert result == [True]
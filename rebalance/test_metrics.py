@@ -0,0 +1,38 @@
+import pytest
+from metrics import Histogram, RebalanceMetrics
+
+
+def test_histogram():
+    h = Histogram()
+    assert h.quantile(0.5) == 0.0
+    for seconds in [0.001] * 8 + [0.3, 400]:
+        h.observe(seconds)
+    assert h.count == 10
+    assert h.quantile(0.5) == 0.001
+    assert h.quantile(0.9) == 0.5
+    assert h.quantile(1) == 400
+    report = h.report()
+    assert report["buckets"] == {"le_0.001s": 8, "le_0.5s": 1, "inf": 1}
+    assert report["max_s"] == 400
+
+
+def test_rebalance_metrics():
+    metrics = RebalanceMetrics()
+    with metrics.timed("getroute"):
+        pass
+    with pytest.raises(KeyError):
+        with metrics.timed("getroute"):
+            raise KeyError()
+    metrics.attempt()
+    metrics.attempt({"failcode": 4103, "failcodename": "WIRE_TEMPORARY_CHANNEL_FAILURE", "erring_node": "02aa"})
+    metrics.attempt({"failcode": 16399, "erring_node": "02aa"})
+    metrics.result("complete")
+    report = metrics.report()
+    assert report["phases"]["getroute"]["count"] == 2
+    assert report["errors"] == {"getroute": 1}
+    assert report["attempts"] == {"success": 1, "failure": 2}
+    assert report["failcodes"] == {"WIRE_TEMPORARY_CHANNEL_FAILURE": 1, "16399": 1}
+    assert report["erring_nodes"] == {"02aa": 2}
+    assert report["rebalances"] == {"complete": 1}
+    metrics.reset()
+    assert metrics.report()["attempts"] == {}
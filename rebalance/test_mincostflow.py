@@ -0,0 +1,59 @@
+from mincostflow import FlowNetwork, TransferPlan, min_cost_transfers
+
+
+def test_flownetwork():
+    network = FlowNetwork()
+    a = network.add_arc("s", "a", 4, -10)
+    b = network.add_arc("s", "b", 2, -10)
+    network.add_arc("a", "t", 3, 1)
+    network.add_arc("b", "t", 3, 1)
+    ab = network.add_arc("a", "b", 5, 2)
+    assert network.solve("s", "t") == (6, -6 * 9 + 2)
+    assert (network.flow(a), network.flow(b), network.flow(ab)) == (4, 2, 1)
+
+
+def test_min_cost_transfers():
+    senders = {"x": [(100, -5)], "y": [(50, -5)]}
+    receivers = {"u": [(120, -5)], "v": [(30, -5), (100, 0)]}
+    costs = {("x", "u"): 1, ("x", "v"): 3, ("y", "u"): 2, ("y", "v"): 1}
+    transfers = min_cost_transfers(senders, receivers, lambda s, r: costs[(s, r)])
+    assert transfers == {("x", "u"): 100, ("y", "u"): 20, ("y", "v"): 30}
+    # unprofitable or impossible transfers are left out
+    transfers = min_cost_transfers(senders, receivers, lambda s, r: 20 if r == "u" else None)
+    assert transfers == {}
+
+
+def test_transferplan_update():
+    costs = {("x", "u"): 1, ("x", "v"): 3, ("y", "u"): 2, ("y", "v"): 1}
+    senders = {"x": [(100, -5)], "y": [(50, -5)]}
+    receivers = {"u": [(120, -5)], "v": [(30, -5), (100, 0)]}
+    plan = TransferPlan(senders, receivers, lambda s, r: costs[(s, r)])
+    assert plan.transfers() == {("x", "u"): 100, ("y", "u"): 20, ("y", "v"): 30}
+
+    def check(senders, receivers):
+        # the updated plan is as cheap as one solved from scratch
+        expected = min_cost_transfers(senders, receivers, lambda s, r: costs.get((s, r)))
+        cost = sum(amount * costs[pair] for pair, amount in plan.transfers().items())
+        assert cost == sum(amount * costs[pair] for pair, amount in expected.items())
+        assert sum(plan.transfers().values()) == sum(expected.values())
+
+    # a forward took liquidity from x
+    senders["x"] = [(40, -5)]
+    plan.update({"x": (senders["x"], None)})
+    assert plan.transfers() == {("x", "u"): 40, ("y", "u"): 20, ("y", "v"): 30}
+    check(senders, receivers)
+    # and gave it to y, which can now fill up u
+    senders["y"] = [(110, -5)]
+    plan.update({"y": (senders["y"], None)})
+    check(senders, receivers)
+    assert sum(plan.transfers().values()) == 150
+    # u needs less, v more
+    receivers["u"] = [(10, -5)]
+    receivers["v"] = [(140, -5), (0, 0)]
+    plan.update({"u": (None, receivers["u"]), "v": (None, receivers["v"])})
+    check(senders, receivers)
+    # y -> v failed
+    plan.remove("y", "v")
+    del costs[("y", "v")]
+    check(senders, receivers)
+    assert ("y", "v") not in plan.transfers()
@@ -0,0 +1,55 @@
+from missioncontrol import MissionControl, WIRE_TEMPORARY_CHANNEL_FAILURE, WIRE_UNKNOWN_NEXT_PEER
+
+
+def hops(*scids):
+    return [{'channel': scid, 'direction': 0} for scid in scids]
+
+
+def test_probability_bounds():
+    mc = MissionControl()
+    # no knowledge: uniform prior over the capacity, or certain success
+    assert mc.probability('1x1x1/0', 250, capacity=1000) == 0.75
+    assert mc.probability('1x1x1/0', 250) == 1.0
+    mc.success('1x1x1/0', 300, capacity=1000)
+    mc.failure('1x1x1/0', 700)
+    assert mc.probability('1x1x1/0', 300) == 1.0
+    assert mc.probability('1x1x1/0', 700) == 0.0
+    assert abs(mc.probability('1x1x1/0', 500) - 0.5) < 0.01
+    assert mc.unlikely(800) == ['1x1x1/0']
+    assert mc.unlikely(200) == []
+    # a newer success above the failed amount wins
+    mc.success('1x1x1/0', 800)
+    assert mc.probability('1x1x1/0', 800) == 1.0
+
+
+def test_decay():
+    mc = MissionControl(halflife=3600)
+    mc.failure('1x1x1/0', 500, capacity=1000)
+    mc.channels['1x1x1/0']['time'] -= 3600
+    # one half-life later the upper bound moved half way back to the capacity
+    assert abs(mc.probability('1x1x1/0', 500) - 1 / 3) < 0.01
+    mc.channels['1x1x1/0']['time'] -= 36000
+    mc.prune()
+    assert len(mc) == 0
+
+
+def test_learn_failure():
+    mc = MissionControl()
+    route = hops('1x1x1', '1x2x1', '1x3x1')
+    mc.learn_failure(route, [1002, 1001, 1000], [None] * 3, 1, WIRE_TEMPORARY_CHANNEL_FAILURE)
+    assert mc.probability('1x1x1/0', 1002) == 1.0
+    assert mc.probability('1x2x1/0', 1001) == 0.0
+    assert '1x3x1/0' not in mc.channels
+    mc.learn_failure(route, [1002, 1001, 1000], [10**6] * 3, 2, WIRE_UNKNOWN_NEXT_PEER)
+    assert mc.probability('1x3x1/0', 1) == 0.0
+    assert mc.penalty('1x3x1/0', 1) > mc.penalty('1x1x1/0', 1)
+    mc.learn_success(route, [1002, 1001, 1000], [10**6] * 3)
+    assert mc.probability('1x3x1/0', 1000) == 1.0
+
+
+def test_serialization():
+    mc = MissionControl()
+    mc.failure('1x1x1/0', 500)
+    mc2 = MissionControl()
+    mc2.loads(mc.dumps())
+    assert mc2.channels == mc.channels
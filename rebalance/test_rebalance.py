@@ -4,6 +4,7 @@ from pyln.client import Millisatoshi
 
 plugin_path = os.path.join(os.path.dirname(__file__), "rebalance.py")
 plugin_opt = {'plugin': plugin_path}
+invoiceless_path = os.path.join(os.path.dirname(__file__), "rebalance-invoiceless.py")
 
 
 # waits for a bunch of nodes HTLCs to settle
@@ -92,6 +93,30 @@ def test_rebalance_manual(node_factory, bitcoind):
     assert report.get('total_successful_rebalances') == 2
 
 
+def test_rebalance_invoiceless(node_factory, bitcoind):
+    l1, l2, l3 = node_factory.line_graph(3, opts={'plugin': invoiceless_path})
+    l1.daemon.logsearch_start = 0
+    l1.daemon.wait_for_log("Plugin rebalance initialized.*invoiceless:True")
+    nodes = [l1, l2, l3]
+
+    # form a circle so we can do rebalancing
+    l3.connect(l1)
+    l3.fundchannel(l1)
+    scid12 = l1.get_channel_scid(l2)
+    scid23 = l2.get_channel_scid(l3)
+    scid31 = l3.get_channel_scid(l1)
+    bitcoind.generate_block(6)
+    wait_for_all_active(nodes, [scid12, scid23, scid31])
+
+    # settled by the htlc_accepted hook, no invoice is created
+    result = l1.rpc.rebalance(scid12, scid31, '250000000msat', parts=2)
+    assert result['status'] == 'complete'
+    assert result['received'] == '250000000msat'
+    assert l1.rpc.listinvoices()['invoices'] == []
+    assert l1.rpc.rebalancereport().get('total_successful_rebalances') == 1
+    wait_for_all_htlcs(nodes)
+
+
 def test_rebalance_all(node_factory, bitcoind):
     l1, l2, l3 = node_factory.line_graph(3, opts=plugin_opt)
     l1.daemon.logsearch_start = 0
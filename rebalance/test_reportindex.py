@@ -0,0 +1,46 @@
+import time
+from reportindex import ReportIndex, DAY
+
+
+def test_reportindex_rebalances():
+    report = ReportIndex()
+    # the part completes before the invoice is seen
+    assert not report.part_complete('hash1', 1, 1000, 1010)
+    assert report.invoice_paid('hash1')
+    assert not report.invoice_paid('hash1')
+    assert report.part_complete('hash1', 2, 500, 502)
+    # duplicates from a catch-up are not counted twice
+    assert not report.part_complete('hash1', 2, 500, 502)
+    # no rebalance invoice, no rebalance
+    report.part_complete('hash2', 3, 1000, 1100)
+    assert (report.count, report.amount, report.fee) == (1, 1500, 12)
+
+    # the totals and recent records are saved, a catch-up after a
+    # restart does not count them again
+    loaded = ReportIndex()
+    loaded.loads(report.dumps())
+    assert not loaded.invoice_paid('hash1')
+    assert not loaded.part_complete('hash1', 1, 1000, 1010)
+    assert (loaded.count, loaded.amount, loaded.fee) == (1, 1500, 12)
+    assert loaded.invoice_paid('hash2')
+    assert (loaded.count, loaded.amount, loaded.fee) == (2, 2500, 112)
+
+    # records the cursors passed are dropped, the totals stay
+    loaded.forget_rebalances(time.time() + 1)
+    assert len(loaded.rebalances) == 0
+    assert (loaded.count, loaded.amount, loaded.fee) == (2, 2500, 112)
+
+
+def test_reportindex_forwards():
+    now = time.time()
+    report = ReportIndex()
+    report.forward_notified('1x1x1/0', now, 10**6, 100)
+    report.forward_caught_up('1x1x1/0', now, 10**6, 100)
+    # notified after the catch-up already counted it
+    report.forward_notified('1x1x1/0', now, 10**6, 100)
+    report.forward_notified('1x1x1/1', now - 3 * DAY, 10**6, 400)
+    assert report.forward_fee_ppm([1, 7, 30], now) == [100, 250, 250]
+
+    loaded = ReportIndex()
+    loaded.loads(report.dumps())
+    assert loaded.forward_fee_ppm([1, 7], now) == [100, 100]
@@ -0,0 +1,87 @@
+from routegraph import ChannelGraph, edge_fee
+
+
+def gossip(source, destination, scid, base=1000, ppm=100, capacity=10**9):
+    return {
+        'source': source,
+        'destination': destination,
+        'short_channel_id': scid,
+        'active': True,
+        'base_fee_millisatoshi': base,
+        'fee_per_millionth': ppm,
+        'delay': 6,
+        'htlc_minimum_msat': 0,
+        'htlc_maximum_msat': capacity,
+        'amount_msat': capacity,
+    }
+
+
+def both(a, b, scid, **kwargs):
+    return [gossip(a, b, scid, **kwargs), gossip(b, a, scid, **kwargs)]
+
+
+def make_graph():
+    # A - B - D is cheap, A - C - D is more expensive, A - D is the most expensive
+    graph = ChannelGraph()
+    graph.load(both('A', 'B', '1x1x1') + both('B', 'D', '1x2x1')
+               + both('A', 'C', '1x3x1', ppm=500) + both('C', 'D', '1x4x1', ppm=500)
+               + both('A', 'D', '1x5x1', base=10000, ppm=5000))
+    return graph
+
+
+def scids(route):
+    return [e['scid'] for e in route]
+
+
+def test_edge_fee():
+    edge = {'base_fee': 1000, 'ppm': 1}
+    # rounds up as required by BOLT #7
+    assert edge_fee(edge, 1) == 1001
+    assert edge_fee(edge, 10**6) == 1001
+    assert edge_fee(edge, 10**6 + 1) == 1002
+
+
+def test_shortest_route():
+    graph = make_graph()
+    assert len(graph) == 10
+    assert scids(graph.shortest_route('A', 'D', 10**6, 20)) == ['1x1x1', '1x2x1']
+    # hop limit forces the direct channel
+    assert scids(graph.shortest_route('A', 'D', 10**6, 1)) == ['1x5x1']
+    # getroute style excludes for nodes and channel directions
+    assert scids(graph.shortest_route('A', 'D', 10**6, 20, ['B'])) == ['1x3x1', '1x4x1']
+    direction = graph.get('1x1x1', 0)['direction']
+    excludes = ['1x1x1/' + str(direction), '1x3x1/0', '1x3x1/1']
+    assert scids(graph.shortest_route('A', 'D', 10**6, 20, excludes)) == ['1x5x1']
+    # too big for any channel
+    assert graph.shortest_route('A', 'D', 10**10, 20) is None
+
+
+def test_k_shortest_routes():
+    graph = make_graph()
+    routes = [scids(r) for r in graph.k_shortest_routes('A', 'D', 10**6, 20)]
+    assert routes[:3] == [['1x1x1', '1x2x1'], ['1x3x1', '1x4x1'], ['1x5x1']]
+    # no route visits a node twice
+    for route in graph.k_shortest_routes('A', 'D', 10**6, 20):
+        nodes = [e['destination'] for e in route]
+        assert len(nodes) == len(set(nodes))
+
+
+def test_k_shortest_routes_live_excludes():
+    graph = make_graph()
+    excludes = []
+    routes = graph.k_shortest_routes('A', 'D', 10**6, 20, excludes)
+    assert scids(next(routes)) == ['1x1x1', '1x2x1']
+    # caller learns C is bad while consuming the generator
+    excludes.append('C')
+    assert scids(next(routes)) == ['1x5x1']
+
+
+def test_update_and_remove():
+    graph = make_graph()
+    changed = graph.update([gossip('A', 'B', '1x1x1', ppm=100000)])
+    assert changed == ['1x1x1/' + str(graph.get('1x1x1', 0)['direction'])]
+    assert graph.update([gossip('A', 'B', '1x1x1', ppm=100000)]) == []
+    assert scids(graph.shortest_route('A', 'D', 10**6, 20)) == ['1x3x1', '1x4x1']
+    graph.remove('1x3x1')
+    assert graph.get('1x3x1', 0) is None
+    assert scids(graph.shortest_route('A', 'D', 10**6, 20)) == ['1x5x1']
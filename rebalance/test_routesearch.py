@@ -0,0 +1,40 @@
+from routesearch import RouteSearch, ThreadStats
+
+
+def test_routesearch_widen():
+    search = RouteSearch(maxhops=3, msatfactor=2)
+    assert (search.maxhopidx, search.msatfactoridx) == (1, 2)
+    steps = []
+    while search.widen():
+        steps.append((search.maxhopidx, search.msatfactoridx))
+    assert steps == [(1, 1), (2, 2), (2, 1), (3, 2), (3, 1)]
+    # maxhops <= 0 disables the limit
+    search = RouteSearch(maxhops=0, msatfactor=1)
+    assert search.maxhopidx == 20
+    assert all(search.widen() for _ in range(10))
+
+
+def test_routesearch_independent():
+    a = RouteSearch(maxhops=5, msatfactor=4)
+    b = RouteSearch(maxhops=5, msatfactor=4)
+    a.widen()
+    a.routes["key"] = iter([])
+    assert (b.msatfactoridx, b.routes) == (4, {})
+
+
+def test_thread_stats():
+    stats = ThreadStats()
+    for thread, success in [("thread0", True), ("thread0", False), ("thread1", True)]:
+        search = RouteSearch(maxhops=5, msatfactor=4)
+        search.getroute_done(search.start_ts)
+        search.sendpay_done(search.start_ts)
+        search.success = success
+        stats.add(thread, search)
+    report = stats.report()
+    assert list(report) == ["thread0", "thread1"]
+    assert report["thread0"]["rebalances"] == 2
+    assert report["thread0"]["successful"] == 1
+    assert report["thread0"]["count_getroute"] == 2
+    assert report["thread1"]["count_sendpay"] == 1
+    stats.clear()
+    assert stats.report() == {}
@@ -0,0 +1,42 @@
+import threading
+from scheduler import PairScheduler
+
+
+def chan(scid):
+    return {"short_channel_id": scid}
+
+
+def test_scheduler_order():
+    a, b, c, d = chan("1x1x1"), chan("1x2x1"), chan("1x3x1"), chan("1x4x1")
+    scheduler = PairScheduler([(1, a, b), (3, a, c), (2, d, b)])
+    assert len(scheduler) == 3
+    # best pair first, then the best one not sharing a busy channel
+    first = scheduler.take()
+    assert first == (a, c)
+    second = scheduler.take()
+    assert second == (d, b)
+    scheduler.done(first)
+    scheduler.done(second)
+    assert scheduler.take() == (a, b)
+    assert scheduler.take() is None
+
+
+def test_scheduler_wakeup():
+    a, b, c = chan("1x1x1"), chan("1x2x1"), chan("1x3x1")
+    scheduler = PairScheduler([(2, a, b), (1, b, c)])
+    first = scheduler.take()
+    taken = []
+    t = threading.Thread(target=lambda: taken.append(scheduler.take(poll=30)))
+    t.start()
+    # the waiting thread needs channel b, it is woken when it gets freed
+    scheduler.done(first)
+    t.join(5)
+    assert not t.is_alive()
+    assert taken == [(b, c)]
+
+
+def test_scheduler_stopping():
+    a, b = chan("1x1x1"), chan("1x2x1")
+    scheduler = PairScheduler([(2, a, b), (1, b, a)])
+    scheduler.take()
+    assert scheduler.take(stopping=lambda: True) is None
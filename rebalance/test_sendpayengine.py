@@ -0,0 +1,55 @@
+import time
+import pytest
+from pyln.client import RpcError
+from sendpayengine import SendpayEngine
+
+
+class Rpc(object):
+    def __init__(self):
+        self.ids = 0
+        self.notify = None
+
+    def sendpay(self, route, payment_hash, partid=None, **kwargs):
+        self.ids += 1
+        if self.notify is not None:
+            self.notify(self.ids)
+        return {'id': self.ids, 'status': 'pending'}
+
+    def waitsendpay(self, payment_hash, timeout, partid=None):
+        raise RpcError("waitsendpay", {}, {'code': 200, 'message': 'Timed out while waiting'})
+
+
+def test_sendpayengine_notifications():
+    rpc = Rpc()
+    engine = SendpayEngine(rpc, check=30)
+    sent = []
+    f1 = engine.submit([], 'hash', sent=sent.append, partid=1)
+    f2 = engine.submit([], 'hash', partid=2)
+    while engine.pending() < 2 or any(w['id'] is None for w in engine.waiters.values()):
+        time.sleep(0.01)
+    # a late notification of an earlier attempt does not resolve the part
+    engine.success({'id': 99, 'payment_hash': 'hash', 'partid': 1})
+    engine.success({'id': 1, 'payment_hash': 'hash', 'partid': 1})
+    engine.failure({'code': 204, 'data': {'id': 2, 'payment_hash': 'hash', 'partid': 2, 'erring_index': 1}})
+    assert f1.result(5)['id'] == 1
+    assert sent == [{'id': 1, 'status': 'pending'}]
+    with pytest.raises(RpcError) as e:
+        f2.result(5)
+    assert e.value.error['data']['erring_index'] == 1
+    assert engine.pending() == 0
+
+
+def test_sendpayengine_early_notification():
+    rpc = Rpc()
+    engine = SendpayEngine(rpc, check=30)
+    # the notification overtakes the sendpay result
+    rpc.notify = lambda id: engine.success({'id': id, 'payment_hash': 'hash'})
+    assert engine.submit([], 'hash').result(5)['id'] == 1
+
+
+def test_sendpayengine_check():
+    rpc = Rpc()
+    engine = SendpayEngine(rpc, check=0.01)
+    rpc.waitsendpay = lambda payment_hash, timeout, partid=None: {'id': 1, 'status': 'complete'}
+    # without notifications the attempt is checked with waitsendpay
+    assert engine.submit([], 'hash').result(5)['status'] == 'complete'
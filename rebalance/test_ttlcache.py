@@ -0,0 +1,28 @@
+import time
+from ttlcache import TTLCache
+
+
+def test_ttlcache():
+    cache = TTLCache(60)
+    assert cache.get('1x1x1/0') is None
+    cache.put('1x1x1/0', {'fee_ppm': 10})
+    assert cache.get('1x1x1/0') == {'fee_ppm': 10}
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.invalidate('1x1x1/0')
+    assert cache.get('1x1x1/0') is None
+    cache.put('1x1x1/1', 'alias')
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_ttlcache_expiry():
+    cache = TTLCache(0.05)
+    cache.put('a', 1)
+    time.sleep(0.06)
+    assert cache.get('a') is None
+    assert len(cache) == 0
+    # expired entries are swept on put
+    cache.put('b', 2)
+    time.sleep(0.06)
+    cache.put('c', 3)
+    assert len(cache) == 1
@@ -0,0 +1,47 @@
+import threading
+import time
+
+
+class TTLCache(object):
+    """ Thread-safe key/value cache whose entries expire after `ttl` seconds.
+
+    Expired entries are dropped on access and swept once per `ttl` period, so
+    the cache never grows beyond what was used within the last two periods.
+    """
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}  # key -> (expires_at, value)
+        self.next_sweep = time.time() + ttl
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= now:
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        now = time.time()
+        with self.lock:
+            self.entries[key] = (now + self.ttl, value)
+            if now >= self.next_sweep:
+                self.entries = {k: e for k, e in self.entries.items() if e[0] > now}
+                self.next_sweep = now + self.ttl
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}